@@ -4,29 +4,56 @@ import logging as _logging
 import logging.handlers as _logging_handlers
 import atexit
 
-_log = _logging.getLogger()
-_log.setLevel(_logging.INFO)
+log = _logging.getLogger(__name__)
 
-_log_handler = _logging_handlers.RotatingFileHandler(os.path.join(os.path.dirname(__file__), 'logs', 'run.log'),
-                                                     mode='a', maxBytes=1024**2, backupCount=3)
-_log_handler.setFormatter(_logging.Formatter('%(asctime)s [%(name)s:%(lineno)d] [%(levelname)s] %(message)s'))
-_log_handler.setLevel(_logging.DEBUG)
-_log.addHandler(_log_handler)
+_logging_set_up = False
 
-_console_handler = _logging.StreamHandler(sys.stdout)
-_console_handler.setFormatter(_logging.Formatter('%(message)s'))
-_console_handler.setLevel(_logging.INFO)
-_log.addHandler(_console_handler)
+def setup_logging(directory=None):
+    '''Logs INFO and up to stdout, and everything to run.log in `directory` (default log_dir, or github_repos/logs).
+    Called by the command line entry points, so that importing the package leaves logging alone'''
+    global _logging_set_up
 
-log = _logging.getLogger(__name__)
+    if _logging_set_up:
+        return
+    _logging_set_up = True
+
+    directory = directory or getattr(config, 'log_dir', None) or os.path.join(os.path.dirname(__file__), 'logs')
+    os.makedirs(directory, exist_ok=True)
+
+    root = _logging.getLogger()
+    root.setLevel(_logging.INFO)
+
+    file_handler = _logging_handlers.RotatingFileHandler(os.path.join(directory, 'run.log'),
+                                                         mode='a', maxBytes=1024**2, backupCount=3)
+    file_handler.setFormatter(_logging.Formatter('%(asctime)s [%(name)s:%(lineno)d] [%(levelname)s] %(message)s'))
+    file_handler.setLevel(_logging.DEBUG)
+    root.addHandler(file_handler)
+
+    console_handler = _logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(_logging.Formatter('%(message)s'))
+    console_handler.setLevel(_logging.INFO)
+    root.addHandler(console_handler)
 
-atexit.register(log.info, "Exiting")
+    atexit.register(log.info, "Exiting")
 
 from . import config
 from . import db
 from . import graphql
 from . import util
+from . import cache
+from . import costmodel
+from . import tokens
+from . import transport
+from . import frontier
+from . import ingest
+from . import aggregates
+from . import migrations
+from . import workqueue
+from . import archive
+from . import edges
+from . import metrics
 from . import scraper
+from . import pipeline
 
 
 def reload():
@@ -36,5 +63,18 @@ def reload():
     importlib.reload(db)
     importlib.reload(graphql)
     importlib.reload(util)
+    importlib.reload(cache)
+    importlib.reload(costmodel)
+    importlib.reload(tokens)
+    importlib.reload(transport)
+    importlib.reload(frontier)
+    importlib.reload(ingest)
+    importlib.reload(aggregates)
+    importlib.reload(migrations)
+    importlib.reload(workqueue)
+    importlib.reload(archive)
+    importlib.reload(edges)
+    importlib.reload(metrics)
     importlib.reload(scraper)
+    importlib.reload(pipeline)
     del importlib
@@ -1,3 +1,15 @@
+import sys
+
 from .scraper import MainScraper
+from .pipeline import Pipeline
+from . import config as g
+from . import setup_logging
+
+setup_logging()
 
-MainScraper().start()
+if sys.argv[1:] == ['refresh']:
+    MainScraper().refresh()
+elif getattr(g, 'scraper_pipeline', False):
+    Pipeline(MainScraper()).run()
+else:
+    MainScraper().start()
@@ -0,0 +1,147 @@
+'''Summary tables behind the db analytics helpers: total repos, owners, and rows per pipeline state in `stats`, and
+repo count and bytes per language in `language_stats`.
+
+Every write path of the scraper adds its deltas with add() and add_languages() in the same transaction as the rows
+they count, so a rollback undoes both. Anything written behind the scraper's back makes them drift, which check()
+reports and rebuild() fixes.
+
+    python -m github_repos.aggregates check
+    python -m github_repos.aggregates rebuild
+'''
+
+import sys
+import logging as _logging
+
+from sqlalchemy import func, update, bindparam, true
+
+from github_repos.db import Session
+from github_repos.db import Repo, Owner, STATE_NEW, STATE_TODO, STATE_ERROR, STATE_MISSING
+from github_repos.db import RepoLanguages, Stat, LanguageStat
+from github_repos.db import insert_ignoring_conflicts
+from github_repos import setup_logging
+
+
+log = _logging.getLogger(__name__)
+
+# Total -> (model, criterion) of the rows it counts. repos are the crawled ones, fetched and not given up on
+STATS = {
+    'repos': (Repo, Repo.state.notin_((STATE_NEW, STATE_MISSING, STATE_ERROR))),
+    'owners': (Owner, true()),
+    'new_repos': (Repo, Repo.state == STATE_NEW),
+    'repos_todo': (Repo, Repo.state == STATE_TODO),
+    'repo_errors': (Repo, Repo.state == STATE_ERROR),
+    'repos_missing': (Repo, Repo.state == STATE_MISSING),
+}
+
+
+def add(session, **deltas):
+    '''Adds each stat=delta to its running total. Rows are updated in name order, and language rows in id order, so
+    concurrent writers lock them in the same order and can't deadlock on each other'''
+
+    deltas = [{'stat': name, 'delta': delta} for name, delta in sorted(deltas.items()) if delta]
+    if deltas:
+        table = Stat.__table__
+        session.execute(update(table)
+                        .where(table.c.name == bindparam('stat'))
+                        .values(value=table.c.value + bindparam('delta')),
+                        deltas)
+
+def add_languages(session, rows, sign=1):
+    '''Adds (or with sign=-1 takes away) the repo_languages `rows`, dicts with lang_id and bytes_used, to the
+    per language totals'''
+
+    deltas = {}
+    for row in rows:
+        repos, bytes_used = deltas.get(row['lang_id'], (0, 0))
+        deltas[row['lang_id']] = repos + sign, bytes_used + sign * (row['bytes_used'] or 0)
+    if not deltas:
+        return
+    lang_ids = sorted(deltas)
+
+    session.execute(insert_ignoring_conflicts(session, LanguageStat.__table__)
+                    .values([{'lang_id': lang_id, 'repos': 0, 'bytes_used': 0} for lang_id in lang_ids]))
+
+    table = LanguageStat.__table__
+    session.execute(update(table)
+                    .where(table.c.lang_id == bindparam('lang'))
+                    .values(repos=table.c.repos + bindparam('repo_delta'),
+                            bytes_used=table.c.bytes_used + bindparam('bytes_delta')),
+                    [{'lang': lang_id, 'repo_delta': deltas[lang_id][0], 'bytes_delta': deltas[lang_id][1]}
+                     for lang_id in lang_ids])
+
+
+def compute(session):
+    '''Exact totals from full table scans: ({stat: value}, {lang_id: (repos, bytes)})'''
+
+    stats = {name: session.query(func.count()).select_from(model).filter(criterion).scalar()
+             for name, (model, criterion) in STATS.items()}
+    languages = {lang_id: (repos, int(bytes_used or 0)) for lang_id, repos, bytes_used in
+                 session.query(RepoLanguages.lang_id, func.count(), func.sum(RepoLanguages.bytes_used))
+                        .group_by(RepoLanguages.lang_id)}
+    return stats, languages
+
+def stored(session):
+    '''The running totals as stored, in the same shape as compute()'''
+
+    stats = dict(session.query(Stat.name, Stat.value))
+    languages = {lang_id: (repos, bytes_used) for lang_id, repos, bytes_used in
+                 session.query(LanguageStat.lang_id, LanguageStat.repos, LanguageStat.bytes_used)}
+    return stats, languages
+
+def check(session):
+    '''Compares the running totals with a full recount. Returns {name: (stored, actual)} for every total that
+    drifted, languages keyed by ('language', lang_id)'''
+
+    actual_stats, actual_languages = compute(session)
+    stored_stats, stored_languages = stored(session)
+
+    drift = {name: (stored_stats.get(name), value) for name, value in actual_stats.items()
+             if stored_stats.get(name) != value}
+    for lang_id in set(actual_languages) | set(stored_languages):
+        actual = actual_languages.get(lang_id, (0, 0))
+        if stored_languages.get(lang_id, (0, 0)) != actual:
+            drift[('language', lang_id)] = (stored_languages.get(lang_id), actual)
+
+    for name, (stored_value, actual) in drift.items():
+        log.warning('%s is %s, should be %s', name, stored_value, actual)
+    return drift
+
+def rebuild(session):
+    '''Recounts every total from scratch and commits'''
+
+    stats, languages = compute(session)
+
+    session.query(Stat).delete(synchronize_session=False)
+    session.query(LanguageStat).delete(synchronize_session=False)
+    session.bulk_insert_mappings(Stat, [{'name': name, 'value': value} for name, value in stats.items()])
+    session.bulk_insert_mappings(LanguageStat, [{'lang_id': lang_id, 'repos': repos, 'bytes_used': bytes_used}
+                                                for lang_id, (repos, bytes_used) in languages.items()])
+    session.commit()
+
+    log.info('Rebuilt summary tables: %s, %d languages',
+             ', '.join('{} {}'.format(value, name) for name, value in stats.items()), len(languages))
+
+def ensure(session):
+    '''Builds the summary tables if they have never been built'''
+
+    if session.query(Stat).count() < len(STATS):
+        rebuild(session)
+
+
+def main(argv):
+    if argv not in (['check'], ['rebuild']):
+        print(__doc__)
+        return 1
+
+    session = Session()
+    if argv[0] == 'rebuild':
+        rebuild(session)
+        return 0
+
+    drift = check(session)
+    print('{} totals drifted'.format(len(drift)) if drift else 'Summary tables are consistent')
+    return 1 if drift else 0
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
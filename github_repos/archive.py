@@ -0,0 +1,221 @@
+import io
+import os
+import zlib
+import gzip
+import json
+import time
+import glob
+import heapq
+import shutil
+import hashlib
+import tempfile
+import threading
+import collections
+import logging as _logging
+
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+ArchiveRecord = collections.namedtuple('ArchiveRecord', 'time query_hash variables response_hash status')
+
+
+class Archive():
+    '''Content-addressed, append-only store of every raw query and response.
+
+    Blobs (query texts and response bodies) are keyed by their sha256 and stored once, each as its own gzip member
+    appended to a segment file, so a segment is itself a valid gzip file and any blob can be read with one seek.
+    Each segment has a JSON lines index next to it, recording where its blobs are and one line per response with
+    its time, query hash, variables and status. Every process writes its own segments, so several scrapers can
+    share an archive directory.'''
+
+    def __init__(self, directory=None, segment_bytes=None, level=None):
+        self.directory = directory or getattr(g, 'archive_dir', None) or \
+                         os.path.join(os.path.dirname(__file__), 'archive')
+        self.segment_bytes = segment_bytes or getattr(g, 'archive_segment_bytes', 256 * 1024**2)
+        self.level = level or getattr(g, 'archive_compression', 6)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.blobs = {}
+        self.readers = {}
+        self.segment = None
+        self.segment_name = None
+        self.index = None
+        self.segment_count = 0
+
+        for name in self.segment_names():
+            for entry in self.read_index(name):
+                if 'blob' in entry:
+                    self.blobs[entry['blob']] = (name, entry['offset'], entry['length'])
+
+    def segment_names(self):
+        return sorted(os.path.basename(path)[:-len('.idx')]
+                      for path in glob.glob(os.path.join(self.directory, '*.idx')))
+
+    def read_index(self, name):
+        with open(os.path.join(self.directory, name + '.idx'), encoding='utf8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    log.warning('Skipping broken line in archive index %s', name)
+
+    def open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+
+        self.segment_count += 1
+        self.segment_name = '{}-{}-{:04d}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid(), self.segment_count)
+        self.segment = open(os.path.join(self.directory, self.segment_name + '.gz'), 'ab')
+        self.index = open(os.path.join(self.directory, self.segment_name + '.idx'), 'a', encoding='utf8')
+        log.info('Archiving responses to %s', self.segment_name)
+
+    def write_index(self, entry):
+        self.index.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.index.flush()
+
+    def store(self, data):
+        '''Stores `data` (bytes) unless a blob with the same hash is already archived. Returns its hash'''
+
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self.blobs:
+            self.append_blob(digest, io.BytesIO(gzip.compress(data, self.level)))
+        return digest
+
+    def append_blob(self, digest, compressed):
+        '''Appends the gzip member read from the file object `compressed` to the segment as the blob `digest`'''
+
+        if self.segment is None or self.segment.tell() >= self.segment_bytes:
+            self.open_segment()
+
+        offset = self.segment.tell()
+        shutil.copyfileobj(compressed, self.segment)
+        self.segment.flush()
+        length = self.segment.tell() - offset
+
+        self.write_index({'blob': digest, 'offset': offset, 'length': length})
+        self.blobs[digest] = (self.segment_name, offset, length)
+
+    def record(self, query, variables, response_hash, status):
+        record = ArchiveRecord(time.time(), self.store(query.encode('utf8')), variables or {}, response_hash, status)
+        self.write_index(record._asdict())
+        return record
+
+    def put(self, query, variables, body, status=200):
+        '''Archives the response `body` (bytes) github gave to `query` with `variables`. Returns its ArchiveRecord'''
+
+        with self.lock:
+            return self.record(query, variables, self.store(body), status)
+
+    def writer(self, query, variables, status=200):
+        '''A ResponseWriter archiving the response github gave to `query` with `variables` as its body is written to
+        it, for bodies read as they download'''
+
+        return ResponseWriter(self, query, variables, status)
+
+    def put_written(self, query, variables, digest, compressed, status):
+        '''Archives the response whose body hashes to `digest` and was compressed into the file object `compressed`
+        by a ResponseWriter. Returns its ArchiveRecord'''
+
+        with self.lock:
+            if digest not in self.blobs:
+                compressed.seek(0)
+                self.append_blob(digest, compressed)
+            return self.record(query, variables, digest, status)
+
+    def get(self, digest):
+        '''The bytes of the blob with hash `digest`'''
+
+        with self.lock:
+            name, offset, length = self.blobs[digest]
+            if name not in self.readers:
+                if name == self.segment_name:
+                    self.segment.flush()
+                self.readers[name] = open(os.path.join(self.directory, name + '.gz'), 'rb')
+
+            reader = self.readers[name]
+            reader.seek(offset)
+            return gzip.decompress(reader.read(length))
+
+    def records(self, since=None, until=None, query_hash=None):
+        '''Yields the ArchiveRecords of every segment in time order, optionally only those in [since, until) or
+        for one query'''
+
+        def segment_records(name):
+            for entry in self.read_index(name):
+                if 'time' not in entry:
+                    continue
+                record = ArchiveRecord(**entry)
+                if since is not None and record.time < since:
+                    continue
+                if until is not None and record.time >= until:
+                    continue
+                if query_hash is not None and record.query_hash != query_hash:
+                    continue
+                yield record
+
+        with self.lock:
+            if self.index is not None:
+                self.index.flush()
+            names = self.segment_names()
+
+        return heapq.merge(*(segment_records(name) for name in names), key=lambda record: record.time)
+
+    def close(self):
+        with self.lock:
+            for f in list(self.readers.values()) + [self.segment, self.index]:
+                if f is not None:
+                    f.close()
+            self.readers.clear()
+            self.segment = self.index = self.segment_name = None
+
+
+class ResponseWriter():
+    '''Archives a response body written to it a piece at a time. The pieces are hashed and compressed as they come,
+    into a temporary file in the archive directory, so the body is never held in memory. close() appends the file
+    to the archive as one blob, unless the same body is archived already; abort() drops it'''
+
+    def __init__(self, archive, query, variables, status):
+        self.archive = archive
+        self.query = query
+        self.variables = variables
+        self.status = status
+        self.hash = hashlib.sha256()
+        # A gzip member, like Archive.store writes
+        self.compressor = zlib.compressobj(archive.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.file = tempfile.TemporaryFile(dir=archive.directory, prefix='writing-')
+
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        '''Archives the response with the body written so far. Returns its ArchiveRecord'''
+
+        try:
+            self.file.write(self.compressor.flush())
+            return self.archive.put_written(self.query, self.variables, self.hash.hexdigest(), self.file, self.status)
+        finally:
+            self.file.close()
+
+    def abort(self):
+        self.file.close()
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+def get_archive():
+    '''The process-wide Archive send_query writes to, or None unless archive_responses is set'''
+    global _archive
+    if not getattr(g, 'archive_responses', False):
+        return None
+    with _archive_lock:
+        if _archive is None:
+            _archive = Archive()
+        return _archive
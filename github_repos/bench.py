@@ -0,0 +1,197 @@
+'''Benchmarks for the scraper.
+
+    python -m github_repos.bench ingest [repos] [rounds]
+    python -m github_repos.bench scrape [repos] [rounds]
+    python -m github_repos.bench pipeline [repos] [rounds]
+
+ingest works inside a transaction that is rolled back, so it can be pointed at a real crawl database. scrape crawls
+a local fake github of about `repos` repos with MainScraper, and creates and drops its tables in the disposable
+database at bench_db_url, which has to be set and must not be the crawl database. pipeline does the same with the
+pipelined loop.
+'''
+
+import os
+import sys
+import time
+import random
+import functools
+import resource
+import logging as _logging
+
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+
+from github_repos.db import Session, Base, get_engine
+from github_repos.db import Repo, Owner, OwnerType, STATE_NEW
+from github_repos.ingest import orm_ingest_fetched_repos, bulk_ingest_fetched_repos
+from github_repos.fakeserver import FakeGithub, FakeGraph, LANGUAGES
+from github_repos.cache import IdentityCache
+from github_repos.tokens import TokenPool
+from github_repos.scraper import MainScraper
+from github_repos.pipeline import Pipeline
+from github_repos import setup_logging
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+
+def fake_fetch_node(login, name, rand=random):
+    '''A repository node shaped like the repoInfo fragment of build_fetch_query'''
+
+    return {'name': name,
+            'owner': {'login': login},
+            'description': 'benchmark repo %s/%s' % (login, name),
+            'diskUsage': rand.randrange(100000),
+            'url': 'https://github.com/%s/%s' % (login, name),
+            'isFork': rand.random() < 0.2,
+            'isMirror': False,
+            'stargazers': {'totalCount': rand.randrange(1000)},
+            'languages': {'edges': [{'size': rand.randrange(1000000), 'node': {'name': lang, 'color': color}}
+                                    for lang, color in rand.sample(LANGUAGES, rand.randrange(len(LANGUAGES)))]}}
+
+def make_new_repos(session, n, owners=50, rand=random):
+    '''Adds `n` new repos spread over `owners` fresh owners and returns them with their fake fetch nodes'''
+
+    type_id = session.query(OwnerType.id).order_by(OwnerType.id).limit(1).scalar()
+    tag = '%x' % rand.getrandbits(32)
+    owner_objs = [Owner(login='bench-%s-%d' % (tag, i), type_id=type_id) for i in range(owners)]
+    session.add_all(owner_objs)
+
+    todos = [Repo(owner=owner_objs[i % owners], name='repo%d' % i, state=STATE_NEW) for i in range(n)]
+    session.add_all(todos)
+    session.flush()
+
+    return todos, [fake_fetch_node(todo.owner.login, todo.name, rand) for todo in todos]
+
+def bench_ingest(n=500, rounds=5, seed=0):
+    '''Times writing one n-repo fetch query result with the ORM and bulk ingestion paths.
+    Returns {path: [seconds per round]}'''
+
+    rand = random.Random(seed)
+    timings = {}
+    for path, ingest in (('orm', orm_ingest_fetched_repos), ('bulk', bulk_ingest_fetched_repos)):
+        timings[path] = []
+        for _ in range(rounds):
+            session = Session()
+            try:
+                todos, nodes = make_new_repos(session, n, rand=rand)
+
+                start = time.perf_counter()
+                ingest(session, todos, nodes)
+                session.flush()
+                timings[path].append(time.perf_counter() - start)
+            finally:
+                session.rollback()
+                session.close()
+
+    return timings
+
+DEFAULT_PORTS = {'postgresql': 5432, 'mysql': 3306}
+
+def database_of(url):
+    '''What identifies the database `url` points at: its backend, host, port and database, with defaults filled in
+    and sqlite paths made absolute'''
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        return backend, os.path.realpath(url.database) if url.database not in (None, '', ':memory:') else url.database
+    return backend, (url.host or 'localhost').lower(), url.port or DEFAULT_PORTS.get(backend), url.database
+
+def bench_db_url():
+    '''bench_db_url, checked to be set and not to be the crawl database, since the scrape benchmark drops its
+    tables'''
+
+    url = getattr(g, 'bench_db_url', None)
+    if not url:
+        raise ValueError('bench_db_url is not set. The scrape benchmark drops all tables in it, so it needs a '
+                         'database of its own')
+    if database_of(url) == database_of(g.db_url):
+        raise ValueError('bench_db_url is the crawl database at db_url. The scrape benchmark drops all tables in '
+                         'it, so it needs a database of its own')
+    return url
+
+def bench_scrape(n=2000, rounds=1, seed=0, latency=0.0, error_rate=0.0, timeout_rate=0.0, pipeline=False):
+    '''Crawls a fake github of about `n` repos from its popular repos until nothing is left to expand or fetch,
+    `rounds` times on an empty database. Returns {measure: [value per round]}'''
+
+    engine = get_engine(bench_db_url())
+    results = {}
+    for _ in range(rounds):
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+
+        session = sessionmaker(engine)()
+        session.add_all([OwnerType('User'), OwnerType('Organization')])
+        session.commit()
+
+        fake = FakeGithub(FakeGraph(n, seed=seed), latency=latency, error_rate=error_rate,
+                          timeout_rate=timeout_rate, rate_limit=10**9)
+        with fake:
+            start = time.perf_counter()
+            scraper = MainScraper(tokens=TokenPool(['bench']), api_url=fake.url, session=session,
+                                  cache=IdentityCache())
+            scraper.populate_most_popular()
+            if pipeline:
+                Pipeline(scraper).run()
+            else:
+                scraper.start()
+            elapsed = time.perf_counter() - start
+
+        rows = sum(session.query(table).count() for table in Base.metadata.sorted_tables)
+        measures = {'seconds': elapsed,
+                    'repos/s': session.query(Repo).filter(Repo.state != STATE_NEW).count() / elapsed,
+                    'queries/s': sum(fake.queries.values()) / elapsed,
+                    'rows/s': rows / elapsed,
+                    'peak MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        for measure, value in measures.items():
+            results.setdefault(measure, []).append(value)
+
+        scraper.cache.detach(session)
+        session.close()
+
+    Base.metadata.drop_all(engine)
+    return results
+
+def report(name, timings, n):
+    print(name)
+    for path, times in timings.items():
+        best = min(times)
+        print('  %-6s best %8.2f ms  mean %8.2f ms  %10.0f repos/s' % (
+            path, best * 1000, sum(times) / len(times) * 1000, n / best))
+
+def report_measures(name, results, n):
+    print(name)
+    for measure, values in results.items():
+        print('  %-10s %s' % (measure, '  '.join('%10.1f' % value for value in values)))
+
+
+def main(argv):
+    if not argv or argv[0] not in BENCHMARKS:
+        print(__doc__)
+        return 1
+
+    bench, report_fn, default_n, default_rounds = BENCHMARKS[argv[0]]
+    n = int(argv[1]) if len(argv) > 1 else default_n
+    rounds = int(argv[2]) if len(argv) > 2 else default_rounds
+    if argv[0] in CRAWL_BENCHMARKS:
+        try:
+            bench_db_url()
+        except ValueError as e:
+            log.error(e)
+            return 1
+    report_fn(argv[0], bench(n, rounds), n)
+    return 0
+
+BENCHMARKS = {
+    'ingest': (bench_ingest, report, 500, 5),
+    'scrape': (bench_scrape, report_measures, 2000, 1),
+    'pipeline': (functools.partial(bench_scrape, pipeline=True), report_measures, 2000, 1),
+}
+# Benchmarks that drop all tables in bench_db_url
+CRAWL_BENCHMARKS = ('scrape', 'pipeline')
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
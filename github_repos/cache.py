@@ -0,0 +1,291 @@
+import math
+import hashlib
+import collections
+import logging as _logging
+
+from sqlalchemy import event, func
+
+from github_repos.db import Repo, Owner, OwnerType, RepoRedirect, STATE_NEW, STATE_MISSING
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+REPO_FETCHED = 'fetched'
+REPO_FOUND = 'found'
+REPO_MISSING = 'missing'
+
+
+def repo_state(state):
+    '''REPO_FOUND, REPO_MISSING or REPO_FETCHED for a Repo.state'''
+    if state == STATE_NEW:
+        return REPO_FOUND
+    elif state == STATE_MISSING:
+        return REPO_MISSING
+    return REPO_FETCHED
+
+
+class LRU():
+    '''Dict with a maximum size that evicts the least recently used key'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            self.items.move_to_end(key)
+            return self.items[key]
+        except KeyError:
+            return default
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+
+class BloomFilter():
+    '''Set membership test that can return false positives but never false negatives'''
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.bit_count = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / self.capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(repr(key).encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class IdentityCache():
+    '''Process-level cache of owner login -> owner id, (owner id, repo name) -> repo state and typename -> type id,
+    and of every repo redirect, (lowercase owner login, name) -> (owner id, repo name) of the repo it points to.
+
+    Changes made through an attached session are staged when flushed, and only become visible to other sessions
+    once committed. So are rows looked up in the database, which may only have been autoflushed. A rollback drops
+    them. With use_bloom, every repo key ever committed is also added to a bloom filter, so a repo missing from it
+    is definitely new and needs no query. Rows inserted by other processes are not seen, so it is off unless this
+    process is known to be the only writer (see identity_cache_bloom).'''
+
+    def __init__(self, maxsize=None, bloom_capacity=None, use_bloom=None):
+        self.maxsize = maxsize or getattr(g, 'identity_cache_size', 100000)
+        self.bloom_capacity = bloom_capacity or getattr(g, 'identity_cache_bloom_capacity', 1000000)
+        self.use_bloom = use_bloom if use_bloom is not None else getattr(g, 'identity_cache_bloom', False)
+
+        self.owners = LRU(self.maxsize)
+        self.repos = LRU(self.maxsize)
+        self.types = {}
+        self.bloom = None
+        # Loaded on first use. Renames are rare enough to keep all of them
+        self.redirects = None
+
+        self.pending_owners = {}
+        self.pending_repos = {}
+        self.pending_redirects = {}
+        self.savepoints = {}
+
+    def warm(self, session):
+        '''Loads owner types and the most recent owners and repos the cache has room for from the database. With
+        use_bloom, every known repo key also goes into the bloom filter'''
+
+        self.types = dict(session.query(OwnerType.typename, OwnerType.id).all())
+
+        owners = session.query(Owner.id, Owner.login).order_by(Owner.id.desc()).limit(self.maxsize).all()
+        for owner_id, login in reversed(owners):
+            self.owners.set(login, owner_id)
+
+        if self.use_bloom:
+            self.bloom = BloomFilter(max(self.bloom_capacity, session.query(Repo).count() * 2))
+            for key in session.query(Repo.owner_id, Repo.name).yield_per(10000):
+                self.bloom.add(tuple(key))
+
+        repos = session.query(Repo.owner_id, Repo.name, Repo.state).order_by(Repo.id.desc()).limit(self.maxsize).all()
+        for owner_id, name, state in reversed(repos):
+            self.repos.set((owner_id, name), repo_state(state))
+
+        log.info('Warmed identity cache with %d owners and %d repos', len(self.owners), len(self.repos))
+
+    def attach(self, session):
+        for name, fn in self._listeners():
+            event.listen(session, name, fn)
+
+    def detach(self, session):
+        for name, fn in self._listeners():
+            event.remove(session, name, fn)
+
+    def _listeners(self):
+        return (('after_flush', self._after_flush),
+                ('after_commit', self._after_commit),
+                ('after_transaction_create', self._after_transaction_create),
+                ('after_soft_rollback', self._after_soft_rollback))
+
+    def _after_transaction_create(self, session, transaction):
+        # Remember what was staged before a savepoint so rolling it back doesn't drop the outer transaction's changes
+        if transaction.nested:
+            self.savepoints[transaction] = (dict(self.pending_owners), dict(self.pending_repos),
+                                            dict(self.pending_redirects))
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        if previous_transaction in self.savepoints:
+            owners, repos, redirects = self.savepoints.pop(previous_transaction)
+            self.pending_owners = owners
+            self.pending_repos = repos
+            self.pending_redirects = redirects
+        elif not previous_transaction.nested:
+            self.pending_owners.clear()
+            self.pending_repos.clear()
+            self.pending_redirects.clear()
+            self.savepoints.clear()
+
+    def _after_flush(self, session, flush_context):
+        for obj in session.deleted:
+            if isinstance(obj, Repo):
+                self.pending_repos[(obj.owner_id, obj.name)] = None
+            elif isinstance(obj, Owner):
+                self.pending_owners[obj.login] = None
+
+        for obj in session.new:
+            if isinstance(obj, Owner):
+                self.pending_owners[obj.login] = obj.id
+            elif isinstance(obj, Repo):
+                self.pending_repos[(obj.owner_id, obj.name)] = repo_state(obj.state)
+
+        # Fetched repos change state in place
+        for obj in session.dirty:
+            if isinstance(obj, Repo):
+                self.pending_repos[(obj.owner_id, obj.name)] = repo_state(obj.state)
+
+    def _after_commit(self, session):
+        for login, owner_id in self.pending_owners.items():
+            if owner_id is None:
+                self.owners.discard(login)
+            else:
+                self.owners.set(login, owner_id)
+
+        for key, state in self.pending_repos.items():
+            if state is None:
+                self.repos.discard(key)
+            else:
+                self.repos.set(key, state)
+                if self.bloom is not None:
+                    self.bloom.add(key)
+
+        if self.redirects is not None:
+            self.redirects.update(self.pending_redirects)
+
+        self.pending_owners.clear()
+        self.pending_repos.clear()
+        self.pending_redirects.clear()
+        self.savepoints.clear()
+
+    def note_owners(self, owner_ids):
+        '''Stages the login -> id `owner_ids` of owners written without the ORM'''
+
+        self.pending_owners.update(owner_ids)
+
+    def note_repos(self, keys, state):
+        '''Stages (owner id, name) keys written without the ORM, e.g. by bulk inserts'''
+
+        for key in keys:
+            self.pending_repos[key] = state
+
+    def note_redirect(self, login, name, target):
+        '''Stages a redirect from `login`/`name` to the (owner id, name) `target`'''
+
+        self.pending_redirects[(login.lower(), name.lower())] = target
+
+    def redirect(self, session, login, name):
+        '''Returns the (owner id, name) of the repo `login`/`name` redirects to, or None'''
+
+        key = (login.lower(), name.lower())
+        if key in self.pending_redirects:
+            return self.pending_redirects[key]
+
+        if self.redirects is None:
+            self.redirects = {(owner_login.lower(), old_name.lower()): (owner_id, repo_name)
+                              for owner_login, old_name, owner_id, repo_name in
+                              session.query(RepoRedirect.owner_login, RepoRedirect.name, Repo.owner_id, Repo.name)
+                                     .join(Repo, RepoRedirect.repo_id == Repo.id)}
+        return self.redirects.get(key)
+
+    def type_id(self, session, typename):
+        if typename not in self.types:
+            self.types[typename] = session.query(OwnerType.id).filter_by(typename=typename).scalar()
+        return self.types[typename]
+
+    def owner_id(self, session, login):
+        '''Returns the id of the owner with `login`, or None if there is no such owner'''
+
+        if login in self.pending_owners:
+            return self.pending_owners[login]
+
+        owner_id = self.owners.get(login)
+        if owner_id is None:
+            owner_id = session.query(Owner.id).filter_by(login=login).scalar()
+            if owner_id is not None:
+                # The row may only have been autoflushed, so it is cached once the transaction commits
+                self.pending_owners[login] = owner_id
+        return owner_id
+
+    def repo_state(self, session, owner_id, name):
+        '''Returns REPO_FETCHED, REPO_FOUND or None if the repo is unknown'''
+
+        key = (owner_id, name)
+        if key in self.pending_repos:
+            return self.pending_repos[key]
+
+        if self.bloom is not None and key not in self.bloom:
+            return None
+
+        state = self.repos.get(key)
+        if state is None:
+            # A probe of ux_repositories_owner_lower_name
+            row = session.query(Repo.state) \
+                         .filter(Repo.owner_id == owner_id) \
+                         .filter(func.lower(Repo.name) == name.lower()) \
+                         .first()
+            if row is not None:
+                state = repo_state(row.state)
+                self.pending_repos[key] = state
+        return state
+
+    def clear(self):
+        self.owners.clear()
+        self.repos.clear()
+        self.types.clear()
+        self.bloom = None
+        self.redirects = None
+        self.pending_owners.clear()
+        self.pending_repos.clear()
+        self.pending_redirects.clear()
+        self.savepoints.clear()
+
+
+identity_cache = IdentityCache()
@@ -2,15 +2,139 @@ debug = True
 
 api_url = 'https://api.github.com/graphql'
 personal_token = 'dontshowthisdamnthingtoanyoneyouhearmeok'
+# Every query goes to whichever of these has the most rate limit left. Defaults to [personal_token]
+# personal_tokens = ['token1', 'token2']
+# Spread each token's rate limit evenly over its window instead of spending it all and sleeping until the reset,
+# doing database upkeep in the gaps. Up to rate_limit_burst points can be spent at once after a pause
+rate_limit_pacing = True
+rate_limit_burst = 200
 
+# postgresql, or sqlite for a single-node crawl, e.g. 'sqlite:////var/lib/github_repos/github.db'
 db_url = 'postgresql://me@localhost:5432/github'
+# Create missing tables and columns the first time the database is used
+db_create_schema = True
+# Extra PRAGMAs for sqlite connections, on top of WAL mode, synchronous=normal and a 30s busy timeout
+# sqlite_pragmas = {'cache_size': -262144}
+# Where run.log (and by default the profiler control file) go. Defaults to github_repos/logs
+# log_dir = '/var/log/github_repos'
 
+# Connections the expand query follows. Turning one off drops its sub-tree from the query, and its cost with it.
+# Issue and pull request participants are off unless turned on, since they multiply by every issue's participants
 # scraper_expand_repo_contributors = True
-scraper_expand_repo_issues_participants = True
-scraper_expand_repo_pullrequest_participants = True
+# Renamed from scraper_expand_repo_issues_participants and scraper_expand_repo_pullrequest_participants, which are
+# ignored (with a warning) so configs that set them to True don't start spending 4x on every expansion
+scraper_expand_issue_participants = False
+scraper_expand_pullrequest_participants = False
 scraper_expand_repo_stars = True
 scraper_expand_repo_watchers = True
 
 scraper_expand_user_contributions = True
 scraper_expand_user_issues = True
 scraper_expand_user_pullrequests = True
+# scraper_expand_user_stars = True
+# `first:` of each connection above, by its name in github_repos.scraper.EXPAND_CONNECTIONS (the flag's name without
+# scraper_expand_, except for repo_issues_participants and repo_pullrequest_participants), and 'participants' per
+# issue or pull request
+# scraper_expand_sizes = {'repo_stars': 10, 'user_issues': 10, 'participants': 5}
+
+# Number of expand queries kept in flight at once. 1 expands one repo at a time
+scraper_concurrency = 1
+# Todos pulled per concurrent expansion round, as a multiple of scraper_concurrency
+scraper_round_multiplier = 4
+# Finished expansions (or pipeline batches) to collect before writing their new repos back
+scraper_write_batch = 8
+# Run the scraper as a pipeline, sending queries from scraper_concurrency threads while a single writer persists
+# results, with up to scraper_pipeline_depth claimed batches (default twice scraper_concurrency) in flight
+scraper_pipeline = False
+# scraper_pipeline_depth = 8
+# When a fetch query fails, keep what came back and fetch the failed repos again in halves, down to single repos
+# that are given up on after a few tries, and send batches at most half the failed size for the next
+# scraper_fetch_safe_batch_seconds. Off, the whole batch is retried and counts towards the crawl's error limit
+scraper_fetch_bisect = True
+scraper_fetch_safe_batch_seconds = 3600
+# Parse fetch responses as they download (needs ijson) and write their repos scraper_stream_chunk at a time, instead
+# of holding the whole response in memory. The pipeline always decodes whole responses
+scraper_stream_fetches = False
+scraper_stream_chunk = 50
+# Todos expanded by a single aliased query. Capped by the query node limit and remaining rate limit
+scraper_expand_batch_size = 1
+# Weights of the expansion priority: log stars, log times a repo was seen again, and log new repos per expansion of
+# its owner, smoothed towards frontier_prior_yield as if the owner had frontier_prior_weight expansions already
+frontier_star_weight = 1.0
+frontier_sighting_weight = 1.0
+frontier_yield_weight = 1.0
+frontier_prior_yield = 5.0
+frontier_prior_weight = 2.0
+# Name this scraper process leases work under (default hostname:pid), and how long a lease lasts without renewal
+# scraper_worker_id = 'worker-1'
+scraper_lease_seconds = 600
+
+# Owners and repos kept in the in-process identity cache
+identity_cache_size = 100000
+# Minimum number of repo keys the cache's bloom filter is sized for
+identity_cache_bloom_capacity = 1000000
+# Skip database lookups for repos missing from the identity cache's bloom filter. Only safe with a single scraper
+# process, so only turn it on when no other worker shares the database
+identity_cache_bloom = False
+# Load the identity cache from the database when the scraper starts
+scraper_warm_cache = True
+# Write fetched repos with multi-row INSERTs instead of one ORM object at a time
+scraper_bulk_ingest = True
+
+# Standard deviations added to predicted query costs before choosing a batch size
+cost_model_margin = 2.0
+# Recorded query costs replayed into the cost model on startup
+cost_model_history = 2000
+
+# (connect, read) timeouts in seconds for each query
+http_timeout = (10, 120)
+# Retries, with exponential backoff, when github times out or serves an error page instead of JSON
+http_retries = 3
+http_backoff = 2.0
+# gzip request bodies as well as responses
+http_gzip_requests = False
+
+# Keep every raw query response in compressed, content-addressed segment files, so the database can be rebuilt
+# with `python -m github_repos.reingest` without re-crawling
+archive_responses = True
+# Defaults to github_repos/archive
+# archive_dir = '/var/lib/github_repos/archive'
+archive_segment_bytes = 256 * 1024**2
+
+# Log the user -> repo edges every expansion sees (contributed, starred, issues, pull requests, watches), for
+# `python -m github_repos.edges compact` to turn into a memory-mapped graph. Needs numpy to compact. Replaying the
+# archive with reingest logs the edges again
+edge_log = False
+# Defaults to github_repos/edges
+# edge_dir = '/var/lib/github_repos/edges'
+edge_segment_edges = 10000000
+
+# Disposable database `python -m github_repos.bench scrape` creates and drops its tables in. Required by the scrape
+# and pipeline benchmarks, which refuse to run against the crawl database at db_url
+bench_db_url = 'postgresql://me@localhost:5432/github_bench'
+# Let tests.py send a query to the real github API. Every other test runs against github_repos.fakeserver
+test_live_api = False
+
+# `python -m github_repos refresh` checks repos whose change markers are older than this many seconds, and
+# re-fetches the ones that changed
+refresh_max_age = 7 * 24 * 3600
+# Repos github can't resolve when they are fetched (deleted or private) are fetched again after this many seconds
+missing_repo_ttl = 30 * 24 * 3600
+
+# `python -m github_repos.export` writes Parquet files here, defaults to github_repos/export. Needs pyarrow
+# export_dir = '/var/lib/github_repos/export'
+export_chunk_rows = 50000
+export_rows_per_file = 5000000
+# Repos fetched less than this many seconds ago are left for the next export
+export_settle_seconds = 300
+
+# Serve the scraper's timers and counters at http://localhost:<metrics_port>/metrics, and/or rewrite metrics_file
+# with them every metrics_dump_seconds. See github_repos.metrics, also for profiling a running scraper
+# metrics_port = 9108
+# metrics_file = '/var/lib/github_repos/metrics.prom'
+metrics_dump_seconds = 60
+# Defaults to profile in log_dir
+# profile_control = '/tmp/github_repos.profile'
+
+# Rows github_repos.migrations moves per transaction
+migration_chunk_rows = 10000
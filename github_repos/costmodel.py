@@ -0,0 +1,147 @@
+import math
+import logging as _logging
+
+from github_repos.db import QueryCost
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+EXPAND = 'expand'
+FETCH = 'fetch'
+REFRESH = 'refresh'
+# (intercept, slope, typical batch size) of points per query, as guessed before any costs were recorded
+PRIORS = {
+    EXPAND: (0.0, 13.0, 10),
+    FETCH: (0.0, 1.5 / 467.0, 500),
+    # Change markers have no connections, so github charges the minimum whatever the batch size
+    REFRESH: (1.0, 0.0, 500),
+}
+
+
+class LinearCostModel():
+    '''cost ~ intercept + slope * batch_size, fitted by exponentially weighted least squares.
+
+    The fit is pulled towards the prior as if it were `prior_weight` observations at batch size `scale`, so a single
+    batch size seen over and over (the fetch step almost always asks for 500 repos) still gives a sensible slope. The
+    prior fades by `prior_decay` per observation, down to `min_prior_weight`.'''
+
+    def __init__(self, intercept, slope, scale=1, decay=0.98, prior_weight=1.0, prior_decay=0.8,
+                 min_prior_weight=0.001):
+        self.prior = (intercept, slope)
+        self.decay = decay
+        self.prior_decay = prior_decay
+        self.prior_weight = prior_weight
+        self.min_prior_weight = min_prior_weight
+        self.scale = scale
+        self.intercept = intercept
+        self.slope = slope
+
+        self.w = self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+
+    def update(self, batch_size, cost):
+        d = self.decay
+        x, y = float(batch_size), float(cost)
+        self.w = self.w * d + 1
+        self.sx = self.sx * d + x
+        self.sy = self.sy * d + y
+        self.sxx = self.sxx * d + x * x
+        self.sxy = self.sxy * d + x * y
+        self.syy = self.syy * d + y * y
+        self.prior_weight = max(self.min_prior_weight, self.prior_weight * self.prior_decay)
+        self._fit()
+
+    def _fit(self):
+        a0, b0 = self.prior
+        lam_a = self.prior_weight
+        lam_b = self.prior_weight * self.scale ** 2
+
+        m11, m12, m22 = self.w + lam_a, self.sx, self.sxx + lam_b
+        r1, r2 = self.sy + lam_a * a0, self.sxy + lam_b * b0
+        det = m11 * m22 - m12 * m12
+        if det <= 0:
+            return
+
+        self.intercept = (r1 * m22 - r2 * m12) / det
+        self.slope = (m11 * r2 - m12 * r1) / det
+
+    def std(self):
+        if self.w < 2:
+            return 0.0
+
+        a, b = self.intercept, self.slope
+        sse = (self.syy - 2 * a * self.sy - 2 * b * self.sxy
+               + a * a * self.w + 2 * a * b * self.sx + b * b * self.sxx)
+        return math.sqrt(max(0.0, sse) / self.w)
+
+    def predict(self, batch_size):
+        return self.intercept + self.slope * batch_size
+
+
+class CostModel():
+    '''Predicts rate limit points per query from QueryCost history, one LinearCostModel per query type.
+
+    Github charges whole points with a minimum of 1, so predictions are rounded up after adding `margin` standard
+    deviations of the fit's residual. Query types whose cost depends on what the query asks for, like the
+    connections expand queries follow, have a shape key in `shapes`: costs are recorded with it, and only the
+    costs recorded for the current shape are loaded.'''
+
+    def __init__(self, margin=None):
+        self.margin = margin if margin is not None else getattr(g, 'cost_model_margin', 2.0)
+        self.models = {query_type: LinearCostModel(*prior) for query_type, prior in PRIORS.items()}
+        self.shapes = {}
+
+    def set_prior(self, query_type, intercept, slope, scale=1, shape=None):
+        '''Starts `query_type` over from another prior, e.g. for a smaller expand query than PRIORS guessed for, and
+        fits it only to costs of queries of `shape`'''
+
+        self.models[query_type] = LinearCostModel(intercept, slope, scale)
+        self.shapes[query_type] = shape
+
+    def load(self, session, limit=None):
+        '''Replays the most recent `limit` recorded costs of each query type's current shape'''
+
+        limit = limit or getattr(g, 'cost_model_history', 2000)
+        rows = session.query(QueryCost.query_type, QueryCost.shape, QueryCost.batch_size, QueryCost.normalized_actual) \
+                      .filter(QueryCost.query_type.isnot(None)) \
+                      .filter(QueryCost.normalized_actual.isnot(None)) \
+                      .order_by(QueryCost.id.desc()) \
+                      .limit(limit) \
+                      .all()
+        # Costs of other shapes (or recorded before shapes were) say little about this one's
+        rows = [row for row in rows if row.shape == self.shapes.get(row.query_type)]
+
+        for query_type, _, batch_size, cost in reversed(rows):
+            self.update(query_type, batch_size, cost)
+
+        log.info('Loaded %d query costs', len(rows))
+        for query_type, model in self.models.items():
+            log.info('%s cost ~ %.3f + %.5f * n (std %.3f)', query_type, model.intercept, model.slope, model.std())
+
+    def update(self, query_type, batch_size, cost):
+        if query_type not in self.models:
+            self.models[query_type] = LinearCostModel(0.0, 1.0, max(1, batch_size or 1))
+        self.models[query_type].update(batch_size or 1, cost)
+
+    def predict(self, query_type, batch_size):
+        model = self.models[query_type]
+        cost = model.predict(batch_size) + self.margin * model.std()
+        return max(1, math.ceil(cost))
+
+    def best_batch_size(self, query_type, max_size, remaining, reserve=2, tolerance=0.95):
+        '''Returns the batch size up to `max_size` with the most items per predicted point whose cost still fits in
+        `remaining` - `reserve` points, or 0 if not even one item fits. Since costs are whole points, the largest
+        batch within `tolerance` of the best rate wins, saving round trips for the same spend'''
+
+        rates = []
+        for n in range(1, max_size + 1):
+            cost = self.predict(query_type, n)
+            if cost > remaining - reserve:
+                break
+            rates.append(n / cost)
+
+        if not rates:
+            return 0
+
+        best_rate = max(rates)
+        return max(n for n, rate in enumerate(rates, 1) if rate >= best_rate * tolerance)
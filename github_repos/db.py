@@ -1,23 +1,94 @@
-from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Integer, SmallInteger, BigInteger, String, Boolean
-from sqlalchemy import create_engine
+from sqlalchemy import Column, ForeignKey, Index
+from sqlalchemy import Integer, SmallInteger, BigInteger, String, Boolean, Float
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import func, desc, asc, exists
+from sqlalchemy import func, desc, asc
+from sqlalchemy import inspect, text, insert, select, tuple_
+from sqlalchemy.dialects import postgresql
 
 import github_repos.config as g
 
-def get_engine(url=g.db_url):
-    #return psycopg2.connect(dbname=DBNAME, host=HOST, port=PORT)
+# Journal and sync settings for sqlite databases. WAL lets readers (exports, stats) run alongside the writer, and
+# synchronous=normal only syncs at checkpoints, so committing each batch stays cheap
+SQLITE_PRAGMAS = {'journal_mode': 'wal', 'synchronous': 'normal', 'busy_timeout': 30000}
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # Let SQLAlchemy issue BEGIN itself, so SAVEPOINTs (begin_nested) work
+    dbapi_connection.isolation_level = None
+
+    cursor = dbapi_connection.cursor()
+    for pragma, value in dict(SQLITE_PRAGMAS, **getattr(g, 'sqlite_pragmas', {})).items():
+        cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+    cursor.close()
+
+def _sqlite_begin(conn):
+    conn.exec_driver_sql('BEGIN')
+
+def get_engine(url=None):
+    '''Creates an engine for `url` (default db_url). postgresql is the main backend; sqlite works for single-node
+    crawls, tests and benchmarks'''
+
+    url = url or g.db_url
+    if make_url(url).get_backend_name() == 'sqlite':
+        engine = create_engine(url)
+        event.listen(engine, 'connect', _sqlite_connect)
+        event.listen(engine, 'begin', _sqlite_begin)
+        return engine
+
     return create_engine(url, client_encoding='utf8')
 
-engine = get_engine()
-Session = sessionmaker(engine)
+_engine = None
+
+def default_engine():
+    '''The engine for db_url, created on first use along with any missing tables (unless db_create_schema is
+    off)'''
+    global _engine
+
+    if _engine is None:
+        _engine = get_engine()
+        if getattr(g, 'db_create_schema', True):
+            create_schema(_engine)
+    return _engine
+
+def use_engine(engine):
+    '''Makes `engine` the one Session() and default_engine() use, e.g. to point everything at a test database'''
+    global _engine
+
+    _engine = engine
+
+def __getattr__(name):
+    # db.engine used to be created on import
+    if name == 'engine':
+        return default_engine()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+class LazySessionmaker(sessionmaker):
+    '''sessionmaker that binds sessions to default_engine() when they are made, so nothing connects to the
+    database on import'''
+
+    def __call__(self, **local_kw):
+        if local_kw.get('bind') is None and self.kw.get('bind') is None:
+            local_kw['bind'] = default_engine()
+        return sessionmaker.__call__(self, **local_kw)
+
+Session = LazySessionmaker()
 
 Base = declarative_base()
 
+# Repo.state. A repo is found (new) by an expansion, fetched into the todo state, and expanded or given up on (error).
+# Repos github can't resolve when they are fetched are missing until missing_repo_ttl has passed
+STATE_NEW = 'new'
+STATE_TODO = 'todo'
+STATE_EXPANDED = 'expanded'
+STATE_ERROR = 'error'
+STATE_MISSING = 'missing'
+
 class Repo(Base):
+    '''Every repo seen, in one of the STATE_* states. Only fetched repos (not STATE_NEW) have their data columns
+    set'''
     __tablename__ = 'repositories'
 
     id = Column('id', Integer, primary_key=True)
@@ -29,14 +100,59 @@ class Repo(Base):
     url = Column('url', String)
     is_fork = Column('is_fork', Boolean)
     is_mirror = Column('is_mirror', Boolean)
+    # Change markers github last reported, and when they were last checked. See MainScraper.refresh_stale_repos
+    pushed_at = Column('pushed_at', String, nullable=True)
+    updated_at = Column('updated_at', String, nullable=True)
+    fetched_at = Column('fetched_at', Float, nullable=True)
+    stars = Column('stars', Integer, nullable=True)
+
+    state = Column('state', String, nullable=True)
+    # Lease held by the worker fetching (STATE_NEW) or expanding (STATE_TODO) this repo, see github_repos.workqueue
+    leased_by = Column('leased_by', String, nullable=True)
+    lease_expires = Column('lease_expires', Float, nullable=True)
+    attempts = Column('attempts', Integer, nullable=True)
+    errors = Column('errors', String, nullable=True)
+    # Times this repo turned up again in expansions before it was expanded
+    sightings = Column('sightings', Integer, nullable=True)
+    # Expansion order of STATE_TODO repos, highest first. See github_repos.frontier
+    priority = Column('priority', Float, nullable=True)
 
     owner = relationship('Owner', uselist=False)
     languages = relationship('RepoLanguages', back_populates='repo')
 
+    __table_args__ = (
+        # github names are case insensitive, so this is also the existence check
+        Index('ux_repositories_owner_lower_name', 'owner_id', func.lower(name), unique=True),
+        # Queue pops and refresh scans, each only over the rows in its states
+        Index('ix_repositories_new', 'id',
+              postgresql_where=state == STATE_NEW, sqlite_where=state == STATE_NEW),
+        # Read backwards for Frontier.order_by, priority DESC NULLS LAST, id. sqlite sorts NULLs first already, and
+        # has no NULLS FIRST in CREATE INDEX
+        Index('ix_repositories_todo_priority_id', 'priority', id.desc(), postgresql_ops={'priority': 'NULLS FIRST'},
+              postgresql_where=state == STATE_TODO, sqlite_where=state == STATE_TODO),
+        Index('ix_repositories_fetched_at_not_new', 'fetched_at',
+              postgresql_where=state != STATE_NEW, sqlite_where=state != STATE_NEW),
+    )
+
+class RepoRedirect(Base):
+    '''An old owner/name github resolved to another repo, after a rename or transfer. Repos found under an old name
+    count as sightings of the repo it points to instead of being fetched again'''
+    __tablename__ = 'repo_redirects'
+
+    id = Column('id', Integer, primary_key=True)
+    owner_login = Column('owner_login', String, nullable=False)
+    name = Column('name', String, nullable=False)
+    repo_id = Column('repo_id', Integer, ForeignKey('repositories.id'), index=True, nullable=False)
+
+    __table_args__ = (
+        Index('ux_repo_redirects_lower_key', func.lower(owner_login), func.lower(name), unique=True),
+    )
+
 class OwnerType(Base):
     __tablename__ = 'owner_types'
 
-    id = Column('id', SmallInteger, primary_key=True)
+    # sqlite only autoincrements INTEGER PRIMARY KEYs
+    id = Column('id', SmallInteger().with_variant(Integer, 'sqlite'), primary_key=True)
     typename = Column('type', String, unique=True)
 
     def __init__(self, typename):
@@ -48,34 +164,17 @@ class Owner(Base):
     id = Column('id', Integer, primary_key=True)
     login = Column('login', String, index=True, unique=True, nullable=False)
     type_id = Column('type_id', SmallInteger, ForeignKey('owner_types.id'))
+    # Repos expanded from this owner and the new repos they turned up, see github_repos.frontier
+    expansions = Column('expansions', Integer, nullable=True)
+    yielded = Column('yielded', Integer, nullable=True)
 
     owner_type = relationship('OwnerType', uselist=False)
     owner_typename = association_proxy('owner_type', 'typename')
 
-class NewRepo(Base):
-    __tablename__ = 'new_repos'
-
-    id = Column('id', Integer, primary_key=True)
-    owner_id = Column('owner_id', Integer, ForeignKey('owners.id'))
-    name = Column('name', String)
-
-    owner = relationship('Owner', uselist=False)
-
-class ReposTodo(Base):
-    __tablename__ = 'repos_todo'
-
-    id = Column('id', Integer, primary_key=True)
-    repo_id = Column('repo_id', Integer, ForeignKey('repositories.id'), unique=True)
-    repo = relationship('Repo', uselist=False)
-
-class RepoError(Base):
-    __tablename__ = 'repo_errors'
-
-    id = Column('id', Integer, primary_key=True)
-    repo_id = Column('repo_id', Integer, ForeignKey('repositories.id'), unique=True)
-    error_text = Column('error_text', String, nullable=True)
-
-    repo = relationship('Repo', uselist=False)
+    __table_args__ = (
+        # Logins are case insensitive, for lookups by a login spelled otherwise
+        Index('ix_owners_lower_login', func.lower(login)),
+    )
 
 class Language(Base):
     __tablename__ = 'languages'
@@ -92,11 +191,16 @@ class QueryCost(Base):
     id = Column('id', Integer, primary_key=True)
     guess = Column('guess', Integer)
     normalized_actual = Column('normalized_actual', Integer)
+    query_type = Column('query_type', String, nullable=True)
+    batch_size = Column('batch_size', Integer, nullable=True)
+    # Key of the connections an expand query followed, see scraper.shape_key. NULL for other queries
+    shape = Column('shape', String, nullable=True)
 
 class RepoLanguages(Base):
     __tablename__ = 'repo_languages'
 
-    id = Column('id', BigInteger, primary_key=True)
+    # sqlite only autoincrements INTEGER PRIMARY KEYs
+    id = Column('id', BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
     repo_id = Column('repo_id', Integer, ForeignKey('repositories.id'), index=True)
     lang_id = Column('lang_id', Integer, ForeignKey('languages.id'), index=True)
     bytes_used = Column('bytes_used', BigInteger)
@@ -104,23 +208,118 @@ class RepoLanguages(Base):
     repo = relationship('Repo', back_populates='languages')
     language = relationship('Language', back_populates='repos')
 
-Base.metadata.create_all(engine)
+class Stat(Base):
+    '''Running totals kept up to date by github_repos.aggregates'''
+    __tablename__ = 'stats'
 
+    name = Column('name', String, primary_key=True)
+    value = Column('value', BigInteger, nullable=False)
+
+class SchemaMigration(Base):
+    '''Migrations applied to this database, see github_repos.migrations'''
+    __tablename__ = 'schema_migrations'
+
+    version = Column('version', Integer, primary_key=True, autoincrement=False)
+    name = Column('name', String)
+    applied_at = Column('applied_at', Float)
+
+class LanguageStat(Base):
+    '''Per language repo count and bytes, kept up to date by github_repos.aggregates'''
+    __tablename__ = 'language_stats'
+
+    lang_id = Column('lang_id', Integer, ForeignKey('languages.id'), primary_key=True, autoincrement=False)
+    repos = Column('repos', BigInteger, nullable=False, index=True)
+    bytes_used = Column('bytes_used', BigInteger, nullable=False)
+
+    language = relationship('Language')
+
+def add_missing_columns(engine, table):
+    '''create_all never alters existing tables, so add any nullable columns `table` gained since it was created,
+    and their indexes'''
+    existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    added = set()
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name, column.type.compile(engine.dialect))))
+                added.add(column.name)
+
+        for index in table.indexes:
+            if added.intersection(column.name for column in index.columns):
+                index.create(conn)
+
+def insert_ignoring_conflicts(session, table):
+    '''INSERT that skips rows violating a unique constraint. Raises NotImplementedError on dialects other than
+    postgresql, sqlite and mysql'''
+
+    dialect = session.bind.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        return insert(table).prefix_with('OR IGNORE', dialect='sqlite')
+    elif dialect == 'mysql':
+        return insert(table).prefix_with('IGNORE', dialect='mysql')
+    raise NotImplementedError('No INSERT ignoring conflicts for ' + dialect)
+
+def insert_missing(session, table, rows, chunk=1000):
+    '''Inserts the `rows` that don't conflict with existing ones (or each other), `chunk` rows per statement.
+    Returns the number of rows actually inserted'''
+
+    inserted = 0
+    for i in range(0, len(rows), chunk):
+        inserted += session.execute(insert_ignoring_conflicts(session, table).values(rows[i:i + chunk])).rowcount
+    return inserted
+
+def insert_returning_ids(session, table, rows, *columns):
+    '''Inserts `rows` and returns (id, *columns) for each inserted row. One statement where RETURNING is supported.
+    Elsewhere (sqlite), if `columns` are a unique key, one executemany and a lookup of the ids by key'''
+
+    if not rows:
+        return []
+
+    if session.bind.dialect.implicit_returning:
+        stmt = insert(table).values(rows).returning(table.c.id, *(table.c[col] for col in columns))
+        return [tuple(row) for row in session.execute(stmt)]
+
+    if columns:
+        session.execute(insert(table), rows)
+        key_columns = [table.c[col] for col in columns]
+        return [tuple(row) for row in session.execute(
+            select(table.c.id, *key_columns).where(tuple_(*key_columns).in_(
+                [tuple(row[col] for col in columns) for row in rows])))]
+
+    returned = []
+    for row in rows:
+        result = session.execute(insert(table).values(row))
+        returned.append((result.inserted_primary_key[0],) + tuple(row[col] for col in columns))
+    return returned
+
+def create_schema(engine):
+    '''Creates missing tables, and adds the columns older versions of the existing ones lack'''
+
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine, Repo.__table__)
+    add_missing_columns(engine, Owner.__table__)
+    add_missing_columns(engine, QueryCost.__table__)
+
+
+def get_stat(session, name):
+    return session.query(Stat.value).filter_by(name=name).scalar() or 0
 
 def get_popular_languages(limit=None, headers=False, reverse=False):
     s = Session()
 
     order = asc if reverse else desc
 
-    repo_count = s.query(Repo).count()
-    table = s.query(Language.name, func.count(RepoLanguages.repo_id)) \
-             .join(RepoLanguages) \
-             .group_by(RepoLanguages.lang_id, Language.name) \
-             .order_by(order(func.count(RepoLanguages.repo_id))) \
+    repo_count = get_stat(s, 'repos')
+    table = s.query(Language.name, LanguageStat.repos) \
+             .join(LanguageStat, LanguageStat.lang_id == Language.id) \
+             .order_by(order(LanguageStat.repos)) \
              .limit(limit) \
              .all()
 
-    table = tuple(row + ('{:3f}%'.format(row[1] / repo_count * 100),) for row in table)
+    table = tuple(tuple(row) + ('{:3f}%'.format(row[1] / repo_count * 100),) for row in table)
 
     if headers:
         table = (('name', '"top 10 langs" count', '% share of repos'),) + table
@@ -129,10 +328,8 @@ def get_popular_languages(limit=None, headers=False, reverse=False):
 
 def get_average_repos_per_owner():
     s = Session()
-    return s.query(Repo).count() / s.query(Owner).count()
+    return get_stat(s, 'repos') / get_stat(s, 'owners')
 
 def get_expanded_repo_count():
-    return Session().query(Repo) \
-                    .filter(~exists().where(Repo.id == RepoError.repo_id)) \
-                    .filter(~exists().where(Repo.id == ReposTodo.repo_id)) \
-                    .count()
+    s = Session()
+    return get_stat(s, 'repos') - get_stat(s, 'repos_todo')
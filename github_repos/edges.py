@@ -0,0 +1,346 @@
+'''Graph of which users contributed to, starred, watch or filed issues and pull requests on which repos, as seen by
+expansions.
+
+    python -m github_repos.edges compact
+    python -m github_repos.edges stats
+    python -m github_repos.edges repos <login>
+    python -m github_repos.edges users <owner>/<name>
+
+With edge_log set, every expansion appends its (user, repo, relation) edges to a segment of the edge log in
+edge_dir. A segment is a file of little-endian uint32 (user, repo, relation) triples, with the logins and repo keys
+behind its ids in text files next to it, one per line, written before any edge that uses them. Every process
+writes its own segments, so several scrapers can share edge_dir, and ids are only meaningful within a segment.
+
+compact() merges the segments into a compressed sparse row adjacency in both directions, with global ids and
+duplicate edges removed, saved as .npy files that EdgeGraph memory-maps. It picks up where the last compaction
+stopped, so it can be run while scrapers keep appending. Needs numpy; capturing edges doesn't.
+'''
+
+import os
+import sys
+import json
+import glob
+import time
+import array
+import shutil
+import threading
+import logging as _logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from github_repos import setup_logging
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+# Edge relations
+CONTRIBUTED = 0
+STARRED = 1
+ISSUE = 2
+PULL_REQUEST = 3
+WATCHES = 4
+MENTIONABLE = 5
+RELATION_NAMES = ('contributed', 'starred', 'issue', 'pull_request', 'watches', 'mentionable')
+
+# User node connection -> relation of its repos, and expanded repo connection -> relation of its users (of the
+# participants, for issues and pull requests)
+USER_RELATIONS = {'contributedRepositories': CONTRIBUTED, 'starredRepositories': STARRED,
+                  'issues': ISSUE, 'pullRequests': PULL_REQUEST}
+REPO_RELATIONS = {'stargazers': STARRED, 'watchers': WATCHES, 'mentionableUsers': MENTIONABLE,
+                  'issues': ISSUE, 'pullRequests': PULL_REQUEST}
+
+
+def default_directory():
+    return getattr(g, 'edge_dir', None) or os.path.join(os.path.dirname(__file__), 'edges')
+
+
+class EdgeLog():
+    '''Appends edges to this process' segments of the edge log in `directory`, starting a new segment every
+    `segment_edges` edges'''
+
+    def __init__(self, directory=None, segment_edges=None):
+        self.directory = directory or default_directory()
+        self.segment_edges = segment_edges or getattr(g, 'edge_segment_edges', 10000000)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.segment_name = None
+        self.segment_count = 0
+        self.files = None
+        self.users = {}
+        self.repos = {}
+        self.edge_count = 0
+
+    def open_segment(self):
+        self.close_segment()
+
+        # Segments are never reopened, or their ids would clash
+        while True:
+            self.segment_count += 1
+            self.segment_name = '{}-{}-{:04d}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+                                                      self.segment_count)
+            path = os.path.join(self.directory, self.segment_name)
+            if not os.path.exists(path + '.edges'):
+                break
+        self.files = {'users': open(path + '.users', 'a', encoding='utf8'),
+                      'repos': open(path + '.repos', 'a', encoding='utf8'),
+                      'edges': open(path + '.edges', 'ab')}
+        self.users = {}
+        self.repos = {}
+        self.edge_count = 0
+        log.info('Logging edges to %s', self.segment_name)
+
+    def close_segment(self):
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+
+    def intern(self, ids, kind, name):
+        if name not in ids:
+            ids[name] = len(ids)
+            self.files[kind].write(name + '\n')
+        return ids[name]
+
+    def append(self, edges):
+        '''Logs (user login, (owner login, repo name), relation) edges'''
+
+        with self.lock:
+            if self.files is None or self.edge_count >= self.segment_edges:
+                self.open_segment()
+
+            triples = array.array('I')
+            for login, (owner, name), relation in edges:
+                triples.extend((self.intern(self.users, 'users', login),
+                                self.intern(self.repos, 'repos', owner + '/' + name),
+                                relation))
+            if sys.byteorder == 'big':
+                triples.byteswap()
+
+            # Names first, so an edge never refers to a name that didn't make it to disk
+            self.files['users'].flush()
+            self.files['repos'].flush()
+            self.files['edges'].write(triples.tobytes())
+            self.files['edges'].flush()
+            self.edge_count += len(triples) // 3
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+            self.segment_name = None
+
+
+_edge_log = None
+_edge_log_lock = threading.Lock()
+
+def get_edge_log():
+    '''The process-wide EdgeLog expansions write to, or None unless edge_log is set'''
+    global _edge_log
+    if not getattr(g, 'edge_log', False):
+        return None
+    with _edge_log_lock:
+        if _edge_log is None:
+            _edge_log = EdgeLog()
+        return _edge_log
+
+
+def read_names(path):
+    with open(path, encoding='utf8') as f:
+        return f.read().split('\n')[:-1]
+
+def read_segment(directory, name, start):
+    '''(users, repos, edges, edge count) of segment `name`, with the edges from number `start` on, without any cut
+    short by a crash or referring to names that weren't written'''
+
+    # Edges are sized up before reading names, so a segment still being written has every name its edges need
+    path = os.path.join(directory, name)
+    count = os.path.getsize(path + '.edges') // 12
+    users = read_names(path + '.users')
+    repos = read_names(path + '.repos')
+
+    edges = np.fromfile(path + '.edges', dtype='<u4', count=count * 3).reshape(-1, 3)[start:]
+    edges = edges[(edges[:, 0] < len(users)) & (edges[:, 1] < len(repos))]
+    return users, repos, edges, count
+
+def build_csr(rows, columns, relations, n):
+    '''indptr, indices and relations of the CSR adjacency of (row, column, relation) edges sorted by row'''
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, columns.astype(np.uint32), relations.astype(np.uint8)
+
+def compact(directory=None):
+    '''Merges the edges logged since the last compaction into the CSR graph in <directory>/graph. Returns the
+    number of new edges read'''
+
+    if np is None:
+        raise RuntimeError('Compacting the edge log needs numpy')
+
+    directory = directory or default_directory()
+    graph_dir = os.path.join(directory, 'graph')
+
+    meta = {'segments': {}}
+    users, repos = [], []
+    old = np.zeros((0, 3), dtype=np.uint32)
+    if os.path.exists(os.path.join(graph_dir, 'meta.json')):
+        graph = EdgeGraph(directory)
+        with open(os.path.join(graph_dir, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+        users, repos = list(graph.users), list(graph.repos)
+        old = np.stack([np.repeat(np.arange(len(users), dtype=np.uint32), np.diff(graph.user_indptr)),
+                        graph.user_repos, graph.user_relations], axis=1)
+        del graph
+
+    user_ids = {login: i for i, login in enumerate(users)}
+    repo_ids = {key: i for i, key in enumerate(repos)}
+    parts = [old]
+    read = 0
+    for path in sorted(glob.glob(os.path.join(directory, '*.edges'))):
+        name = os.path.basename(path)[:-len('.edges')]
+        seg_users, seg_repos, edges, count = read_segment(directory, name, meta['segments'].get(name, 0))
+        meta['segments'][name] = count
+        if not len(edges):
+            continue
+
+        user_map = np.array([user_ids.setdefault(login, len(user_ids)) for login in seg_users], dtype=np.uint32)
+        repo_map = np.array([repo_ids.setdefault(key, len(repo_ids)) for key in seg_repos], dtype=np.uint32)
+        parts.append(np.stack([user_map[edges[:, 0]], repo_map[edges[:, 1]], edges[:, 2]], axis=1))
+        read += len(edges)
+
+    # Sorted by user, then repo and relation
+    edges = np.unique(np.concatenate(parts), axis=0)
+    by_repo = np.lexsort((edges[:, 0], edges[:, 1]))
+
+    tmp_dir = graph_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for prefix, rows, columns, relations, n in (
+            ('user', edges[:, 0], edges[:, 1], edges[:, 2], len(user_ids)),
+            ('repo', edges[by_repo, 1], edges[by_repo, 0], edges[by_repo, 2], len(repo_ids))):
+        indptr, indices, relations = build_csr(rows, columns, relations, n)
+        np.save(os.path.join(tmp_dir, prefix + '_indptr.npy'), indptr)
+        np.save(os.path.join(tmp_dir, prefix + '_neighbors.npy'), indices)
+        np.save(os.path.join(tmp_dir, prefix + '_relations.npy'), relations)
+
+    for file_name, names in (('users.txt', user_ids), ('repos.txt', repo_ids)):
+        with open(os.path.join(tmp_dir, file_name), 'w', encoding='utf8') as f:
+            f.writelines(name + '\n' for name in names)
+    meta['edges'] = len(edges)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf8') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(graph_dir + '.old', ignore_errors=True)
+    if os.path.exists(graph_dir):
+        os.rename(graph_dir, graph_dir + '.old')
+    os.rename(tmp_dir, graph_dir)
+    shutil.rmtree(graph_dir + '.old', ignore_errors=True)
+
+    log.info('Compacted %d new edges into %d edges between %d users and %d repos', read, len(edges),
+             len(user_ids), len(repo_ids))
+    return read
+
+
+class EdgeGraph():
+    '''The compacted graph in <directory>/graph, memory-mapped. Users and repos are numbered by their line in
+    users.txt and repos.txt'''
+
+    def __init__(self, directory=None):
+        if np is None:
+            raise RuntimeError('Reading the edge graph needs numpy')
+
+        self.directory = os.path.join(directory or default_directory(), 'graph')
+        self.users = read_names(os.path.join(self.directory, 'users.txt'))
+        self.repos = read_names(os.path.join(self.directory, 'repos.txt'))
+        self.user_ids = None
+        self.repo_ids = None
+
+        def load(name):
+            return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+        self.user_indptr = load('user_indptr')
+        self.user_repos = load('user_neighbors')
+        self.user_relations = load('user_relations')
+        self.repo_indptr = load('repo_indptr')
+        self.repo_users = load('repo_neighbors')
+        self.repo_relations = load('repo_relations')
+
+    def user_id(self, login):
+        if self.user_ids is None:
+            self.user_ids = {login: i for i, login in enumerate(self.users)}
+        return self.user_ids.get(login)
+
+    def repo_id(self, owner, name):
+        if self.repo_ids is None:
+            self.repo_ids = {key: i for i, key in enumerate(self.repos)}
+        return self.repo_ids.get(owner + '/' + name)
+
+    @staticmethod
+    def neighbors(indptr, indices, relations, i, relation):
+        neighbors = indices[indptr[i]:indptr[i + 1]]
+        if relation is None:
+            return neighbors
+        return neighbors[relations[indptr[i]:indptr[i + 1]] == relation]
+
+    def repos_of(self, user_id, relation=None):
+        '''Ids of the repos user `user_id` has an edge to, optionally only of one relation'''
+        return self.neighbors(self.user_indptr, self.user_repos, self.user_relations, user_id, relation)
+
+    def users_of(self, repo_id, relation=None):
+        '''Ids of the users with an edge to repo `repo_id`, optionally only of one relation'''
+        return self.neighbors(self.repo_indptr, self.repo_users, self.repo_relations, repo_id, relation)
+
+    def user_degree(self, user_id):
+        return int(self.user_indptr[user_id + 1] - self.user_indptr[user_id])
+
+    def repo_degree(self, repo_id):
+        return int(self.repo_indptr[repo_id + 1] - self.repo_indptr[repo_id])
+
+    def user_degrees(self):
+        return np.diff(self.user_indptr)
+
+    def repo_degrees(self):
+        return np.diff(self.repo_indptr)
+
+
+def main(argv):
+    if not argv or argv[0] not in ('compact', 'stats', 'repos', 'users') or \
+       (argv[0] in ('repos', 'users')) != (len(argv) == 2):
+        print(__doc__)
+        return 1
+
+    if argv[0] == 'compact':
+        compact()
+        return 0
+
+    graph = EdgeGraph()
+    if argv[0] == 'stats':
+        user_degrees, repo_degrees = graph.user_degrees(), graph.repo_degrees()
+        print('{} edges, {} users, {} repos'.format(len(graph.user_repos), len(graph.users), len(graph.repos)))
+        if len(graph.users):
+            print('repos per user: mean {:.1f}, max {}'.format(user_degrees.mean(), user_degrees.max()))
+            print('users per repo: mean {:.1f}, max {}'.format(repo_degrees.mean(), repo_degrees.max()))
+        return 0
+
+    if argv[0] == 'repos':
+        node = graph.user_id(argv[1])
+        ids, relations, names = graph.user_repos, graph.user_relations, graph.repos
+        indptr = graph.user_indptr
+    else:
+        node = graph.repo_id(*argv[1].split('/', 1)) if '/' in argv[1] else None
+        ids, relations, names = graph.repo_users, graph.repo_relations, graph.users
+        indptr = graph.repo_indptr
+    if node is None:
+        print('{} is not in the graph'.format(argv[1]))
+        return 1
+
+    for i in range(indptr[node], indptr[node + 1]):
+        print('{:<13} {}'.format(RELATION_NAMES[relations[i]], names[ids[i]]))
+    return 0
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,227 @@
+'''Exports the crawl to Parquet files for analysis outside the database.
+
+    python -m github_repos.export [directory] [--full]
+
+Each table (repositories, owners, languages, repo_languages) is read through a server-side cursor, a chunk at a
+time, and written to <directory>/<table>/part-<run>-<file>.parquet with dictionary-encoded strings. Owners and
+languages never change once added, so they are read in id order and only the rows added since the highest id
+exported are appended. Repos are exported once fetched, and again with their languages whenever they are re-fetched:
+each export appends the repos (and their repo_languages) with a fetched_at past the previous export's mark, so
+readers keep the rows of the latest run for each repo. Columns that only matter to the crawl itself, like queue
+state and leases, are left out. The marks are kept in <directory>/manifest.json; --full starts over.
+'''
+
+import os
+import sys
+import json
+import glob
+import time
+import logging as _logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import select, func, Integer, SmallInteger, BigInteger, String, Boolean, Float
+
+from github_repos.db import default_engine, Repo, Owner, Language, RepoLanguages, STATE_NEW, STATE_MISSING
+from github_repos import setup_logging
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+TABLES = (Repo.__table__, Owner.__table__, Language.__table__, RepoLanguages.__table__)
+
+# Exported again whenever their repo is re-fetched
+FETCHED_TABLES = (Repo.__table__, RepoLanguages.__table__)
+
+# Crawl bookkeeping left out of the export. It changes without fetched_at moving, so it would go stale anyway
+INTERNAL_COLUMNS = {
+    'repositories': ('state', 'leased_by', 'lease_expires', 'attempts', 'errors', 'sightings', 'priority'),
+    'owners': ('expansions', 'yielded'),
+}
+
+ARROW_TYPES = (
+    # Subclasses before their bases
+    (BigInteger, pa.int64()),
+    (SmallInteger, pa.int16()),
+    (Integer, pa.int32()),
+    (Boolean, pa.bool_()),
+    (Float, pa.float64()),
+    (String, pa.dictionary(pa.int32(), pa.string())),
+)
+
+
+def exported_columns(table):
+    '''The columns of `table` that are exported'''
+
+    return [column for column in table.columns if column.name not in INTERNAL_COLUMNS.get(table.name, ())]
+
+def arrow_schema(table):
+    '''The arrow schema of the exported columns of `table`, strings dictionary-encoded'''
+
+    fields = []
+    for column in exported_columns(table):
+        # Types made with with_variant wrap the general type
+        column_type = getattr(column.type, 'impl', column.type)
+        for sql_type, arrow_type in ARROW_TYPES:
+            if isinstance(column_type, sql_type):
+                fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+                break
+        else:
+            raise TypeError('No arrow type for {}.{} ({})'.format(table.name, column.name, column.type))
+    return pa.schema(fields)
+
+def record_batch(schema, rows):
+    '''A RecordBatch of the result `rows`, in the column order of `schema`'''
+
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class Exporter():
+    '''Exports TABLES to `directory`, reading `chunk_rows` rows per fetch and starting a new file every
+    `rows_per_file` rows. Repos fetched in the last `settle_seconds` are left for the next export, so that
+    transactions still writing rows stamped before the mark have committed by the time it is passed'''
+
+    def __init__(self, directory=None, engine=None, chunk_rows=None, rows_per_file=None, settle_seconds=None):
+        self.directory = directory or getattr(g, 'export_dir', None) or \
+                         os.path.join(os.path.dirname(__file__), 'export')
+        self.engine = engine or default_engine()
+        self.chunk_rows = chunk_rows or getattr(g, 'export_chunk_rows', 50000)
+        self.rows_per_file = rows_per_file or getattr(g, 'export_rows_per_file', 5000000)
+        self.settle_seconds = settle_seconds if settle_seconds is not None else \
+                              getattr(g, 'export_settle_seconds', 300)
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'runs': 0, 'tables': {}}
+
+    def save_manifest(self, manifest):
+        # Written only once a table's files are complete, so a crashed export is redone from the previous mark
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, '*', 'part-*.parquet')):
+            os.remove(path)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def export(self, full=False):
+        '''Exports the rows added or re-fetched since the last export, or all of them if `full`. Returns table name
+        -> rows'''
+
+        os.makedirs(self.directory, exist_ok=True)
+        if full:
+            self.clear()
+
+        manifest = self.load_manifest()
+        manifest['runs'] += 1
+        until = time.time() - self.settle_seconds
+        counts = {}
+        with self.engine.connect() as conn:
+            for table in TABLES:
+                # The new marks are only saved once the table is written
+                state = manifest['tables'].setdefault(table.name, {'rows': 0})
+                if table in FETCHED_TABLES:
+                    # Older versions marked these by id, and have no fetched_at yet: every repo is exported once more
+                    state.pop('last_id', None)
+                    since = state.get('fetched_at', 0)
+                    query = fetched_rows(table, since, until) if until > since else None
+                    state['fetched_at'] = max(since, until)
+                else:
+                    query, state['last_id'] = added_rows(conn, table, state.get('last_id', 0))
+
+                counts[table.name] = 0 if query is None else self.export_table(conn, table, query, manifest['runs'])
+                state['rows'] += counts[table.name]
+                self.save_manifest(manifest)
+        return counts
+
+    def export_table(self, conn, table, query, run):
+        '''Writes the rows of the select `query` over `table`'s exported columns. Returns the number of rows written'''
+
+        schema = arrow_schema(table)
+        result = conn.execution_options(stream_results=True).execute(query)
+
+        os.makedirs(os.path.join(self.directory, table.name), exist_ok=True)
+        writer = None
+        files = 0
+        file_rows = 0
+        total = 0
+        try:
+            for rows in result.partitions(self.chunk_rows):
+                if writer is None or file_rows >= self.rows_per_file:
+                    if writer is not None:
+                        writer.close()
+                    files += 1
+                    path = os.path.join(self.directory, table.name, 'part-{:05d}-{:04d}.parquet'.format(run, files))
+                    writer = pq.ParquetWriter(path, schema, use_dictionary=True, compression='zstd')
+                    file_rows = 0
+
+                writer.write_batch(record_batch(schema, rows))
+                file_rows += len(rows)
+                total += len(rows)
+        finally:
+            result.close()
+            if writer is not None:
+                writer.close()
+
+        log.info('Exported %d rows of %s in %d files', total, table.name, files)
+        return total
+
+
+def added_rows(conn, table, last_id):
+    '''The select of the rows of `table` with ids above `last_id`, or None if there are none, and the highest id'''
+
+    # Rows inserted while this runs are left for the next export, so every export is a clean id range
+    max_id = conn.execute(select(func.max(table.c.id))).scalar()
+    if max_id is None or max_id <= last_id:
+        return None, last_id
+    return select(*exported_columns(table)) \
+           .where(table.c.id > last_id) \
+           .where(table.c.id <= max_id) \
+           .order_by(table.c.id), max_id
+
+def fetched_rows(table, since, until):
+    '''The select of the repos (or their repo_languages) fetched after `since` and up to `until`. Repos not fetched
+    yet, or missing, have no data to export'''
+
+    repos = Repo.__table__
+    query = select(*exported_columns(table))
+    if table is not repos:
+        query = query.join_from(table, repos, table.c.repo_id == repos.c.id)
+    return query.where(repos.c.state.notin_((STATE_NEW, STATE_MISSING))) \
+                .where(repos.c.fetched_at > since) \
+                .where(repos.c.fetched_at <= until) \
+                .order_by(repos.c.fetched_at, repos.c.id)
+
+
+def main(argv):
+    args = [arg for arg in argv if arg != '--full']
+    if len(args) > 1 or any(arg in ('-h', '--help') for arg in argv):
+        print(__doc__)
+        return 1
+
+    start = time.perf_counter()
+    counts = Exporter(args[0] if args else None).export(full='--full' in argv)
+    elapsed = time.perf_counter() - start
+
+    log.info('Exported %d rows in %.1f seconds: %s', sum(counts.values()), elapsed,
+             ', '.join('{} {}'.format(count, name) for name, count in counts.items()))
+    return 0
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
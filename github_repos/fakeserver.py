@@ -0,0 +1,357 @@
+'''A local stand-in for github's GraphQL API, serving a synthetic user/repo graph to the queries MainScraper sends.
+
+    python -m github_repos.fakeserver [port] [repos]
+
+It only understands the shapes of the queries in github_repos.scraper (expand, fetch, refresh, popular repos and
+rate limit), recognized by their fragments and variables rather than parsed. Expand queries are answered with the
+connections and `first:` sizes expand_shape_of reads back from their text. Queries are charged their static cost
+estimate against a per-token rate limit, and latency, per-repo errors and html timeout pages can be injected.
+'''
+
+import sys
+import gzip
+import json
+import time
+import random
+import threading
+import collections
+import logging as _logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from github_repos.graphql import estimate
+from github_repos.costmodel import EXPAND, FETCH, REFRESH
+from github_repos.scraper import POPULAR, query_kind, archived_pairs
+from github_repos.scraper import EXPAND_CONNECTIONS, DEFAULT_EXPAND_SHAPE, expand_shape_of
+from github_repos.scraper import build_expand_query, build_fetch_query, build_refresh_query
+from github_repos import setup_logging
+
+
+log = _logging.getLogger(__name__)
+
+LANGUAGES = (('Python', '#3572A5'), ('C', '#555555'), ('Rust', '#dea584'), ('Shell', '#89e051'),
+             ('JavaScript', '#f1e05a'), ('Go', '#00ADD8'), ('Makefile', '#427819'), ('HTML', '#e34c26'))
+
+TIMEOUT_PAGE = b'<html><body><h1>We couldn\'t respond to your request in time.</h1></body></html>'
+QUERY_TIMEOUT_MESSAGE = 'Something went wrong while executing your query. This may be the result of a timeout.'
+
+
+class FakeGraph():
+    '''Deterministic synthetic github. Repos repo0..repoN-1 are each owned by one user or org, and every repo and
+    user links to others with a skew towards low ids, so a few repos are popular and most are rarely seen. touch()
+    moves a repo's change markers, as a push would. `renames` maps old (login, name) pairs to the repo number github
+    would redirect them to.'''
+
+    def __init__(self, repos=10000, users=None, orgs=None, seed=0):
+        self.repos = repos
+        self.users = users or max(1, repos // 5)
+        self.orgs = orgs if orgs is not None else self.users // 10
+        self.seed = seed
+        self.versions = collections.Counter()
+        self.created = 1262304000
+        self.renames = {}
+
+    def touch(self, repo):
+        self.versions[repo] += 1
+
+    def rand(self, *key):
+        return random.Random('{}/{}'.format(self.seed, '/'.join(map(str, key))))
+
+    def skewed(self, rand, n, k):
+        return [int(n * rand.random() ** 3) for _ in range(k)]
+
+    def owner(self, repo):
+        '''(login, typename) of the owner of repo number `repo`'''
+
+        i = (repo * 7919) % (self.users + self.orgs)
+        if i < self.users:
+            return 'user%d' % i, 'User'
+        return 'org%d' % (i - self.users), 'Organization'
+
+    def lookup(self, login, name):
+        '''Repo number of login/name, or None if it doesn't exist'''
+
+        if (login, name) in self.renames:
+            return self.renames[(login, name)]
+        if not name.startswith('repo') or not name[4:].isdigit():
+            return None
+        repo = int(name[4:])
+        if repo >= self.repos or self.owner(repo)[0] != login:
+            return None
+        return repo
+
+    def stars(self, repo):
+        return self.repos // (repo + 1)
+
+    def repo_info(self, repo):
+        login, typename = self.owner(repo)
+        return {'name': 'repo%d' % repo, 'owner': {'__typename': typename, 'login': login}}
+
+    def user_node(self, user, shape=DEFAULT_EXPAND_SHAPE):
+        '''The userExpand fragment of user number `user`, with the connections in `shape`'''
+
+        rand = self.rand('user', user)
+
+        def repos(key, n):
+            return [self.repo_info(repo) for repo in self.skewed(rand, self.repos, rand.randrange(n + 1))]
+
+        connections = {'contributedRepositories': repos('contributed', 10),
+                       'issues': [{'repository': repo} for repo in repos('issues', 20)],
+                       'pullRequests': [{'repository': repo} for repo in repos('pullRequests', 20)],
+                       'starredRepositories': repos('starred', 20)}
+        return dict(self.selected(shape, 'userExpand', connections), login='user%d' % user)
+
+    def expand_node(self, repo, shape=DEFAULT_EXPAND_SHAPE):
+        '''The repoExpand fragment of repo number `repo`, with the connections in `shape`'''
+
+        rand = self.rand('repo', repo)
+        users = {key: self.skewed(rand, self.users, rand.randrange(6))
+                 for key in ('mentionableUsers', 'stargazers', 'watchers')}
+        # Issues and pull requests, each with a few participants
+        for key in ('issues', 'pullRequests'):
+            rand = self.rand('repo', repo, key)
+            users[key] = [self.skewed(rand, self.users, rand.randrange(4)) for _ in range(rand.randrange(6))]
+
+        participants = dict(shape).get('participants')
+        connections = {}
+        for key, first in self.followed(shape, 'repoExpand'):
+            if key in ('issues', 'pullRequests'):
+                connections[key] = [{'participants': {'nodes': [self.user_node(user, shape)
+                                                                for user in item[:participants]]}}
+                                    for item in users[key][:first]]
+            else:
+                connections[key] = [self.user_node(user, shape) for user in users[key][:first]]
+
+        node = self.selected(shape, 'repoExpand', connections)
+        node.update(self.repo_info(repo))
+        return node
+
+    def followed(self, shape, fragment):
+        '''(key, first) of each connection of `fragment` that `shape` follows'''
+
+        return [(EXPAND_CONNECTIONS[name][1], first) for name, first in shape
+                if name in EXPAND_CONNECTIONS and EXPAND_CONNECTIONS[name][0] == fragment]
+
+    def selected(self, shape, fragment, connections):
+        '''The nodes of `fragment` for the connections (key -> all its nodes) that `shape` follows'''
+
+        return {key: {'nodes': connections[key][:first]} for key, first in self.followed(shape, fragment)}
+
+    def marker_node(self, repo):
+        '''The repoMarker fragment of repo number `repo`'''
+
+        pushed = self.created + repo * 60 + self.versions[repo] * 3600
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(pushed))
+        login, typename = self.owner(repo)
+        return {'name': 'repo%d' % repo, 'owner': {'__typename': typename, 'login': login},
+                'pushedAt': timestamp, 'updatedAt': timestamp}
+
+    def fetch_node(self, repo):
+        '''The repoInfo fragment of build_fetch_query for repo number `repo`'''
+
+        rand = self.rand('info', repo)
+        login, typename = self.owner(repo)
+        return {'name': 'repo%d' % repo,
+                'owner': {'__typename': typename, 'login': login},
+                'description': 'synthetic repo %d' % repo,
+                'diskUsage': rand.randrange(100000),
+                'url': 'https://github.com/%s/repo%d' % (login, repo),
+                'isFork': rand.random() < 0.2,
+                'isMirror': False,
+                'pushedAt': self.marker_node(repo)['pushedAt'],
+                'updatedAt': self.marker_node(repo)['updatedAt'],
+                'stargazers': {'totalCount': self.stars(repo)},
+                'languages': {'edges': [{'size': rand.randrange(1000000), 'node': {'name': lang, 'color': color}}
+                                        for lang, color in rand.sample(LANGUAGES, rand.randrange(4))]}}
+
+    def popular_nodes(self, n=100):
+        return [dict(self.repo_info(repo), stargazers={'totalCount': self.stars(repo)})
+                for repo in range(min(n, self.repos))]
+
+
+class FakeGithub():
+    '''Serves a FakeGraph over HTTP on `host`:`port` (0 picks a free port). Every token starts with `rate_limit`
+    points per `reset_seconds` window. `latency` seconds are added to each response, a `timeout_rate` fraction of
+    queries get an html 502 page and each requested repo fails with NOT_FOUND with probability `error_rate`.
+
+    Fetches of the repo numbers in `poisoned` time out on github's end, failing the whole query, and the repos
+    in `broken` come back as null with an error while the rest of their query succeeds.'''
+
+    def __init__(self, graph=None, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, timeout_rate=0.0,
+                 rate_limit=5000, reset_seconds=3600, seed=0):
+        self.graph = graph or FakeGraph(seed=seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.rate_limit = rate_limit
+        self.reset_seconds = reset_seconds
+        self.rand = random.Random(seed)
+        self.poisoned = set()
+        self.broken = set()
+
+        self.lock = threading.Lock()
+        self.budgets = {}
+        self.costs = {}
+        self.queries = collections.Counter()
+
+        self.server = ThreadingHTTPServer((host, port), FakeGithubHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/graphql'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='FakeGithub', daemon=True)
+        self.thread.start()
+        log.info('Fake github serving %d repos at %s', self.graph.repos, self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def cost(self, kind, n, shape=None):
+        '''Static cost estimate github would charge for a query of `kind` on n repos, following the connections in
+        `shape` for expand queries'''
+
+        with self.lock:
+            if (kind, n, shape) not in self.costs:
+                if kind == EXPAND:
+                    self.costs[(kind, n, shape)] = estimate(build_expand_query(n if n > 1 else None, shape)).cost
+                elif kind == FETCH:
+                    self.costs[(kind, n, shape)] = estimate(build_fetch_query(n)).cost
+                elif kind == REFRESH:
+                    self.costs[(kind, n, shape)] = estimate(build_refresh_query(n)).cost
+                else:
+                    self.costs[(kind, n, shape)] = 1
+            return self.costs[(kind, n, shape)]
+
+    def charge(self, token, cost):
+        '''Takes `cost` points from `token`. Returns its rateLimit block, or None if it doesn't have them'''
+
+        now = time.time()
+        with self.lock:
+            remaining, reset_time = self.budgets.get(token, (self.rate_limit, now + self.reset_seconds))
+            if now >= reset_time:
+                remaining, reset_time = self.rate_limit, now + self.reset_seconds
+            if cost > remaining:
+                self.budgets[token] = remaining, reset_time
+                return None
+
+            self.budgets[token] = remaining - cost, reset_time
+        return {'cost': cost, 'remaining': remaining - cost,
+                'resetAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(reset_time))}
+
+    def lookup(self, alias, login, name, data, errors):
+        repo = self.graph.lookup(login, name)
+        if repo is None or self.rand.random() < self.error_rate:
+            data[alias] = None
+            errors.append({'type': 'NOT_FOUND', 'path': [alias],
+                           'message': "Could not resolve to a Repository with the name '{}'.".format(name)})
+            return None
+        return repo
+
+    def respond(self, query, variables, token):
+        '''Returns (status, content type, body) for a query'''
+
+        kind = query_kind(query)
+        with self.lock:
+            self.queries[kind or 'rateLimit'] += 1
+            timeout = self.rand.random() < self.timeout_rate
+        if timeout:
+            return 502, 'text/html', TIMEOUT_PAGE
+
+        pairs = archived_pairs(variables) if kind in (EXPAND, FETCH, REFRESH) else []
+        if kind == FETCH and any(self.graph.lookup(login, name) in self.poisoned for _, login, name in pairs):
+            return 200, 'application/json', {'data': None, 'errors': [{'message': QUERY_TIMEOUT_MESSAGE}]}
+
+        shape = expand_shape_of(query) if kind == EXPAND else None
+        rate_limit = self.charge(token, self.cost(kind, len(pairs), shape) if kind else 0)
+        if rate_limit is None:
+            return 200, 'application/json', {'data': None, 'errors': [
+                {'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'}]}
+
+        data = {'rateLimit': rate_limit}
+        errors = []
+        for alias, login, name in pairs:
+            alias = alias or 'repository'
+            repo = self.lookup(alias, login, name, data, errors)
+            if repo is None:
+                continue
+            elif repo in self.broken:
+                data[alias] = None
+                errors.append({'type': 'SERVICE_UNAVAILABLE', 'path': [alias], 'message': 'Timeout on this field'})
+            elif kind == EXPAND:
+                data[alias] = self.graph.expand_node(repo, shape)
+            elif kind == FETCH:
+                data[alias] = self.graph.fetch_node(repo)
+            else:
+                data[alias] = self.graph.marker_node(repo)
+
+        if kind == POPULAR:
+            data['search'] = {'nodes': self.graph.popular_nodes()}
+
+        result = {'data': data}
+        if errors:
+            result['errors'] = errors
+        return 200, 'application/json', result
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, which Nagle's algorithm would hold back on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        payload = json.loads(body.decode('utf8'))
+        token = self.headers.get('Authorization', '').split(' ')[-1]
+
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        status, content_type, result = fake.respond(payload['query'], payload.get('variables') or {}, token)
+        if not isinstance(result, bytes):
+            result = json.dumps(result, separators=(',', ':')).encode('utf8')
+            content_type += '; charset=utf-8'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            result = gzip.compress(result, 1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def main(argv):
+    port = int(argv[0]) if len(argv) > 0 else 8000
+    repos = int(argv[1]) if len(argv) > 1 else 10000
+
+    fake = FakeGithub(FakeGraph(repos), port=port)
+    print('Serving {} synthetic repos at {}. Point api_url there'.format(repos, fake.url))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+    return 0
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
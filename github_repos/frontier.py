@@ -0,0 +1,157 @@
+import math
+import time
+import logging as _logging
+
+from sqlalchemy import func, update, bindparam
+
+from github_repos.db import Repo, Owner, STATE_NEW, STATE_TODO
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+
+class Frontier():
+    '''Scores STATE_TODO repos so the most promising ones are expanded first.
+
+    A todo's priority grows with the log of its repo's stars, the log of how often the repo turned up again in
+    other expansions, and the log of the new repos per expansion its owner has yielded so far. An owner's yield is
+    smoothed towards `prior_yield` as if it had `prior_weight` expansions already, so owners nobody expanded yet
+    aren't starved. Priorities are stored in repositories.priority, indexed for todos only, so claiming the next
+    todos is an index scan however long the queue gets. Todos not scored yet are claimed last.
+
+    An owner's yield moves all of its todos' priorities by the same amount, so expansions shift them in place
+    rather than rescoring each row.'''
+
+    def __init__(self, star_weight=None, sighting_weight=None, yield_weight=None, prior_yield=None,
+                 prior_weight=None):
+        self.star_weight = star_weight if star_weight is not None else getattr(g, 'frontier_star_weight', 1.0)
+        self.sighting_weight = sighting_weight if sighting_weight is not None else \
+                               getattr(g, 'frontier_sighting_weight', 1.0)
+        self.yield_weight = yield_weight if yield_weight is not None else getattr(g, 'frontier_yield_weight', 1.0)
+        self.prior_yield = prior_yield if prior_yield is not None else getattr(g, 'frontier_prior_yield', 5.0)
+        self.prior_weight = prior_weight if prior_weight is not None else getattr(g, 'frontier_prior_weight', 2.0)
+
+    @property
+    def order_by(self):
+        '''Claim order for LeaseQueue. Matches ix_repositories_todo_priority_id read backwards'''
+        return (Repo.priority.desc().nullslast(), Repo.id)
+
+    def score(self, stars, sightings, expansions, yielded):
+        return self.star_weight * math.log1p(stars or 0) + \
+               self.sighting_weight * math.log1p(sightings or 0) + \
+               self.yield_score(expansions, yielded)
+
+    def yield_score(self, expansions, yielded):
+        '''The part of a todo's priority that comes from its owner's yield'''
+
+        owner_yield = ((yielded or 0) + self.prior_yield * self.prior_weight) / ((expansions or 0) + self.prior_weight)
+        return self.yield_weight * math.log1p(owner_yield)
+
+    def owner_stats(self, session, owner_ids):
+        '''owner id -> (expansions, yielded) for `owner_ids`'''
+
+        if not owner_ids:
+            return {}
+        return {owner_id: (expansions, yielded) for owner_id, expansions, yielded in
+                session.query(Owner.id, Owner.expansions, Owner.yielded).filter(Owner.id.in_(set(owner_ids)))}
+
+    def rescore(self, session, *criteria):
+        '''Recomputes the priority of every todo matching `criteria`. Returns the number of todos rescored'''
+
+        rows = session.query(Repo.id, Repo.sightings, Repo.stars, Owner.expansions, Owner.yielded) \
+                      .join(Owner, Repo.owner_id == Owner.id) \
+                      .filter(Repo.state == STATE_TODO) \
+                      .filter(*criteria) \
+                      .all()
+
+        session.bulk_update_mappings(Repo, [{'id': repo_id, 'priority': self.score(*stats)}
+                                            for repo_id, *stats in rows])
+        return len(rows)
+
+    def backfill(self, session, chunk=10000, deadline=None):
+        '''Scores todos created before they had a priority, a chunk at a time, stopping after the chunk that passes
+        `deadline` (a time.time()) if one is given'''
+
+        total = 0
+        while deadline is None or time.time() < deadline:
+            ids = [repo_id for repo_id, in session.query(Repo.id)
+                                                  .filter(Repo.state == STATE_TODO)
+                                                  .filter(Repo.priority.is_(None))
+                                                  .limit(chunk)]
+            if not ids:
+                break
+            total += self.rescore(session, Repo.id.in_(ids))
+            session.commit()
+
+        if total:
+            log.info('Scored %d todos that had no priority', total)
+        return total
+
+    def note_sightings(self, session, keys):
+        '''Counts one more sighting for each already known (owner id, repo name) in `keys` not expanded yet, and
+        rescores the todos among them'''
+
+        # Names are case insensitive, like ux_repositories_owner_lower_name
+        keys = {(owner_id, name.lower()) for owner_id, name in keys}
+        if not keys:
+            return
+
+        rows = session.query(Repo.id, Repo.owner_id, Repo.name, Repo.state) \
+                      .filter(Repo.owner_id.in_({owner_id for owner_id, _ in keys})) \
+                      .filter(func.lower(Repo.name).in_({name for _, name in keys})) \
+                      .filter(Repo.state.in_((STATE_NEW, STATE_TODO)))
+        rows = [(repo_id, state) for repo_id, owner_id, name, state in rows if (owner_id, name.lower()) in keys]
+        if not rows:
+            return
+
+        session.query(Repo).filter(Repo.id.in_([repo_id for repo_id, _ in rows])) \
+               .update({Repo.sightings: func.coalesce(Repo.sightings, 0) + 1}, synchronize_session=False)
+        todo_ids = [repo_id for repo_id, state in rows if state == STATE_TODO]
+        if todo_ids:
+            self.rescore(session, Repo.id.in_(todo_ids))
+
+    def note_expansions(self, session, yields):
+        '''Adds `yields`, owner id -> (repos expanded, new repos found), to the owners' stats and shifts the priority of
+        their remaining todos by how much their yield score moved'''
+
+        if not yields:
+            return
+
+        # In owner id order, so concurrent writers lock the same rows in the same order
+        owner_ids = sorted(yields)
+        before = self.owner_stats(session, owner_ids)
+        owners = Owner.__table__
+        session.execute(update(owners)
+                        .where(owners.c.id == bindparam('owner'))
+                        .values(expansions=func.coalesce(owners.c.expansions, 0) + bindparam('expanded'),
+                                yielded=func.coalesce(owners.c.yielded, 0) + bindparam('found')),
+                        [{'owner': owner_id, 'expanded': yields[owner_id][0], 'found': yields[owner_id][1]}
+                         for owner_id in owner_ids])
+
+        shifts = []
+        for owner_id in owner_ids:
+            expansions, yielded = before.get(owner_id, (None, None))
+            expanded, found = yields[owner_id]
+            shift = self.yield_score((expansions or 0) + expanded, (yielded or 0) + found) - \
+                    self.yield_score(expansions, yielded)
+            if shift:
+                shifts.append({'owner': owner_id, 'shift': shift})
+        if shifts:
+            # Todos without a priority yet keep it NULL until backfill scores them
+            repos = Repo.__table__
+            session.execute(update(repos)
+                            .where(repos.c.owner_id == bindparam('owner'))
+                            .where(repos.c.state == STATE_TODO)
+                            .values(priority=repos.c.priority + bindparam('shift')),
+                            shifts)
+
+    def priorities(self, session, repos):
+        '''Priorities of the (owner id, stars, sightings) of newly fetched repos'''
+
+        stats = self.owner_stats(session, [owner_id for owner_id, _, _ in repos])
+        return [self.score(stars, sightings, *stats.get(owner_id, (None, None)))
+                for owner_id, stars, sightings in repos]
+
+
+frontier = Frontier()
@@ -1,4 +1,37 @@
 import json
+import threading
+import collections
+
+class Var:
+    '''Reference to a query variable, e.g. Var('owner') formats as $owner'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Var({!r})'.format(self.name)
+
+class Enum:
+    '''Unquoted enum value, e.g. Enum('DESC')'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return 'Enum({!r})'.format(self.value)
+
+def format_value(value):
+    if isinstance(value, Var):
+        return '$' + value.name
+    elif isinstance(value, Enum):
+        return value.value
+    elif isinstance(value, dict):
+        return '{' + ', '.join('{}: {}'.format(k, format_value(v)) for k, v in value.items()) + '}'
+    elif isinstance(value, (list, tuple)):
+        return '[' + ', '.join(format_value(v) for v in value) + ']'
+    else:
+        return json.dumps(value)
+
 
 class Node:
     # Named something that hopefully won't conflict with any graphql names, about 91 bits of entropy here
@@ -40,31 +73,36 @@ class Node:
         self.children = tuple(list(self.children) + new_children)
         return self
 
+    def arg(self, name, default=None):
+        for k, v in self.args:
+            if k == name:
+                return v
+        return default
+
     # TODO pretty-print
     def format(self):
+        parts = []
+        self._format(parts)
+        return ''.join(parts)
+
+    def _format(self, parts):
         if self.json_name:
-            namestr = self.json_name + ': '
-        else:
-            namestr = ''
+            parts.append(self.json_name + ': ')
+        parts.append(self.gql_name + ' ')
 
         if self.args:
-            argstr = '({}: {}'.format(self.args[0][0], json.dumps(self.args[0][1]))
-            for arg in self.args[1:]:
-                argstr += ', {}: {}'.format(arg[0], json.dumps(arg[1]))
-            argstr += ')'
-        else:
-            argstr = ''
+            parts.append('(' + ', '.join('{}: {}'.format(k, format_value(v)) for k, v in self.args) + ')')
 
-        if self.children:
-            childrenstr = '{ ' + self.children[0].format()
-            for child in self.children[1:]:
-                childrenstr += ', ' + child.format()
-            childrenstr += ' }'
-        else:
-            childrenstr = ''
+        self._format_children(parts)
 
-        return '{jsonname}{name} {args}{children}'.format(
-            jsonname=namestr, name=self.gql_name, args=argstr, children=childrenstr)
+    def _format_children(self, parts):
+        if self.children:
+            parts.append('{ ')
+            for i, child in enumerate(self.children):
+                if i:
+                    parts.append(', ')
+                child._format(parts)
+            parts.append(' }')
 
     def export(self):
         exported_children = []
@@ -76,3 +114,144 @@ class Node:
 
         return (self.gql_name, self.args, tuple(exported_children))
 
+GraphQLNode = Node
+
+
+class Spread(Node):
+    '''...fragmentName'''
+
+    def __init__(self, fragment_name):
+        Node.__init__(self, fragment_name)
+
+    def _format(self, parts):
+        parts.append('...' + self.gql_name)
+
+class InlineFragment(Node):
+    '''...on TypeName { children }'''
+
+    def __init__(self, type_name):
+        Node.__init__(self, type_name)
+
+    def _format(self, parts):
+        parts.append('...on ' + self.gql_name + ' ')
+        self._format_children(parts)
+
+class Fragment(Node):
+    '''fragment name on TypeName { children }'''
+
+    def __init__(self, name, type_name):
+        Node.__init__(self, name)
+        self.type_name = type_name
+
+    def _format(self, parts):
+        parts.append('fragment {} on {} '.format(self.gql_name, self.type_name))
+        self._format_children(parts)
+
+class Query(Node):
+    '''A query operation with typed variables and the fragments it uses, e.g.
+
+        Query(variables={'owner': 'String!'}, fragments=[repo_info])(
+            Node('repository', owner=Var('owner'))(Spread('repoInfo')))
+    '''
+
+    def __init__(self, variables=None, fragments=(), name=None):
+        Node.__init__(self, 'query')
+        self.variables = tuple((variables or {}).items())
+        self.fragments = collections.OrderedDict((fragment.gql_name, fragment) for fragment in fragments)
+        self.name = name
+
+    def _format(self, parts):
+        parts.append('query')
+        if self.name:
+            parts.append(' ' + self.name)
+        if self.variables:
+            parts.append('(' + ', '.join('${}: {}'.format(name, type_) for name, type_ in self.variables) + ')')
+        parts.append(' ')
+        self._format_children(parts)
+
+        for fragment in self.used_fragments():
+            parts.append('\n')
+            fragment._format(parts)
+
+    def used_fragments(self):
+        '''Fragments reachable from the query's selections, in the order they were given'''
+
+        used = set()
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            for child in node.children:
+                if isinstance(child, Spread) and child.gql_name not in used:
+                    if child.gql_name not in self.fragments:
+                        raise KeyError('Unknown fragment ' + child.gql_name)
+                    used.add(child.gql_name)
+                    pending.append(self.fragments[child.gql_name])
+                pending.append(child)
+
+        return [fragment for name, fragment in self.fragments.items() if name in used]
+
+
+Estimate = collections.namedtuple('Estimate', 'nodes requests cost')
+
+def estimate(node, variables=None, fragments=None):
+    '''Statically estimates what github will charge for a query, following
+    https://developer.github.com/v4/guides/resource-limitations/: every connection is assumed to return its full
+    `first`/`last` count, `nodes` is the total node count checked against the 500,000 node limit, and `cost` is the
+    number of connection requests divided by 100, at least 1'''
+
+    variables = variables or {}
+    if fragments is None:
+        fragments = getattr(node, 'fragments', {})
+
+    totals = [0, 0]
+
+    def walk(node, multiplier):
+        limit = node.arg('first', node.arg('last'))
+        if isinstance(limit, Var):
+            limit = variables[limit.name]
+
+        if limit is not None:
+            totals[0] += multiplier * limit
+            totals[1] += multiplier
+            multiplier *= limit
+
+        for child in node.children:
+            if isinstance(child, Spread):
+                walk(fragments[child.gql_name], multiplier)
+            else:
+                walk(child, multiplier)
+
+    walk(node, 1)
+    nodes, requests = totals
+    return Estimate(nodes, requests, max(1, int(round(requests / 100.0))))
+
+
+Template = collections.namedtuple('Template', 'text nodes requests cost')
+
+class TemplateCache:
+    '''Compiled query text and cost estimate per query shape, so a query is only built once per shape (e.g.
+    ('fetch', 500) for a fetch batch of 500) and github always sees the same text for it'''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.templates = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, shape, build):
+        '''Returns the Template for `shape`, calling `build()` to make its Query the first time'''
+
+        with self.lock:
+            if shape in self.templates:
+                self.templates.move_to_end(shape)
+                return self.templates[shape]
+
+        query = build()
+        template = Template(query.format(), *estimate(query))
+
+        with self.lock:
+            self.templates[shape] = template
+            while len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return template
+
+templates = TemplateCache()
@@ -0,0 +1,363 @@
+import time
+import collections
+import logging as _logging
+
+from sqlalchemy import insert, update, func
+from sqlalchemy.orm.exc import NoResultFound
+
+from github_repos.db import Repo, Owner, RepoRedirect, STATE_TODO, STATE_ERROR, STATE_MISSING
+from github_repos.db import RepoLanguages, Language
+from github_repos.db import insert_ignoring_conflicts, insert_returning_ids
+from github_repos.cache import REPO_FETCHED
+from github_repos.frontier import frontier
+from github_repos import aggregates
+
+
+log = _logging.getLogger(__name__)
+
+
+def get_fetched_nodes(data):
+    '''Returns the repository nodes of a fetch query result, skipping repos github couldn't resolve'''
+
+    return [node for key, node in data.items() if key.lower().startswith('repo') and node]
+
+def resolve_fetched_nodes(session, todos, data, cache, failed=()):
+    '''Pairs each of `todos` with the node of its alias in the fetch query result `data` (repo1 for the first todo,
+    and so on) instead of matching nodes to todos by name, and resolves them with resolve_fetched_pairs. Todos whose
+    alias is in `failed` are left as they are'''
+
+    return resolve_fetched_pairs(session, fetched_pairs(todos, data, failed), cache)
+
+def fetched_pairs(todos, data, skip=()):
+    '''(todo, node) for each of `todos` whose alias in the fetch query result `data` isn't in `skip`'''
+
+    return [(todo, data.get('repo%d' % i)) for i, todo in enumerate(todos, 1) if 'repo%d' % i not in skip]
+
+def resolve_fetched_pairs(session, pairs, cache, moved=None):
+    '''Matches up fetched (todo, node) pairs.
+
+    Todos github couldn't resolve (deleted or made private) move to STATE_MISSING, so they are neither fetched again
+    nor found again as new until missing_repo_ttl passes. Todos github resolved under another owner or name, after
+    a rename or transfer, take that name, or are deleted if the repo under it is already known, and leave a
+    RepoRedirect from their old name. `moved` (lowercase new key -> todo renamed to it) is shared by the calls for
+    one batch resolved in parts. Returns the todos and nodes left to ingest. Doesn't commit'''
+
+    now = time.time()
+    todos_left = []
+    nodes = []
+    # (old login, old name, repo it now is) and (deleted todo, repo it now is)
+    redirects = []
+    merged = []
+    moved = {} if moved is None else moved
+    missing = 0
+    new_owners = 0
+    for todo, node in pairs:
+        if not node:
+            log.info('%s/%s could not be resolved, marking it missing', todo.owner.login, todo.name)
+            todo.state = STATE_MISSING
+            todo.fetched_at = now
+            missing += 1
+            continue
+
+        node = own_login(todo, node)
+        if not is_renamed(todo, node):
+            todo.name = node['name']
+            todos_left.append(todo)
+            nodes.append(node)
+            continue
+
+        target = renamed_target(session, cache, todo, node, moved)
+        if target is None:
+            redirects.append((todo.owner.login, todo.name, todo))
+            new_owners += move_repo(session, cache, todo, node, moved)
+            todos_left.append(todo)
+            nodes.append(node)
+            continue
+
+        redirects.append((todo.owner.login, todo.name, target))
+        merged.append((todo.id, target))
+        session.delete(todo)
+
+    session.flush()
+    write_redirects(session, cache, redirects, merged)
+
+    aggregates.add(session, new_repos=-missing - len(merged), repos_missing=missing, owners=new_owners)
+    return todos_left, nodes
+
+# Counter of each state of fetched repos that has one, see aggregates.STATS
+STATE_STATS = {STATE_TODO: 'repos_todo', STATE_ERROR: 'repo_errors'}
+
+def resolve_refetched_pairs(session, pairs, cache):
+    '''Matches up re-fetched (repo, node) pairs of already fetched repos, like resolve_fetched_pairs does for
+    todos. Repos github can't resolve any more are left as they are. Repos it resolved under another owner or name
+    take that name and leave a RepoRedirect from the old one. If a row already has the new name, the repo is a stale
+    copy of it, and moves to STATE_MISSING redirected to that row instead of being refreshed. Returns the
+    (owner login, name) -> repo id and the nodes of the repos left to refresh. Doesn't commit'''
+
+    repo_ids = {}
+    nodes = []
+    redirects = []
+    merged = []
+    moved = {}
+    deltas = collections.Counter()
+    for repo, node in pairs:
+        if not node:
+            continue
+
+        node = own_login(repo, node)
+        target = renamed_target(session, cache, repo, node, moved) if is_renamed(repo, node) else None
+        if target is None:
+            if is_renamed(repo, node):
+                redirects.append((repo.owner.login, repo.name, repo))
+                deltas['owners'] += move_repo(session, cache, repo, node, moved)
+            repo.name = node['name']
+            repo_ids[(repo.owner.login, repo.name)] = repo.id
+            nodes.append(node)
+            continue
+
+        log.info('%s/%s is a stale copy of %s/%s, marking it missing', repo.owner.login, repo.name,
+                 node['owner']['login'], node['name'])
+        redirects.append((repo.owner.login, repo.name, target))
+        merged.append((repo.id, target))
+        deltas['repos_missing'] += 1
+        if repo.state != STATE_ERROR:
+            deltas['repos'] -= 1
+        if repo.state in STATE_STATS:
+            deltas[STATE_STATS[repo.state]] -= 1
+        repo.state = STATE_MISSING
+        repo.leased_by = repo.lease_expires = None
+
+    session.flush()
+    write_redirects(session, cache, redirects, merged)
+
+    aggregates.add(session, **deltas)
+    return repo_ids, nodes
+
+def own_login(repo, node):
+    '''`node` with our spelling of its owner's login if it is `repo`'s owner. Logins are case insensitive, and
+    keeping ours makes the node match the owner row'''
+
+    if node['owner']['login'].lower() == repo.owner.login.lower():
+        return dict(node, owner=dict(node['owner'], login=repo.owner.login))
+    return node
+
+def is_renamed(repo, node):
+    '''Whether github resolved `repo` to a fetch or marker `node` under another owner or name'''
+
+    return (node['owner']['login'].lower(), node['name'].lower()) != (repo.owner.login.lower(), repo.name.lower())
+
+def renamed_target(session, cache, repo, node, moved):
+    '''The Repo already known under the new owner and name of renamed `repo`, or None'''
+
+    login, name = node['owner']['login'], node['name']
+    log.info('%s/%s is now %s/%s', repo.owner.login, repo.name, login, name)
+    key = (login.lower(), name.lower())
+    if key in moved:
+        return moved[key]
+
+    owner_id = cache.owner_id(session, login)
+    if owner_id is not None and cache.repo_state(session, owner_id, name) is not None:
+        # Already known under the new name, and fetched (or to be) as that
+        return session.query(Repo) \
+                      .filter(Repo.owner_id == owner_id) \
+                      .filter(func.lower(Repo.name) == name.lower()) \
+                      .one()
+    return None
+
+def move_repo(session, cache, repo, node, moved):
+    '''Gives `repo` the owner and name of its `node`, and notes it in `moved`. Returns 1 if the owner is new, else 0'''
+
+    login, name = node['owner']['login'], node['name']
+    owner_id = cache.owner_id(session, login)
+    if owner_id is None:
+        repo.owner = Owner(login=login, type_id=cache.type_id(session, node['owner'].get('__typename', 'User')))
+    else:
+        repo.owner = session.get(Owner, owner_id)
+    repo.name = name
+    moved[(login.lower(), name.lower())] = repo
+    return int(owner_id is None)
+
+def write_redirects(session, cache, redirects, merged):
+    '''Points the RepoRedirects of each (repo id, repo it now is) in `merged` at the latter, and adds a RepoRedirect
+    for each (old login, old name, repo it now is) in `redirects`'''
+
+    for repo_id, target in merged:
+        session.execute(update(RepoRedirect.__table__)
+                        .where(RepoRedirect.__table__.c.repo_id == repo_id)
+                        .values(repo_id=target.id))
+    for login, name, target in redirects:
+        session.query(RepoRedirect) \
+               .filter(func.lower(RepoRedirect.owner_login) == login.lower()) \
+               .filter(func.lower(RepoRedirect.name) == name.lower()) \
+               .delete(synchronize_session=False)
+        session.add(RepoRedirect(owner_login=login, name=name, repo_id=target.id))
+        cache.note_redirect(login, name, (target.owner_id, target.name))
+
+def get_stars(node):
+    return (node.get('stargazers') or {}).get('totalCount')
+
+def fetched_columns(node, now):
+    '''Repo columns of a fetch query node'''
+
+    return {'description': node['description'],
+            'disk_usage': node['diskUsage'],
+            'url': node['url'],
+            'is_fork': node['isFork'],
+            'is_mirror': node['isMirror'],
+            'pushed_at': node.get('pushedAt'),
+            'updated_at': node.get('updatedAt'),
+            'fetched_at': now,
+            'stars': get_stars(node)}
+
+# Fetched repos start expansion with no lease or errors
+TODO_COLUMNS = {'state': STATE_TODO, 'leased_by': None, 'lease_expires': None, 'attempts': None, 'errors': None}
+
+def orm_ingest_fetched_repos(session, todos, nodes):
+    '''Fills in each fetched node's STATE_NEW repo from `todos` (or a new Repo if there is none) and its
+    RepoLanguages, one ORM object at a time, and moves it to STATE_TODO'''
+
+    repo_langs = []
+    found = 0
+    for node in nodes:
+        repo = None
+        for todo in todos:
+            if todo.name == node['name'] and todo.owner.login == node['owner']['login']:
+                repo = todo
+                found += 1
+
+        owner = session.query(Owner).filter_by(login=node['owner']['login']).one()
+        if repo is None:
+            repo = Repo(name=node['name'], owner=owner)
+        for column, value in dict(fetched_columns(node, time.time()), **TODO_COLUMNS).items():
+            setattr(repo, column, value)
+
+        for lang_edge in node.get('languages', {}).get('edges', []):
+            try:
+                lang = session.query(Language).filter_by(name=lang_edge['node']['name']).one()
+            except NoResultFound:
+                lang = Language(name=lang_edge['node']['name'], color=lang_edge['node']['color'])
+
+            repo_lang = RepoLanguages(repo=repo, language=lang, bytes_used=lang_edge['size'])
+            session.add(repo_lang)
+            repo_langs.append(repo_lang)
+
+        repo.priority = frontier.score(repo.stars, repo.sightings, owner.expansions, owner.yielded)
+        session.add(repo)
+
+    session.flush()
+    aggregates.add(session, repos=len(nodes), repos_todo=len(nodes), new_repos=-found)
+    aggregates.add_languages(session, [{'lang_id': repo_lang.language.id, 'bytes_used': repo_lang.bytes_used}
+                                       for repo_lang in repo_langs])
+
+    return len(nodes)
+
+def bulk_ingest_fetched_repos(session, todos, nodes, cache=None):
+    '''Same as orm_ingest_fetched_repos, but with one round trip per table: owners and languages are resolved with
+    a single query each, and rows are written with executemany UPDATEs and multi-row INSERTs. Nodes whose owner
+    isn't known are skipped. Returns the number of repos written'''
+
+    todo_ids = {(todo.owner.login, todo.name): todo.id for todo in todos}
+    sightings = {(todo.owner.login, todo.name): todo.sightings for todo in todos}
+
+    nodes = {(node['owner']['login'], node['name']): node for node in nodes}
+    if not nodes:
+        return 0
+
+    owner_ids = dict(session.query(Owner.login, Owner.id)
+                            .filter(Owner.login.in_({login for login, _ in nodes})))
+
+    keys = []
+    for login, name in nodes:
+        if login not in owner_ids:
+            log.warning('Fetched %s/%s, but its owner is unknown. Skipping', login, name)
+        else:
+            keys.append((login, name))
+    if not keys:
+        return 0
+
+    now = time.time()
+    priorities = frontier.priorities(session, [(owner_ids[key[0]], get_stars(nodes[key]), sightings.get(key))
+                                               for key in keys])
+    rows = {key: dict(fetched_columns(nodes[key], now), priority=priority, **TODO_COLUMNS)
+            for key, priority in zip(keys, priorities)}
+
+    found = [key for key in keys if key in todo_ids]
+    session.bulk_update_mappings(Repo, [dict(rows[key], id=todo_ids[key]) for key in found])
+
+    # Fetched without being found first, e.g. when replaying the archive into an empty database
+    inserted = insert_returning_ids(session, Repo.__table__,
+                                    [dict(rows[key], owner_id=owner_ids[key[0]], name=key[1])
+                                     for key in keys if key not in todo_ids],
+                                    'owner_id', 'name')
+    logins = {(owner_ids[login], name): (login, name) for login, name in keys}
+    login_ids = {key: todo_ids[key] for key in found}
+    login_ids.update({logins[(owner_id, name)]: repo_id for repo_id, owner_id, name in inserted})
+
+    insert_repo_languages(session, nodes, login_ids)
+
+    aggregates.add(session, repos=len(login_ids), repos_todo=len(login_ids), new_repos=-len(found))
+
+    if cache is not None:
+        cache.note_repos([(owner_ids[login], name) for login, name in login_ids], REPO_FETCHED)
+
+    return len(login_ids)
+
+def refresh_fetched_repos(session, repo_ids, nodes):
+    '''Overwrites the columns and languages of already fetched repos with their new fetch query nodes. `repo_ids`
+    maps (owner login, name) to repo id. Returns the number of repos updated'''
+
+    nodes = {(node['owner']['login'], node['name']): node for node in nodes}
+    repo_ids = {key: repo_id for key, repo_id in repo_ids.items() if key in nodes}
+    if not repo_ids:
+        return 0
+
+    now = time.time()
+    session.bulk_update_mappings(Repo, [dict(fetched_columns(nodes[key], now), id=repo_id)
+                                        for key, repo_id in repo_ids.items()])
+
+    old_langs = session.query(RepoLanguages).filter(RepoLanguages.repo_id.in_(list(repo_ids.values())))
+    aggregates.add_languages(session, [{'lang_id': lang_id, 'bytes_used': bytes_used} for lang_id, bytes_used in
+                                       old_langs.with_entities(RepoLanguages.lang_id, RepoLanguages.bytes_used)],
+                             sign=-1)
+    old_langs.delete(synchronize_session=False)
+    insert_repo_languages(session, nodes, repo_ids)
+
+    return len(repo_ids)
+
+def insert_repo_languages(session, nodes, repo_ids):
+    '''Inserts the language edges of each (owner login, name) -> node in `nodes` for the repo ids in `repo_ids`'''
+
+    lang_colors = {}
+    for key, node in nodes.items():
+        if key in repo_ids:
+            for lang_edge in node.get('languages', {}).get('edges', []):
+                lang_colors[lang_edge['node']['name']] = lang_edge['node']['color']
+    lang_ids = resolve_languages(session, lang_colors)
+
+    lang_rows = []
+    for key, node in nodes.items():
+        if key not in repo_ids:
+            continue
+        for lang_edge in node.get('languages', {}).get('edges', []):
+            lang_rows.append({'repo_id': repo_ids[key],
+                              'lang_id': lang_ids[lang_edge['node']['name']],
+                              'bytes_used': lang_edge['size']})
+    if lang_rows:
+        session.execute(insert(RepoLanguages.__table__).values(lang_rows))
+        aggregates.add_languages(session, lang_rows)
+
+def resolve_languages(session, lang_colors):
+    '''Returns name -> id for every language in `lang_colors` (name -> color), creating the missing ones'''
+
+    if not lang_colors:
+        return {}
+
+    lang_ids = dict(session.query(Language.name, Language.id).filter(Language.name.in_(lang_colors)))
+
+    missing = [{'name': name, 'color': color} for name, color in lang_colors.items() if name not in lang_ids]
+    if missing:
+        session.execute(insert_ignoring_conflicts(session, Language.__table__).values(missing))
+        lang_ids.update(session.query(Language.name, Language.id)
+                               .filter(Language.name.in_([lang['name'] for lang in missing])))
+
+    return lang_ids
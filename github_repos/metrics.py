@@ -0,0 +1,321 @@
+'''Timers, counters and histograms for the scraper loop, exposed in the Prometheus text format.
+
+Set metrics_port to serve them at http://localhost:<port>/metrics, and/or metrics_file to have the scraper loop
+rewrite that file every metrics_dump_seconds. SQL statements and session flushes and commits are timed by
+instrument_session(), queries by send_query, and loop steps and rate limit sleeps by MainScraper.start.
+
+The profiler is switched on and off while the scraper runs by writing to the profile_control file (default
+profile in log_dir), e.g. `echo cprofile 50 > logs/profile` to profile every 50th loop iteration with cProfile, or
+`echo tracemalloc 50 > logs/profile` to take a tracemalloc snapshot every 50 iterations. Profiles and snapshots are
+written next to the control file. Deleting it switches profiling off.
+'''
+
+import os
+import time
+import bisect
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import logging as _logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics():
+    '''Thread-safe registry of counters and histograms, each keyed by name and a sorted tuple of label pairs'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.last_dump = time.time()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''Observes the seconds the with block took in histogram `name`'''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        '''Every metric in the Prometheus text exposition format'''
+
+        def format_labels(labels, **extra):
+            pairs = list(labels) + sorted(extra.items())
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    if name in self.help:
+                        lines.append('# HELP {} {}'.format(name, self.help[name]))
+                    lines.append('# TYPE {} counter'.format(name))
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    if name in self.help:
+                        lines.append('# HELP {} {}'.format(name, self.help[name]))
+                    lines.append('# TYPE {} histogram'.format(name))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def maybe_dump(self, path=None, every=None):
+        '''Rewrites metrics_file if it is set and metrics_dump_seconds have passed since the last dump'''
+
+        path = path or getattr(g, 'metrics_file', None)
+        every = every if every is not None else getattr(g, 'metrics_dump_seconds', 60)
+        if path and time.time() - self.last_dump >= every:
+            self.dump(path)
+            self.last_dump = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+metrics = Metrics()
+metrics.describe('github_query_seconds', 'Time from sending a query to having its response, retries included')
+metrics.describe('github_responses_total', 'Responses by query kind and HTTP status')
+metrics.describe('json_decode_seconds', 'Time spent decoding response bodies')
+metrics.describe('db_statement_seconds', 'Time spent executing SQL statements, by operation and table')
+metrics.describe('db_flush_seconds', 'Time spent in session flushes')
+metrics.describe('db_commit_seconds', 'Time spent committing, including the final flush')
+metrics.describe('rate_limit_sleep_seconds_total',
+                 'Time spent sleeping for rate limit points, pacing the spend (paced) or for a reset (reset)')
+metrics.describe('scraper_step_seconds', 'Time spent per scraper loop step')
+metrics.describe('pipeline_wait_seconds', 'Time the pipeline writer spent waiting for parsed responses')
+
+
+def statement_labels(context):
+    '''(operation, table) of an executed statement, for db_statement_seconds'''
+
+    statement = getattr(context.compiled, 'statement', None) if context is not None else None
+    table = getattr(statement, 'table', None)
+    if table is not None and getattr(statement, 'is_dml', False):
+        return statement.__visit_name__, getattr(table, 'name', '?')
+    return 'select' if getattr(statement, 'is_select', False) else 'other', ''
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('metrics_start', None)
+    if start is None:
+        return
+    op, table = statement_labels(context)
+    metrics.observe('db_statement_seconds', time.perf_counter() - start, op=op, table=table)
+
+def _before_flush(session, flush_context, instances):
+    session.info['metrics_flush'] = time.perf_counter()
+
+def _after_flush(session, flush_context):
+    start = session.info.pop('metrics_flush', None)
+    if start is not None:
+        metrics.observe('db_flush_seconds', time.perf_counter() - start)
+
+def _before_commit(session):
+    session.info['metrics_commit'] = time.perf_counter()
+
+def _after_commit(session):
+    start = session.info.pop('metrics_commit', None)
+    if start is not None:
+        metrics.observe('db_commit_seconds', time.perf_counter() - start)
+
+def instrument_session(session):
+    '''Times the SQL statements, flushes and commits of `session` and its engine'''
+
+    engine = session.get_bind()
+    for target, name, listener in ((engine, 'before_cursor_execute', _before_cursor_execute),
+                                   (engine, 'after_cursor_execute', _after_cursor_execute),
+                                   (session, 'before_flush', _before_flush),
+                                   (session, 'after_flush_postexec', _after_flush),
+                                   (session, 'before_commit', _before_commit),
+                                   (session, 'after_commit', _after_commit)):
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+_server = None
+
+def serve_metrics(port=None, host='127.0.0.1'):
+    '''Serves /metrics on `port` (default metrics_port) in a daemon thread, once per process. Returns the server,
+    or None if no port is configured'''
+    global _server
+
+    port = port if port is not None else getattr(g, 'metrics_port', None)
+    if port is None:
+        return None
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), MetricsHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+        log.info('Serving metrics at http://%s:%d/metrics', *_server.server_address[:2])
+    return _server
+
+
+class Profiler():
+    '''Profiles every Nth call of tick() while the control file asks for it. See the module docstring'''
+
+    def __init__(self, control=None):
+        self.control = control or getattr(g, 'profile_control', None) or \
+                       os.path.join(getattr(g, 'log_dir', None) or os.path.join(os.path.dirname(__file__), 'logs'),
+                                    'profile')
+        self.mtime = None
+        self.mode = None
+        self.every = 1
+        self.iteration = 0
+        self.profile = None
+        self.snapshot = None
+
+    def read_control(self):
+        try:
+            mtime = os.stat(self.control).st_mtime
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+
+        mode, every = None, 0
+        if mtime is not None:
+            with open(self.control, encoding='utf8') as f:
+                words = f.read().split()
+            if words and words[0] in ('cprofile', 'tracemalloc'):
+                mode = words[0]
+                every = int(words[1]) if len(words) > 1 and words[1].isdigit() else 1
+            elif words:
+                log.warning('Unknown profile mode %r in %s', words[0], self.control)
+        self.switch(mode, max(1, every))
+
+    def switch(self, mode, every):
+        if mode == self.mode and every == self.every:
+            return
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile = None
+        if self.mode == 'tracemalloc' and mode != 'tracemalloc':
+            tracemalloc.stop()
+            self.snapshot = None
+        if mode == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+
+        log.info('Profiling %s', '{} every {} iterations'.format(mode, every) if mode else 'off')
+        self.mode, self.every, self.iteration = mode, every, 0
+
+    def output_path(self, extension):
+        return '{}-{}-{}-{:06d}.{}'.format(self.control, time.strftime('%Y%m%dT%H%M%S'), os.getpid(), self.iteration,
+                                           extension)
+
+    def tick(self):
+        '''Called once per scraper loop iteration'''
+
+        self.read_control()
+        if self.mode is None:
+            return
+
+        if self.profile is not None:
+            self.profile.disable()
+            path = self.output_path('prof')
+            self.profile.dump_stats(path)
+            log.info('Wrote profile of one iteration to %s', path)
+            self.profile = None
+
+        self.iteration += 1
+        if self.iteration % self.every:
+            return
+
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+        elif self.mode == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            path = self.output_path('tracemalloc')
+            snapshot.dump(path)
+            current, peak = tracemalloc.get_traced_memory()
+            log.info('Wrote tracemalloc snapshot to %s, %.1f MB traced, %.1f MB peak', path,
+                     current / 1024**2, peak / 1024**2)
+            if self.snapshot is not None:
+                for stat in snapshot.compare_to(self.snapshot, 'lineno')[:10]:
+                    log.info('    %s', stat)
+            self.snapshot = snapshot
@@ -0,0 +1,265 @@
+'''Schema migrations for changes Base.metadata.create_all and add_missing_columns can't make to existing tables.
+
+    python -m github_repos.migrations [status|upgrade]
+
+Each migration is a function of the engine, applied once in version order and recorded in schema_migrations. They
+work in chunks of migration_chunk_rows rows, each committed on its own, so tables aren't locked for long, and are
+written so that running one again after a crash carries on where it stopped. Indexes are built CONCURRENTLY on
+postgresql. A database created by the current code passes through every migration without changes.
+
+MainScraper applies pending migrations when it starts. With several scrapers sharing a database, stop them all,
+upgrade, and start them again.
+'''
+
+import sys
+import time
+import logging as _logging
+
+from sqlalchemy import MetaData, Table, inspect, select, update, delete, func, bindparam, and_, text
+from sqlalchemy.schema import CreateIndex
+
+from github_repos.db import default_engine, Session, Repo, Owner, RepoLanguages, Stat, SchemaMigration
+from github_repos.db import insert_ignoring_conflicts
+from github_repos.db import STATE_NEW, STATE_TODO, STATE_EXPANDED, STATE_ERROR
+from github_repos import aggregates, setup_logging
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+
+def create_index(engine, index):
+    '''Creates `index` unless it exists, without blocking writes on postgresql'''
+
+    if engine.dialect.name == 'postgresql':
+        index.dialect_kwargs['postgresql_concurrently'] = True
+        try:
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        finally:
+            index.dialect_kwargs['postgresql_concurrently'] = False
+    else:
+        with engine.begin() as conn:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+
+def rebuild_index(engine, table, name):
+    '''Drops index `name` and creates it again as `table` (a model) defines it, without blocking writes on
+    postgresql'''
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS ' + name))
+    else:
+        with engine.begin() as conn:
+            conn.execute(text('DROP INDEX IF EXISTS ' + name))
+    create_index(engine, next(index for index in table.__table__.indexes if index.name == name))
+
+def column_sorting(engine, table, name):
+    '''column -> ('desc', 'nulls_first'...) of index `name` on `table` (a model) as it is in the database'''
+
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            return {row[2]: ('desc',) for row in conn.exec_driver_sql('PRAGMA index_xinfo({})'.format(name))
+                    if row[2] is not None and row[3]}
+    existing = {index['name']: index for index in inspect(engine).get_indexes(table.__tablename__)}
+    return existing.get(name, {}).get('column_sorting', {})
+
+def old_table(engine, name):
+    '''The table `name` as it is in the database, or None if it isn't there (any more)'''
+
+    if not inspect(engine).has_table(name):
+        return None
+    return Table(name, MetaData(), autoload_with=engine, resolve_fks=False)
+
+def move_rows(engine, source, chunk, move):
+    '''Calls move(conn, rows) for the rows of `source`, `chunk` at a time in id order, and deletes them from
+    `source` in the same transaction. Returns the number of rows moved'''
+
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select(source).order_by(source.c.id).limit(chunk)).all()
+            if not rows:
+                return total
+            move(conn, rows)
+            conn.execute(delete(source).where(source.c.id.in_([row.id for row in rows])))
+        total += len(rows)
+        log.info('Moved %d rows of %s', total, source.name)
+
+
+def consolidate_repos(engine, chunk):
+    '''Moves new_repos, repos_todo and repo_errors into repositories.state, then drops them'''
+
+    repos = Repo.__table__
+    session = Session(bind=engine)
+
+    # Case variants of a name can't share the unique index. Keep the first row of each
+    lower_name = func.lower(repos.c.name)
+    duplicates = select(repos.c.owner_id, lower_name.label('lower_name'), func.min(repos.c.id).label('keep')) \
+                 .group_by(repos.c.owner_id, lower_name) \
+                 .having(func.count() > 1) \
+                 .subquery()
+    with engine.begin() as conn:
+        extra_ids = [repo_id for repo_id, in conn.execute(
+            select(repos.c.id).join(duplicates, and_(repos.c.owner_id == duplicates.c.owner_id,
+                                                     lower_name == duplicates.c.lower_name,
+                                                     repos.c.id != duplicates.c.keep)))]
+        if extra_ids:
+            log.warning('Deleting %d repos whose names only differ in case from an older repo', len(extra_ids))
+            for name in ('repos_todo', 'repo_errors'):
+                table = old_table(engine, name)
+                if table is not None:
+                    conn.execute(delete(table).where(table.c.repo_id.in_(extra_ids)))
+            conn.execute(delete(RepoLanguages.__table__).where(RepoLanguages.repo_id.in_(extra_ids)))
+            conn.execute(delete(repos).where(repos.c.id.in_(extra_ids)))
+
+    for index in repos.indexes:
+        if index.name == 'ux_repositories_owner_lower_name':
+            create_index(engine, index)
+
+    repo_errors = old_table(engine, 'repo_errors')
+    if repo_errors is not None:
+        move_rows(engine, repo_errors, chunk, lambda conn, rows: conn.execute(
+            update(repos).where(repos.c.id == bindparam('repo')).values(state=STATE_ERROR, errors=bindparam('text')),
+            [{'repo': row.repo_id, 'text': row.error_text} for row in rows]))
+
+    repos_todo = old_table(engine, 'repos_todo')
+    if repos_todo is not None:
+        # Older tables may lack the later columns, hence the getattrs
+        move_rows(engine, repos_todo, chunk, lambda conn, rows: conn.execute(
+            update(repos).where(repos.c.id == bindparam('repo'))
+                         .values(state=STATE_TODO,
+                                 leased_by=bindparam('worker'), lease_expires=bindparam('expires'),
+                                 attempts=bindparam('tries'), errors=bindparam('text'),
+                                 sightings=bindparam('seen'), priority=bindparam('score')),
+            [{'repo': row.repo_id, 'worker': getattr(row, 'leased_by', None),
+              'expires': getattr(row, 'lease_expires', None), 'tries': getattr(row, 'attempts', None),
+              'text': getattr(row, 'errors', None), 'seen': getattr(row, 'sightings', None),
+              'score': getattr(row, 'priority', None)} for row in rows]))
+
+    # Every other repo already in the table was fetched and expanded
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [repo_id for repo_id, in conn.execute(select(repos.c.id)
+                                                        .where(repos.c.state.is_(None))
+                                                        .order_by(repos.c.id)
+                                                        .limit(chunk))]
+            if not ids:
+                break
+            conn.execute(update(repos).where(repos.c.id.in_(ids)).values(state=STATE_EXPANDED))
+        total += len(ids)
+        log.info('Marked %d repos expanded', total)
+
+    new_repos = old_table(engine, 'new_repos')
+    if new_repos is not None:
+        move_rows(engine, new_repos, chunk, lambda conn, rows: conn.execute(
+            insert_ignoring_conflicts(session, repos).values(
+                [{'owner_id': row.owner_id, 'name': row.name, 'state': STATE_NEW,
+                  'leased_by': getattr(row, 'leased_by', None), 'lease_expires': getattr(row, 'lease_expires', None),
+                  'attempts': getattr(row, 'attempts', None), 'errors': getattr(row, 'errors', None),
+                  'sightings': getattr(row, 'sightings', None)} for row in rows if row.owner_id is not None])))
+
+    for index in repos.indexes:
+        create_index(engine, index)
+    with engine.begin() as conn:
+        # Replaced by ix_repositories_fetched_at_not_new
+        conn.execute(text('DROP INDEX IF EXISTS ix_repositories_fetched_at'))
+        for table in (repo_errors, repos_todo, new_repos):
+            if table is not None:
+                table.drop(conn)
+
+    if repo_errors is not None or repos_todo is not None or new_repos is not None:
+        aggregates.rebuild(session)
+    session.close()
+
+def todo_index_nulls_first(engine, chunk):
+    '''Rebuilds ix_repositories_todo_priority_id with NULLS FIRST on postgresql, so that reading it backwards
+    claims todos not scored yet last'''
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    name = 'ix_repositories_todo_priority_id'
+    if 'nulls_first' not in column_sorting(engine, Repo, name).get('priority', ()):
+        rebuild_index(engine, Repo, name)
+
+def owner_lower_login_index(engine, chunk):
+    '''Indexes owners by lowercase login'''
+
+    create_index(engine, next(index for index in Owner.__table__.indexes if index.name == 'ix_owners_lower_login'))
+
+def todo_index_id_desc(engine, chunk):
+    '''Rebuilds ix_repositories_todo_priority_id with id descending, so that reading it backwards claims todos of
+    equal priority oldest first'''
+
+    name = 'ix_repositories_todo_priority_id'
+    if 'desc' not in column_sorting(engine, Repo, name).get('id', ()):
+        rebuild_index(engine, Repo, name)
+
+def recount_repos(engine, chunk):
+    '''Recounts the repos total, which no longer counts repos in STATE_ERROR'''
+
+    session = Session(bind=engine)
+    model, criterion = aggregates.STATS['repos']
+    count = session.query(func.count()).select_from(model).filter(criterion).scalar()
+    session.query(Stat).filter_by(name='repos').update({Stat.value: count}, synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+MIGRATIONS = (
+    (1, 'Single repositories table with a state column', consolidate_repos),
+    (2, 'Todo priority index with NULLS FIRST', todo_index_nulls_first),
+    (3, 'Owners indexed by lowercase login', owner_lower_login_index),
+    (4, 'Todo priority index with id descending', todo_index_id_desc),
+    (5, 'Repos total without error repos', recount_repos),
+)
+
+
+def applied(engine):
+    '''version -> applied_at of every migration recorded in `engine`'s database'''
+
+    with engine.connect() as conn:
+        return dict(conn.execute(select(SchemaMigration.version, SchemaMigration.applied_at)).all())
+
+def upgrade(engine=None, chunk=None):
+    '''Applies every pending migration to `engine` (default db_url's) in order. Returns the number applied'''
+
+    engine = engine or default_engine()
+    chunk = chunk or getattr(g, 'migration_chunk_rows', 10000)
+    done = applied(engine)
+    count = 0
+    for version, name, migrate in MIGRATIONS:
+        if version in done:
+            continue
+
+        log.info('Applying migration %d: %s', version, name)
+        start = time.time()
+        migrate(engine, chunk)
+        with engine.begin() as conn:
+            conn.execute(insert_ignoring_conflicts(Session(bind=engine), SchemaMigration.__table__)
+                         .values(version=version, name=name, applied_at=time.time()))
+        log.info('Applied migration %d in %.1f seconds', version, time.time() - start)
+        count += 1
+    return count
+
+
+def main(argv):
+    if argv not in ([], ['status'], ['upgrade']):
+        print(__doc__)
+        return 1
+
+    if argv == ['upgrade']:
+        upgrade()
+        return 0
+
+    done = applied(default_engine())
+    for version, name, _ in MIGRATIONS:
+        print('{:4d} {:<10} {}'.format(version, time.strftime('%Y-%m-%d', time.localtime(done[version]))
+                                       if version in done else 'pending', name))
+    return 0
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
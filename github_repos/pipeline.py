@@ -0,0 +1,365 @@
+'''Pipelined scraper loop, where sending queries, parsing responses and writing results run as separate stages
+connected by bounded queues:
+
+    writer --requests--> sender threads --responses--> parser thread --parsed--> writer
+
+The writer is the thread calling Pipeline.run, and the only one touching the scraper's session and identity cache.
+It claims expand and fetch batches, builds their queries and queues them for the senders, which keep up to
+`concurrency` queries in flight. The parser turns responses into the repos and nodes to write, and the writer
+applies everything parsed so far in one transaction, so the next queries are already in flight while the previous
+results are being persisted.
+
+The writer only claims more work while fewer than `depth` batches are in the pipeline. When the database falls
+behind, parsed batches wait for it and no new queries are sent until they are written. Fetch batches that failed,
+with scraper_fetch_bisect, go back through the pipeline in halves ahead of any new claims, like
+MainScraper.fetch_batch does.
+'''
+
+import queue
+import collections
+import threading
+import logging as _logging
+
+from github_repos.graphql import templates
+from github_repos.costmodel import EXPAND, FETCH
+from github_repos.metrics import metrics, serve_metrics
+from github_repos.ingest import resolve_fetched_nodes, orm_ingest_fetched_repos, bulk_ingest_fetched_repos
+from github_repos.scraper import send_query, batch_variables, build_fetch_query, build_expand_batch_query
+from github_repos.scraper import get_repos_from_expand_result, split_expand_result, get_batch_data
+from github_repos.scraper import batch_aliases, failed_aliases, fetch_batches, MAX_FETCH_ERRORS
+from github_repos.scraper import RateLimit, GithubTimeout, EmptyResultError, MaxErrors
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+
+def other_kind(kind):
+    return FETCH if kind == EXPAND else EXPAND
+
+
+class Job():
+    '''One claimed batch of todos on its way through the pipeline'''
+
+    def __init__(self, kind, todos, query, variables, token, cost, aliases=None):
+        self.kind = kind
+        # Set on the halves of a failed fetch
+        self.bisecting = False
+        self.todos = todos
+        self.ids = [todo.id for todo in todos]
+        self.query = query
+        self.variables = variables
+        self.token = token
+        self.cost = cost
+        self.aliases = aliases
+
+        # Filled in by the sender and parser
+        self.result = None
+        self.data = None
+        self.error = None
+        self.expansions = []
+        self.failures = []
+        self.failed = set()
+
+
+class Pipeline():
+    def __init__(self, scraper, concurrency=None, depth=None, write_batch=None):
+        self.scraper = scraper
+        self.session = scraper.session
+        self.concurrency = concurrency or scraper.concurrency
+        self.depth = max(depth or getattr(g, 'scraper_pipeline_depth', None) or 2 * self.concurrency,
+                         self.concurrency)
+        self.write_batch = write_batch or getattr(g, 'scraper_write_batch', self.depth)
+
+        self.requests = queue.Queue(self.depth)
+        self.responses = queue.Queue(self.depth)
+        self.parsed = queue.Queue(self.depth)
+        self.senders = []
+        self.parser_thread = None
+
+        self.outstanding = {}
+        # Leased todos of failed fetches, waiting to be sent again in smaller batches
+        self.retries = collections.deque()
+        self.next_kind = EXPAND
+        self.rate_limited = None
+
+    def run(self):
+        '''Expands and fetches until there is nothing left to claim and nothing in flight'''
+
+        log.info('Starting pipelined scraper loop with %d senders and up to %d batches in flight',
+                 self.concurrency, self.depth)
+        serve_metrics()
+        self.scraper.frontier.backfill(self.session)
+        self.scraper.requeue_missing_repos()
+
+        self.senders = [threading.Thread(target=self.sender, name='sender-%d' % i, daemon=True)
+                        for i in range(self.concurrency)]
+        self.parser_thread = threading.Thread(target=self.parser, name='parser', daemon=True)
+        for thread in self.senders + [self.parser_thread]:
+            thread.start()
+
+        try:
+            while True:
+                self.scraper.profiler.tick()
+                metrics.maybe_dump()
+
+                self.fill()
+                if not self.outstanding:
+                    if self.rate_limited is None:
+                        log.info('No repos to expand or fetch')
+                        return
+                    cost, self.rate_limited = self.rate_limited, None
+                    self.scraper.rate_limit_sleep(cost)
+                    continue
+
+                with metrics.timer('pipeline_wait_seconds'):
+                    jobs = [self.parsed.get()]
+                while len(jobs) < self.write_batch:
+                    try:
+                        jobs.append(self.parsed.get_nowait())
+                    except queue.Empty:
+                        break
+
+                with metrics.timer('scraper_step_seconds', step='write'):
+                    self.write(jobs)
+
+        except Exception as e:
+            log.error(e)
+            self.session.rollback()
+            raise e
+
+        finally:
+            self.stop()
+
+
+    def fill(self):
+        '''Claims and queues batches until `depth` are in the pipeline, no token has points for the next one or
+        there is nothing left to claim'''
+
+        # A paced token may have refilled while earlier batches were in flight
+        if self.rate_limited is not None and self.scraper.tokens.wait_time(self.rate_limited) <= 0:
+            self.rate_limited = None
+
+        while len(self.outstanding) < self.depth and self.rate_limited is None:
+            if self.retries:
+                job = self.make_job(FETCH, self.retries.popleft())
+                if job is None:
+                    continue
+                job.bisecting = True
+                jobs = [job]
+            else:
+                room = self.depth - len(self.outstanding)
+                jobs = self.claim(self.next_kind, room) or self.claim(other_kind(self.next_kind), room)
+                if not jobs:
+                    return
+                # Alternate like MainScraper.start does
+                self.next_kind = other_kind(jobs[0].kind)
+
+            for job in jobs:
+                self.outstanding[id(job)] = job
+                self.requests.put(job)
+
+    def claim(self, kind, n):
+        '''Claims up to `n` batches of `kind` in one go and reserves their points. Returns their Jobs, which are
+        fewer if there wasn't enough to claim or no token has enough points'''
+
+        scraper = self.scraper
+        work = self.work_queue(kind)
+        if kind == EXPAND:
+            batch_size = scraper.expand_batch_size()
+        else:
+            batch_size = scraper.cost_model.best_batch_size(FETCH, scraper.fetch_batch_limit(),
+                                                            scraper.rate_limit_remaining)
+        if batch_size < 1:
+            self.rate_limited = scraper.cost_model.predict(kind, 1)
+            return []
+
+        todos = work.claim(batch_size * n)
+        if kind == EXPAND:
+            batches = [todos[start:start + batch_size] for start in range(0, len(todos), batch_size)]
+        else:
+            batches = fetch_batches(todos, batch_size)
+
+        jobs = []
+        for i, batch in enumerate(batches):
+            job = self.make_job(kind, batch)
+            if job is None:
+                work.release([todo for rest in batches[i + 1:] for todo in rest])
+                break
+            jobs.append(job)
+        return jobs
+
+    def make_job(self, kind, todos):
+        '''A Job for the leased `todos`, with its points reserved. If no token has them, releases the todos, marks
+        the pipeline rate limited and returns None'''
+
+        scraper = self.scraper
+        cost = scraper.cost_model.predict(kind, len(todos))
+        token = scraper.tokens.acquire(cost)
+        if token is None:
+            self.work_queue(kind).release(todos)
+            self.rate_limited = cost
+            return None
+
+        if kind == EXPAND:
+            log.info('Expanding %d repos...', len(todos))
+            query, variables, aliases = build_expand_batch_query(todos, self.scraper.expand_shape)
+            return Job(kind, todos, query, variables, token, cost, aliases)
+
+        log.info('Fetching %d repos...', len(todos))
+        template = templates.get(('fetch', len(todos)), lambda: build_fetch_query(len(todos)))
+        variables = batch_variables((todo.owner.login, todo.name) for todo in todos)
+        return Job(kind, todos, template.text, variables, token, cost)
+
+    def work_queue(self, kind):
+        return self.scraper.todo_queue if kind == EXPAND else self.scraper.new_repo_queue
+
+    def sender(self):
+        while True:
+            job = self.requests.get()
+            if job is None:
+                return
+            try:
+                job.result = send_query(job.query, job.variables, url=self.scraper.api_url, api_key=job.token.key)
+            except Exception as e:
+                job.error = e
+            self.responses.put(job)
+
+    def parser(self):
+        while True:
+            job = self.responses.get()
+            if job is None:
+                return
+            if job.error is None:
+                try:
+                    self.parse(job)
+                except Exception as e:
+                    job.error = e
+            self.parsed.put(job)
+
+    def parse(self, job):
+        '''Turns the response of `job` into what write() needs, like expand_repos_batched and fetch_new_repo_info'''
+
+        job.data = job.result['data']
+        if job.kind == EXPAND:
+            for alias, todo in job.aliases.items():
+                try:
+                    job.expansions.append(
+                        (todo,) + get_repos_from_expand_result(split_expand_result(job.result, alias), todo))
+                except (GithubTimeout, EmptyResultError) as e:
+                    job.failures.append(e)
+        else:
+            # Matched up with the todos by resolve_fetched_nodes, which needs the session
+            get_batch_data(job.result, job.todos)
+            job.failed = failed_aliases(job.result)
+
+    def write(self, jobs):
+        '''Writes every parsed job in one transaction, then deals with the ones that failed'''
+
+        scraper = self.scraper
+        expansions = []
+        for job in jobs:
+            if job.error is not None:
+                continue
+
+            if job.kind == FETCH:
+                todos, nodes = resolve_fetched_nodes(self.session, job.todos, job.data, scraper.cache, job.failed)
+                if scraper.bulk_ingest:
+                    bulk_ingest_fetched_repos(self.session, todos, nodes, scraper.cache)
+                else:
+                    orm_ingest_fetched_repos(self.session, todos, nodes)
+            expansions.extend(job.expansions)
+            scraper.update_rate_limit(job.data, job.cost, job.kind, len(job.todos), job.token)
+
+        # Commits the fetches along with the expansions
+        scraper.write_expansions(expansions)
+        self.session.commit()
+        log.info('Wrote %d batches', len(jobs))
+
+        for job in jobs:
+            del self.outstanding[id(job)]
+            scraper.tokens.release(job.token, job.cost)
+            for e in job.failures:
+                scraper.record_expand_error(e)
+
+            retry = {todo.id for todo in self.retry_fetch(job)}
+            if job.kind == FETCH or job.error is not None:
+                # Whatever wasn't fetched or expanded, and isn't tried again right away, goes back to the queue
+                self.work_queue(job.kind).release([todo_id for todo_id in job.ids if todo_id not in retry])
+
+            if isinstance(job.error, RateLimit):
+                scraper.tokens.exhaust(job.token)
+                self.rate_limited = max(self.rate_limited or 0, job.cost)
+
+            elif job.kind == FETCH and isinstance(job.error, (GithubTimeout, EmptyResultError)):
+                if scraper.fetch_bisect:
+                    continue
+                scraper.fetch_errors += 1
+                log.error('Error count for fetching is %d', scraper.fetch_errors)
+                if scraper.fetch_errors > MAX_FETCH_ERRORS:
+                    raise MaxErrors()
+
+            elif job.error is not None:
+                raise job.error
+
+    def retry_fetch(self, job):
+        '''With scraper_fetch_bisect, queues the todos of a fetch `job` that failed, all of them if its query did,
+        to be fetched again in two halves, or counts the failure of a single todo. Without it, only counts the
+        failures of todos that failed while the rest of their query came back. Returns the todos queued'''
+
+        scraper = self.scraper
+        if job.kind != FETCH:
+            return []
+
+        if not scraper.fetch_bisect:
+            if job.error is None:
+                # Failed on their own, the rest of the query came back
+                failed = [todo for alias, todo in batch_aliases(job.todos) if alias in job.failed]
+                for todo in failed:
+                    scraper.record_fetch_error(GithubTimeout(job.result.get('errors'), todo), todo)
+            return []
+
+        if isinstance(job.error, (GithubTimeout, EmptyResultError)):
+            scraper.note_fetch_result(False)
+            if not job.bisecting:
+                scraper.note_fetch_failure(len(job.todos))
+            todos, error = job.todos, job.error
+        elif job.error is None:
+            scraper.note_fetch_result(True)
+            todos = [todo for alias, todo in batch_aliases(job.todos) if alias in job.failed]
+            error = GithubTimeout(job.result.get('errors'), todos)
+        else:
+            return []
+
+        if len(todos) == 1:
+            scraper.record_fetch_error(error, todos[0])
+            return []
+
+        half = (len(todos) + 1) // 2
+        self.retries.extend(part for part in (todos[:half], todos[half:]) if part)
+        return todos
+
+    def stop(self):
+        '''Stops the threads and gives back the leases and points of every batch that wasn't written'''
+
+        while True:
+            try:
+                self.requests.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.senders:
+            self.requests.put(None)
+        for thread in self.senders:
+            thread.join()
+        if self.parser_thread is not None:
+            self.responses.put(None)
+            self.parser_thread.join()
+        self.senders = []
+        self.parser_thread = None
+
+        for job in self.outstanding.values():
+            self.scraper.tokens.release(job.token, job.cost)
+            self.work_queue(job.kind).release(job.ids)
+        self.outstanding.clear()
+        while self.retries:
+            self.work_queue(FETCH).release(self.retries.popleft())
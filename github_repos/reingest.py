@@ -0,0 +1,46 @@
+'''Replays the raw responses in the archive into the database without sending any queries, e.g. after a schema
+change or a parsing fix.
+
+    python -m github_repos.reingest [since] [until]
+
+`since` and `until` are YYYY-MM-DD dates or unix times.
+'''
+
+import sys
+import time
+import calendar
+import logging as _logging
+
+from github_repos.archive import Archive
+from github_repos.scraper import MainScraper
+from github_repos import setup_logging
+
+
+log = _logging.getLogger(__name__)
+
+
+def parse_time(arg):
+    try:
+        return float(arg)
+    except ValueError:
+        return calendar.timegm(time.strptime(arg, '%Y-%m-%d'))
+
+def main(argv):
+    if len(argv) > 2 or any(arg in ('-h', '--help') for arg in argv):
+        print(__doc__)
+        return 1
+
+    since = parse_time(argv[0]) if len(argv) > 0 else None
+    until = parse_time(argv[1]) if len(argv) > 1 else None
+
+    start = time.perf_counter()
+    counts = MainScraper().reingest(Archive(), since, until)
+    elapsed = time.perf_counter() - start
+
+    log.info('Replayed %d responses in %.1f seconds: %s', sum(counts.values()), elapsed,
+             ', '.join('{} {}'.format(count, kind) for kind, count in sorted(counts.items())))
+    return 0
+
+if __name__ == '__main__':
+    setup_logging()
+    sys.exit(main(sys.argv[1:]))
@@ -1,17 +1,35 @@
+import re
 import json
 import time
 import calendar
 import sys
+import collections
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import logging as _logging
 
-import requests
-from sqlalchemy import exists
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import or_, func
 
+from github_repos.graphql import Node, Query, Fragment, Spread, Var, Enum, templates
 from github_repos.db import Session
-from github_repos.db import Repo, NewRepo, ReposTodo, RepoError
-from github_repos.db import Owner, OwnerType
-from github_repos.db import RepoLanguages, Language, QueryCost
+from github_repos.db import Repo, STATE_NEW, STATE_TODO, STATE_EXPANDED, STATE_ERROR, STATE_MISSING
+from github_repos.db import Owner
+from github_repos.db import QueryCost, insert_missing
+from github_repos.cache import identity_cache, REPO_FOUND
+from github_repos.costmodel import CostModel, EXPAND, FETCH, REFRESH, PRIORS
+from github_repos.tokens import TokenPool
+from github_repos.transport import get_transport, is_json
+from github_repos.streaming import StreamedResult
+from github_repos.workqueue import LeaseQueue
+from github_repos.frontier import frontier
+from github_repos import aggregates, migrations
+from github_repos.archive import get_archive
+from github_repos.edges import get_edge_log, USER_RELATIONS, REPO_RELATIONS
+from github_repos.metrics import metrics, instrument_session, serve_metrics, Profiler
+from github_repos.ingest import get_fetched_nodes, orm_ingest_fetched_repos, bulk_ingest_fetched_repos
+from github_repos.ingest import refresh_fetched_repos, resolve_fetched_pairs, resolve_refetched_pairs, fetched_pairs
+from github_repos.ingest import is_renamed, own_login
 import github_repos.config as g
 
 
@@ -19,6 +37,8 @@ log = _logging.getLogger(__name__)
 
 MAX_EXPAND_ERRORS = 2
 MAX_FETCH_ERRORS = 30
+# Times a repo may fail to fetch on its own before it moves to STATE_ERROR
+MAX_FETCH_ATTEMPTS = 3
 class MaxErrors(RuntimeError):
     pass
 
@@ -38,7 +58,9 @@ class GraphQLException(RuntimeError):
     pass
 
 class RateLimit(RuntimeError):
-    pass
+    def __init__(self, cost=None):
+        RuntimeError.__init__(self, 'Rate limited' if cost is None else 'No token has {} points left'.format(cost))
+        self.cost = cost
 
 
 POPULAR_REPOS_QUERY = '''\
@@ -59,140 +81,428 @@ query {
   }
 }'''
 
-EXPAND_COST_GUESS = 1300
-EXPAND_QUERY = '''\
-query($owner:String!, $name:String!) {
-  repository(owner: $owner, name: $name) {
-    mentionableUsers(first: 5) {
-      nodes {
-        ...userExpand
-      }
-    }
-    stargazers(first: 5, orderBy: {field: STARRED_AT, direction: DESC}) {
-      nodes {
-        ...userExpand
-      }
-    }
-    watchers(first: 5) {
-      nodes {
-        ...userExpand
-      }
-    }
-  }
-  rateLimit {
-    cost
-    remaining
-    resetAt
-  }
-}
+POPULAR = 'popular'
+
+MAX_QUERY_NODES = 500000
+
+RATE_LIMIT_NODE = Node('rateLimit')('cost', 'remaining', 'resetAt')
+
+# Connections expansion can follow, by the name expand_flag() turns each on with: the fragment and field it is
+# in, and the `first:` it asks for unless scraper_expand_sizes says otherwise
+EXPAND_CONNECTIONS = collections.OrderedDict((
+    ('repo_contributors', ('repoExpand', 'mentionableUsers', 5)),
+    ('repo_stars', ('repoExpand', 'stargazers', 5)),
+    ('repo_watchers', ('repoExpand', 'watchers', 5)),
+    ('repo_issues_participants', ('repoExpand', 'issues', 5)),
+    ('repo_pullrequest_participants', ('repoExpand', 'pullRequests', 5)),
+    ('user_contributions', ('userExpand', 'contributedRepositories', 10)),
+    ('user_issues', ('userExpand', 'issues', 20)),
+    ('user_pullrequests', ('userExpand', 'pullRequests', 20)),
+    ('user_stars', ('userExpand', 'starredRepositories', 20)),
+))
+# Participants asked for per issue or pull request of an expanded repo
+EXPAND_PARTICIPANTS = 5
+# Their cost is multiplied by the participants of every issue or pull request, so they have to be turned on
+EXPAND_OFF_BY_DEFAULT = ('repo_issues_participants', 'repo_pullrequest_participants')
+# Flags that aren't scraper_expand_<connection>. The participant flags were renamed because the example config used
+# to set the old names to True while nothing read them, and honouring those configs would quadruple crawl cost
+EXPAND_FLAGS = {'repo_issues_participants': 'scraper_expand_issue_participants',
+                'repo_pullrequest_participants': 'scraper_expand_pullrequest_participants'}
+# Old flag names, ignored, by the flag that replaced them
+RENAMED_EXPAND_FLAGS = {'scraper_expand_repo_issues_participants': 'scraper_expand_issue_participants',
+                        'scraper_expand_repo_pullrequest_participants': 'scraper_expand_pullrequest_participants'}
+
+def expand_flag(name):
+    '''The config flag that turns connection `name` of EXPAND_CONNECTIONS on or off'''
+
+    return EXPAND_FLAGS.get(name, 'scraper_expand_' + name)
+
+def warn_renamed_expand_flags(config=g):
+    '''Logs a warning for each old participant flag `config` still turns on, since it no longer does anything'''
+
+    for old, new in RENAMED_EXPAND_FLAGS.items():
+        if getattr(config, old, False):
+            log.warning('%s = True is ignored. Following issue and pull request participants multiplies the cost of '
+                        'every expansion about 4x; set %s = True to do it anyway', old, new)
+
+def expand_shape(config=g):
+    '''The ((connection, first), ...) the expand_flag()s and scraper_expand_sizes of `config` ask expansion to
+    follow, with ('participants', first) last if it follows any. `config` None gives the defaults'''
+
+    sizes = {name: first for name, (_, _, first) in EXPAND_CONNECTIONS.items()}
+    sizes['participants'] = EXPAND_PARTICIPANTS
+    sizes.update(getattr(config, 'scraper_expand_sizes', {}))
+
+    shape = [(name, sizes[name]) for name in EXPAND_CONNECTIONS
+             if getattr(config, expand_flag(name), name not in EXPAND_OFF_BY_DEFAULT) and sizes[name] > 0]
+    if any(name in EXPAND_OFF_BY_DEFAULT for name, _ in shape):
+        shape.append(('participants', sizes['participants']))
+    return tuple(shape)
+
+DEFAULT_EXPAND_SHAPE = expand_shape(None)
+
+def shape_key(shape):
+    '''The string QueryCost.shape records expand costs of `shape` under, like contributors:10,stars:10'''
+
+    return ','.join('{}:{}'.format(name, first) for name, first in shape)
+
+def build_expand_fragments(shape):
+    '''Fragments of an expand query following the connections in `shape`, leaving out what they don't use'''
+
+    first = dict(shape)
+
+    # Connection `name` of EXPAND_CONNECTIONS with `node` under its nodes, or None if `shape` doesn't follow it
+    def connection(name, node, **args):
+        if name in first:
+            return Node(EXPAND_CONNECTIONS[name][1], first=first[name], **args)(Node('nodes')(node))
+
+    def participants(name):
+        return connection(name, Node('participants', first=first.get('participants'))(
+            Node('nodes')(Spread('userExpand'))), orderBy={'field': Enum('COMMENTS'), 'direction': Enum('DESC')})
+
+    repo_fields = [
+        connection('repo_contributors', Spread('userExpand')),
+        connection('repo_stars', Spread('userExpand'),
+                   orderBy={'field': Enum('STARRED_AT'), 'direction': Enum('DESC')}),
+        connection('repo_watchers', Spread('userExpand')),
+        participants('repo_issues_participants'),
+        participants('repo_pullrequest_participants')]
+    user_fields = [
+        connection('user_contributions', Spread('repoInfo'), privacy=Enum('PUBLIC'),
+                   orderBy={'field': Enum('STARGAZERS'), 'direction': Enum('DESC')}),
+        connection('user_issues', Node('repository')(Spread('repoInfo')),
+                   orderBy={'field': Enum('COMMENTS'), 'direction': Enum('DESC')}),
+        connection('user_pullrequests', Node('repository')(Spread('repoInfo'))),
+        connection('user_stars', Spread('repoInfo'), orderBy={'field': Enum('STARRED_AT'), 'direction': Enum('DESC')})]
+
+    return (
+        Fragment('repoExpand', 'Repository')(
+            # Which repo this is, for the edge log
+            'name',
+            Node('owner')('login'),
+            *repo_fields),
+
+        Fragment('userExpand', 'User')(
+            'login',
+            *user_fields),
+
+        Fragment('repoInfo', 'Repository')(
+            'name',
+            Node('owner')('__typename', 'login')),
+    )
+
+def build_expand_query(n=None, shape=None):
+    '''Query expanding one repo given as $owner/$name, or, given `n`, n repos given as $owner1/$name1..., following
+    the connections in `shape` (by default the configured expand_shape())'''
+
+    fragments = build_expand_fragments(expand_shape() if shape is None else shape)
+    if n is None:
+        return Query(variables={'owner': 'String!', 'name': 'String!'}, fragments=fragments)(
+            Node('repository', owner=Var('owner'), name=Var('name'))(Spread('repoExpand')),
+            RATE_LIMIT_NODE)
+
+    return build_batch_query(n, 'repoExpand', fragments)
+
+def build_batch_query(n, fragment_name, fragments):
+    '''Query with n aliased repository(owner: $ownerN, name: $nameN) lookups, repo1 to repoN, each selecting
+    `fragment_name`'''
+
+    variables = collections.OrderedDict()
+    repos = []
+    for i in range(1, n + 1):
+        variables['owner%d' % i] = 'String!'
+        variables['name%d' % i] = 'String!'
+        repos.append(Node('repo%d' % i, 'repository', owner=Var('owner%d' % i), name=Var('name%d' % i))(
+            Spread(fragment_name)))
+
+    return Query(variables=variables, fragments=fragments)(*repos)(RATE_LIMIT_NODE)
+
+def batch_variables(pairs):
+    '''Variables for build_batch_query from (owner login, repo name) pairs'''
+
+    variables = {}
+    for i, (owner, name) in enumerate(pairs, 1):
+        variables['owner%d' % i] = owner
+        variables['name%d' % i] = name
+    return variables
+
+EXPAND_QUERY = build_expand_query().format()
+
+def expand_template(n=None, shape=None):
+    '''The cached Template of build_expand_query(n, shape)'''
+
+    shape = expand_shape() if shape is None else shape
+    return templates.get(('expand', n, shape), lambda: build_expand_query(n, shape))
+
+def expand_cost_prior(shape):
+    '''(intercept, slope, typical batch size) of the expand cost prior for `shape`: the default one's, scaled by how
+    many connection requests `shape` makes next to DEFAULT_EXPAND_SHAPE'''
+
+    intercept, slope, scale = PRIORS[EXPAND]
+    ratio = expand_template(1, shape).requests / expand_template(1, DEFAULT_EXPAND_SHAPE).requests
+    return intercept, slope * ratio, scale
+
+def expand_shape_of(query):
+    '''The shape the text of expand query `query` was built from'''
+
+    fragments = dict(re.findall(r'^fragment (\w+) on \w+ (.*)$', query, re.M))
+    first = {}
+    for name, (fragment, key, _) in EXPAND_CONNECTIONS.items():
+        match = re.search(r'\b%s \(first: (\d+)' % key, fragments.get(fragment, ''))
+        if match:
+            first[name] = int(match.group(1))
+    match = re.search(r'\bparticipants \(first: (\d+)', fragments.get('repoExpand', ''))
+    if match:
+        first['participants'] = int(match.group(1))
+
+    return tuple((name, first[name]) for name in list(EXPAND_CONNECTIONS) + ['participants'] if name in first)
+
+MAX_FETCH_BATCH = 500
+FETCH_FRAGMENTS = (
+    Fragment('repoInfo', 'Repository')(
+        'name',
+        Node('owner')('__typename', 'login'),
+        'description',
+        'diskUsage',
+        'url',
+        'isFork',
+        'isMirror',
+        'pushedAt',
+        'updatedAt',
+        Node('stargazers')('totalCount'),
+        Node('languages', first=10, orderBy={'field': Enum('SIZE'), 'direction': Enum('DESC')})(
+            Node('edges')(
+                'size',
+                Node('node')('name', 'color')))),
+)
+
+def build_fetch_query(n):
+    return build_batch_query(n, 'repoInfo', FETCH_FRAGMENTS)
+
+# Selects no connections, so a batch of any size costs github's minimum of 1 point
+MARKER_FRAGMENTS = (
+    Fragment('repoMarker', 'Repository')('name', Node('owner')('__typename', 'login'), 'pushedAt', 'updatedAt'),
+)
+
+def build_refresh_query(n):
+    return build_batch_query(n, 'repoMarker', MARKER_FRAGMENTS)
+
+
+def query_kind(query):
+    '''EXPAND, FETCH, REFRESH or POPULAR for the text of a query this module sends, None for anything else'''
+
+    if 'fragment repoExpand on' in query:
+        return EXPAND
+    elif 'fragment repoMarker on' in query:
+        return REFRESH
+    elif 'fragment repoInfo on' in query:
+        return FETCH
+    elif query == POPULAR_REPOS_QUERY:
+        return POPULAR
+    return None
+
+def archived_pairs(variables):
+    '''(alias, owner login, repo name) for every repo a single (alias None) or batched query asked for'''
+
+    if 'owner' in variables:
+        return [(None, variables['owner'], variables['name'])]
+    return [('repo%d' % i, variables['owner%d' % i], variables['name%d' % i])
+            for i in range(1, len(variables) // 2 + 1)]
 
-fragment userExpand on User {
-  contributedRepositories(first: 10, privacy: PUBLIC, orderBy: {field: STARGAZERS, direction: DESC}) {
-    nodes {
-      ...repoInfo
-    }
-  }
-  issues(first: 20, orderBy: {field: COMMENTS, direction: DESC}) {
-    nodes {
-      repository {
-        ...repoInfo
-      }
-    }
-  }
-  pullRequests(first: 20) {
-    nodes {
-      repository {
-        ...repoInfo
-      }
-    }
-  }
-  starredRepositories(first: 20, orderBy: {field: STARRED_AT, direction: DESC}) {
-    nodes {
-      ...repoInfo
-    }
-  }
-}
 
-fragment repoInfo on Repository {
-  name
-  owner {
-    __typename
-    login
-  }
-}
-'''
+def strp_reset_time(time_str):
+    return time.strptime(time_str, "%Y-%m-%dT%H:%M:%Sz")
 
-fetch_cost_guess = lambda n: n * 1.5 / 467.0 # Best seen so far
-FETCH_QUERY = '''\
-query {
-%s
-  rateLimit {
-    cost
-    remaining
-    resetAt
-  }
-}
+def send_query(query, variables=None, url=g.api_url, raw=False, api_key=g.personal_token, sender=None):
+    '''Sends `query` through the shared Transport, or through `sender` (e.g. requests.post) if given, and archives
+    the raw response if archive_responses is set. If github keeps answering with an error page instead of JSON,
+    its text is returned as the data'''
 
-fragment repoInfo on Repository {
-  name
-  owner {
-    login
-  }
-  description
-  diskUsage
-  url
-  isFork
-  isMirror
-  languages(first: 10, orderBy: {field: SIZE, direction: DESC}) {
-    edges {
-      size
-      node {
-        name
-        color
-      }
-    }
-  }
-}'''
+    if not isinstance(query, str):
+        query = query.format()
 
-RATE_LIMIT_QUERY = '''\
-query {
-  rateLimit {
-    resetAt
-  }
-}'''
+    headers = {'Authorization': 'bearer ' + api_key}
+    payload = {'query': query}
+    if variables:
+        payload['variables'] = variables
 
+    kind = query_kind(query) or 'other'
+    with metrics.timer('github_query_seconds', kind=kind):
+        if sender is not None:
+            result = sender(url, headers=headers, data=json.dumps(payload))
+        else:
+            result = get_transport().post(url, payload, headers)
+    metrics.inc('github_responses_total', kind=kind, status=result.status_code)
 
-def strp_reset_time(time_str):
-    return time.strptime(time_str, "%Y-%m-%dT%H:%M:%Sz")
+    archive = get_archive()
+    if archive is not None:
+        archive.put(query, variables, result.content, result.status_code)
+
+    if raw:
+        return result.text
+
+    if not is_json(result):
+        log.error('Github returned %d %s instead of JSON', result.status_code, result.headers.get('Content-Type'))
+        return {'data': result.text, 'errors': [{'message': 'HTTP {}'.format(result.status_code)}]}
+
+    with metrics.timer('json_decode_seconds', kind=kind):
+        return result.json()
+
+def stream_query(query, variables=None, url=g.api_url, api_key=g.personal_token):
+    '''Sends a batched `query` like send_query, but returns a StreamedResult that yields each aliased repo node as
+    it downloads. The raw response is archived as it downloads'''
 
-def send_query(query, variables=None, url=g.api_url, raw=False, api_key=g.personal_token, sender=requests.post):
     if not isinstance(query, str):
         query = query.format()
 
     headers = {'Authorization': 'bearer ' + api_key}
+    payload = {'query': query}
     if variables:
-        result = sender(url, headers=headers, data=json.dumps({'query': query, 'variables': variables}))
-    else:
-        result = sender(url, headers=headers, data=json.dumps({'query': query}))
+        payload['variables'] = variables
 
-    if raw:
-        result = result.text
-    else:
-        result = result.json()
+    kind = query_kind(query) or 'other'
+    with metrics.timer('github_query_seconds', kind=kind):
+        response = get_transport().post(url, payload, headers, stream=True)
+    metrics.inc('github_responses_total', kind=kind, status=response.status_code)
+
+    archive = get_archive()
+    writer = archive.writer(query, variables, status=response.status_code) if archive is not None else None
+    return StreamedResult(response, kind, archive=writer)
+
+def get_repos_from_expand_result(result, todo):
+    '''Returns the set of ((owner_login, owner_type), repo_name) found by an EXPAND_QUERY, and the number of repo
+    nodes seen. The user -> repo edges it saw go to the edge log, if there is one'''
+
+    errors = result.get('errors', [])
+    data = result['data']
+
+    if errors:
+        log.error(errors)
+        for error in errors:
+            if 'type' in error and error['type'].lower() == 'rate_limited':
+                raise RateLimit()
+
+    if not data:
+        log.warning('result was empty')
+        raise EmptyResultError(errors, todo)
+
+    if isinstance(data, str):
+        log.error('result was text, not a dictionary. Assuming Github timed out')
+        raise GithubTimeout(errors, todo)
+
+    repo_node = data.get('repository')
+    if not repo_node:
+        log.warning('result was empty')
+        raise EmptyResultError(errors, todo)
+
+    edge_log = get_edge_log()
+    edges = [] if edge_log is not None else None
+    expanded = (repo_node.get('owner') or {}).get('login'), repo_node.get('name')
 
-    return result
+    repos = set()
+    count = 0
+    # Only the connections the query's shape followed are there
+    for key in REPO_RELATIONS:
+        user_nodes = connection_nodes(repo_node, key)
+        if key in ('issues', 'pullRequests'):
+            user_nodes = [user for item in user_nodes for user in connection_nodes(item, 'participants')]
+        new_repos, new_count = get_repos_from_user_nodes(user_nodes, edges)
+        repos.update(new_repos)
+        count += new_count
+
+        if edges is not None and all(expanded):
+            edges.extend((user['login'], expanded, REPO_RELATIONS[key]) for user in user_nodes if user.get('login'))
+
+    if edges:
+        edge_log.append(edges)
+    return repos, count
+
+def get_batch_data(result, todos):
+    '''Returns the data of a batched fetch or refresh query result for `todos`, raising RateLimit, EmptyResultError
+    or GithubTimeout like get_repos_from_expand_result'''
+
+    errors = result.get('errors', [])
+    data = result['data']
+
+    if errors:
+        log.error(errors)
+        for error in errors:
+            if 'type' in error and error['type'].lower() == 'rate_limited':
+                raise RateLimit()
+
+    if not data:
+        log.warning('result was empty')
+        raise EmptyResultError(errors, todos)
+
+    if isinstance(data, str):
+        log.error('result was text, not a dictionary. Assuming Github timed out')
+        raise GithubTimeout(errors, todos)
+
+    return data
+
+def batch_aliases(todos):
+    '''(alias, todo) for each of `todos` in a batched query, repo1 for the first'''
+    return [('repo%d' % i, todo) for i, todo in enumerate(todos, 1)]
+
+def failed_aliases(result):
+    '''Aliases of a batched query result whose lookups errored for a reason other than the repo not existing, like
+    a timeout of their part of the query'''
+
+    return {error['path'][0] for error in result.get('errors') or []
+            if error.get('path') and error.get('type') != 'NOT_FOUND'}
+
+def fetch_batches(todos, batch_size):
+    '''Splits `todos` into fetch batches of up to `batch_size`, except the ones that already failed to fetch on their
+    own, which go alone so they can't fail a whole batch again'''
+
+    suspects = [[todo] for todo in todos if todo.attempts]
+    rest = [todo for todo in todos if not todo.attempts]
+    return suspects + [rest[start:start + batch_size] for start in range(0, len(rest), batch_size)]
+
+def build_expand_batch_query(todos, shape=None):
+    '''Returns the cached query text expanding every todo repo in `todos` (following the connections in `shape`),
+    its variables and a dict of alias -> todo'''
+
+    template = expand_template(len(todos), shape)
+    variables = batch_variables((todo.owner.login, todo.name) for todo in todos)
+    aliases = dict(batch_aliases(todos))
+
+    return template.text, variables, aliases
+
+def split_expand_result(result, alias):
+    '''Turns the result of a batched expand query into what EXPAND_QUERY would have returned for `alias`. Errors
+    without a path apply to every alias'''
+
+    data = result.get('data')
+    if isinstance(data, dict):
+        data = {'repository': data.get(alias), 'rateLimit': data.get('rateLimit')}
+
+    errors = [error for error in result.get('errors', [])
+              if not error.get('path') or error['path'][0] == alias]
+
+    return {'data': data, 'errors': errors}
+
+def connection_nodes(node, key):
+    '''The nodes of connection `key` of `node`, none if the query didn't ask for it or github returned it null'''
+
+    return ((node or {}).get(key) or {}).get('nodes') or []
+
+def get_repos_from_user_nodes(user_nodes, edges=None):
+    '''Returns the set of ((owner_login, owner_type), repo_name) the users in `user_nodes` are related to, and the
+    number of repo nodes seen. Appends (user login, (owner login, repo name), relation) to `edges` if given'''
 
-def get_repos_from_user_nodes(user_nodes):
     repos = set()
     count = 0
 
-    for key in ('contributedRepositories', 'starredRepositories', 'issues', 'pullRequests'):
+    for key in USER_RELATIONS:
         for user in user_nodes:
-            for node in user.get(key, {}).get('nodes', []):
+            for node in connection_nodes(user, key):
                 try:
                     repo = node if key in ('contributedRepositories', 'starredRepositories') else node['repository']
                     repos.add(((repo['owner']['login'], repo['owner']['__typename']), repo['name']))
                     count += 1
+                    if edges is not None and user.get('login'):
+                        edges.append((user['login'], (repo['owner']['login'], repo['name']), USER_RELATIONS[key]))
                 except KeyError:
                     pass
 
@@ -200,231 +510,869 @@ def get_repos_from_user_nodes(user_nodes):
 
 
 class MainScraper():
-    def __init__(self):
-        self.session = Session()
-        self.rate_limit_remaining = 5000
-        self.expand_errors = {}
+    def __init__(self, concurrency=None, expand_batch=None, tokens=None, api_url=None, session=None, cache=None):
+        self.session = session or Session()
+        migrations.upgrade(self.session.get_bind())
+        instrument_session(self.session)
+        self.tokens = tokens or TokenPool.from_config()
+        self.api_url = api_url or g.api_url
+        self.cache = cache if cache is not None else identity_cache
+        self.cache.attach(self.session)
+        if self.cache.bloom is None and getattr(g, 'scraper_warm_cache', True):
+            self.cache.warm(self.session)
+        self.concurrency = concurrency or getattr(g, 'scraper_concurrency', 1)
+        self.expand_batch = expand_batch or getattr(g, 'scraper_expand_batch_size', 1)
+        self.bulk_ingest = getattr(g, 'scraper_bulk_ingest', True)
+        warn_renamed_expand_flags()
+        self.expand_shape = expand_shape()
+        self.cost_model = CostModel()
+        self.cost_model.set_prior(EXPAND, *expand_cost_prior(self.expand_shape), shape=shape_key(self.expand_shape))
+        self.cost_model.load(self.session)
+        aggregates.ensure(self.session)
+        self.frontier = frontier
+        self.todo_queue = LeaseQueue(self.session, Repo, (Repo.state == STATE_TODO,), order_by=self.frontier.order_by)
+        self.new_repo_queue = LeaseQueue(self.session, Repo, (Repo.state == STATE_NEW,))
         self.fetch_errors = 0
-        self.reset_time = time.time() + 3600
+        self.fetch_bisect = getattr(g, 'scraper_fetch_bisect', True)
+        self.stream_fetches = getattr(g, 'scraper_stream_fetches', False)
+        self.stream_chunk = getattr(g, 'scraper_stream_chunk', 50)
+        self.fetch_failure_streak = 0
+        self.safe_fetch_batch = MAX_FETCH_BATCH
+        self.safe_fetch_batch_until = 0
+        self.profiler = Profiler()
 
+    @property
+    def rate_limit_remaining(self):
+        '''Headroom of the token with the most points left'''
+        return self.tokens.headroom()
 
-    def owner_exists(self, login):
-        return self.session.query(exists().where(Owner.login == login)).scalar()
+    @property
+    def reset_time(self):
+        return self.tokens.next_reset()
 
-    def repo_fetched(self, owner_login, repo_name):
-        return self.session.query(
-            self.session.query(Owner).filter_by(login=owner_login).join(Repo).filter_by(name=repo_name).exists()
-        ).scalar()
 
-    def repo_found_not_fetched(self, owner_login, repo_name):
-        return self.session.query(
-            self.session.query(Owner).filter_by(login=owner_login).join(NewRepo).filter(NewRepo.name == repo_name).exists()
-        ).scalar()
+    def owner_exists(self, login):
+        return self.cache.owner_id(self.session, login) is not None
 
-    def repo_exists(self, owner_login, repo_name):
-        return self.repo_fetched(owner_login, repo_name) or self.repo_found_not_fetched(owner_login, repo_name)
 
+    def rate_limit_sleep(self, needed=None):
+        '''Waits until some token can afford `needed` points again, going by the rateLimit blocks of earlier
+        responses, and does database upkeep in the meantime. Returns right away if one already can'''
 
-    def rate_limit_sleep(self):
-        result = send_query(RATE_LIMIT_QUERY)
-        if 'data' in result and 'rateLimit' in result['data'] and 'resetAt' in result['data']['rateLimit']:
-            self.reset_time = calendar.timegm(strp_reset_time(result['data']['rateLimit']['resetAt']))
+        wait = self.tokens.wait_time(needed or 1)
+        if wait <= 0:
+            log.info('Rate limited on one token, switching to another')
+            return
 
         now = time.time()
-        sleep_time = 30 + self.reset_time - now
-        log.info('Sleeping %d seconds until %s', sleep_time, time.asctime(time.localtime(now + sleep_time)))
+        # Short waits are just pacing, only worth logging when every token's window is spent
+        exhausted = self.tokens.headroom() - 2 < (needed or 1)
+        if exhausted:
+            log.info('Sleeping %d seconds until %s', wait, time.asctime(time.localtime(now + wait)))
+        with metrics.timer('scraper_step_seconds', step='idle'):
+            self.idle(now + wait)
+
+        sleep_time = max(0, now + wait - time.time())
+        metrics.inc('rate_limit_sleep_seconds_total', sleep_time, reason='reset' if exhausted else 'paced')
         time.sleep(sleep_time)
-        self.rate_limit_remaining = 5000
+
+    def idle(self, deadline):
+        '''Database-only upkeep that needs no rate limit points, done while waiting for them until `deadline`'''
+
+        self.frontier.backfill(self.session, chunk=1000, deadline=deadline)
+        self.requeue_missing_repos()
+        metrics.maybe_dump()
+
+    def requeue_missing_repos(self, ttl=None):
+        '''Gives repos that have been missing for `ttl` (default missing_repo_ttl) seconds another fetch, in case
+        they came back. Returns how many'''
+
+        if ttl is None:
+            ttl = getattr(g, 'missing_repo_ttl', 30 * 24 * 3600)
+        count = self.session.query(Repo) \
+                            .filter(Repo.state == STATE_MISSING) \
+                            .filter(Repo.fetched_at < time.time() - ttl) \
+                            .update({Repo.state: STATE_NEW}, synchronize_session=False)
+        if count:
+            aggregates.add(self.session, new_repos=count, repos_missing=-count)
+            log.info('Fetching %d repos missing for over %d seconds again', count, ttl)
+        self.session.commit()
+        return count
 
 
     def populate_most_popular(self):
         '''Gets 100 most starred repos from github search'''
 
-        result = send_query(POPULAR_REPOS_QUERY)
+        result = send_query(POPULAR_REPOS_QUERY, url=self.api_url, api_key=self.tokens.best().key)
 
         with self.session.begin_nested():
-            for repo in sorted(result.get('data', {}).get('search', {}).get('nodes', []),
-                               key=lambda repo:repo['stargazers']['totalCount'],
-                               reverse=True):
-                try:
-                    owner = self.session.query(Owner).filter_by(login=repo['owner']['login']).one()
-                except NoResultFound:
-                    owner = Owner(login=repo['owner']['login'],
-                                  owner_type=self.session.query(OwnerType).filter_by(typename=repo['owner']['__typename']).one())
-                    self.session.add(owner)
+            self.add_popular_repos(result)
 
-                new_repo = NewRepo(name=repo['name'], owner=owner)
-                self.session.add(new_repo)
+        self.session.commit()
+
+    def add_popular_repos(self, result):
+        '''Adds the repos of a POPULAR_REPOS_QUERY result as new repos, most starred first. Returns the new ones'''
+
+        nodes = sorted((result.get('data') or {}).get('search', {}).get('nodes', []),
+                       key=lambda repo:repo['stargazers']['totalCount'],
+                       reverse=True)
+        return self.add_new_repos(((repo['owner']['login'], repo['owner']['__typename']), repo['name'])
+                                  for repo in nodes)
+
+    def add_new_repos(self, repos):
+        '''Creates owners and STATE_NEW repos for each not yet seen ((owner_login, owner_type), repo_name) in
+        `repos`, and counts a sighting for the ones already known. Returns the set of new keys.
+
+        Another worker may add the same owners and repos between the lookups and the inserts, so rows that already
+        exist by then are skipped rather than failing the round'''
+
+        new = set()
+        seen = set()
+        new_owners = {}
+        # (owner login, owner id or None for a new owner, repo name) of each new repo
+        new_repos = []
+        for key in repos:
+            (owner_login, owner_type), repo_name = key
+            redirect = self.cache.redirect(self.session, owner_login, repo_name)
+            if redirect is not None:
+                seen.add(redirect)
+                continue
+
+            if owner_login in new_owners:
+                # A brand new owner can't have any repos yet
+                new_repos.append((owner_login, None, repo_name))
+                new.add(key)
+                continue
+
+            owner_id = self.cache.owner_id(self.session, owner_login)
+            if owner_id is None:
+                assert owner_type.lower() in ('user', 'organization')
+                new_owners[owner_login] = self.cache.type_id(self.session, owner_type)
+                new_repos.append((owner_login, None, repo_name))
+                new.add(key)
+            elif self.cache.repo_state(self.session, owner_id, repo_name) is None:
+                new_repos.append((owner_login, owner_id, repo_name))
+                new.add(key)
+            else:
+                seen.add((owner_id, repo_name))
+
+        added_owners = insert_missing(self.session, Owner.__table__,
+                                      [{'login': login, 'type_id': type_id} for login, type_id in new_owners.items()])
+        owner_ids = dict(self.session.query(Owner.login, Owner.id).filter(Owner.login.in_(new_owners))) \
+            if new_owners else {}
+        self.cache.note_owners(owner_ids)
+
+        rows = [(owner_id or owner_ids[owner_login], repo_name) for owner_login, owner_id, repo_name in new_repos]
+        added_repos = insert_missing(self.session, Repo.__table__,
+                                     [{'owner_id': owner_id, 'name': repo_name, 'state': STATE_NEW}
+                                      for owner_id, repo_name in rows])
+        self.cache.note_repos(rows, REPO_FOUND)
+
+        aggregates.add(self.session, owners=added_owners, new_repos=added_repos)
+        self.frontier.note_sightings(self.session, seen)
+        return new
+
+    def note_expansions(self, expansions, new):
+        '''Credits each (owner id, repos found) expansion's owner with the repos in `new` it found'''
+
+        yields = {}
+        for owner_id, repos in expansions:
+            expanded, found = yields.get(owner_id, (0, 0))
+            yields[owner_id] = expanded + 1, found + len(new.intersection(repos))
+        self.frontier.note_expansions(self.session, yields)
+
+    def update_rate_limit(self, data, cost_guess, query_type=None, batch_size=None, token=None):
+        '''Records the rateLimit block of a query result sent with `token`, and feeds its cost to the cost model'''
+
+        token = token or self.tokens.best()
+        try:
+            remaining = data['rateLimit']['remaining']
+            reset_time = calendar.timegm(strp_reset_time(data['rateLimit']['resetAt']))
+            actual_cost = data['rateLimit']['cost']
+            self.session.add(QueryCost(guess=int(round(cost_guess * 100)), normalized_actual=actual_cost,
+                                       query_type=query_type, batch_size=batch_size,
+                                       shape=self.cost_model.shapes.get(query_type)))
+            if query_type:
+                self.cost_model.update(query_type, batch_size, actual_cost)
+
+            self.tokens.update(token, remaining, reset_time)
+            local_reset_time_str = time.asctime(time.localtime(token.reset_time))
+
+            log.info('Guessed cost %f, actual cost %d', cost_guess, actual_cost)
+            log.info('Rate limited cost %d remaining on %s until %s', token.remaining, token.name, local_reset_time_str)
+            return True
+        except Exception as e:
+            log.error(e)
+            log.error('Could not get latest remaining query cost. `data` is probably None')
+            return False
 
+    def record_expand_error(self, e):
+        '''Counts a failed expansion on its todo, shared by every worker, and releases its lease. After
+        MAX_EXPAND_ERRORS the repo moves to STATE_ERROR'''
+
+        todo = e.todo
+        attempts = self.todo_queue.fail(todo, e.errors)
+        log.error('Error count for expanding %s/%s is %d', todo.owner.login, todo.name, attempts)
+
+        if attempts > MAX_EXPAND_ERRORS:
+            with self.session.begin_nested():
+                todo.state = STATE_ERROR
+                aggregates.add(self.session, repo_errors=1, repos_todo=-1, repos=-1)
         self.session.commit()
 
     def expand_repos_from_db(self):
-        '''Expands all repos in github_repos.db.ReposTodo table.'''
+        '''Expands the first unleased todo repo'''
 
-        if EXPAND_COST_GUESS > self.rate_limit_remaining * 100 or self.rate_limit_remaining <= 2:
-            raise RateLimit()
+        todos = self.todo_queue.claim(1)
+        if not todos:
+            log.info('Every repo to expand is leased by another worker')
+            return
+        todo = todos[0]
 
+        cost_guess = self.cost_model.predict(EXPAND, 1)
+        token = self.tokens.acquire(cost_guess)
+        if token is None:
+            self.todo_queue.release(todos)
+            raise RateLimit(cost_guess)
+
+        data = None
         try:
-            todo = self.session.query(ReposTodo).order_by(ReposTodo.id).first()
+            log.info('Expanding %s/%s...', todo.owner.login, todo.name)
+            sys.stdout.flush()
+
+            result = send_query(expand_template(shape=self.expand_shape).text,
+                                {'owner': todo.owner.login, 'name': todo.name},
+                                url=self.api_url, api_key=token.key)
+            data = result['data']
+            repos, count = get_repos_from_expand_result(result, todo)
+
+            self.write_expansions([(todo, repos, count)])
+
+        except Exception as e:
+            self.session.rollback()
+            if isinstance(e, RateLimit):
+                self.tokens.exhaust(token)
+            if not isinstance(e, (GithubTimeout, EmptyResultError)):
+                self.todo_queue.release(todos)
+            raise e
+
+        finally:
+            self.tokens.release(token, cost_guess)
+            self.update_rate_limit(data, cost_guess, EXPAND, 1, token)
+
+    def expand_batch_size(self):
+        '''Number of todos to expand in one batched query without passing the node limit or the remaining
+        rate limit'''
 
-            log.info('Expanding %s/%s...', todo.repo.owner.login, todo.repo.name)
+        by_nodes = MAX_QUERY_NODES // expand_template(shape=self.expand_shape).nodes
+        return self.cost_model.best_batch_size(EXPAND, min(self.expand_batch, by_nodes), self.rate_limit_remaining)
+
+    def expand_repos_batched(self):
+        '''Expands the first several todo repos with a single aliased query'''
+
+        batch_size = self.expand_batch_size()
+        if batch_size < 1:
+            raise RateLimit(self.cost_model.predict(EXPAND, 1))
+
+        todos = self.todo_queue.claim(batch_size)
+        if not todos:
+            log.info('Every repo to expand is leased by another worker')
+            return
+
+        cost_guess = self.cost_model.predict(EXPAND, len(todos))
+        token = self.tokens.acquire(cost_guess)
+        if token is None:
+            self.todo_queue.release(todos)
+            raise RateLimit(cost_guess)
+
+        data = None
+        try:
+            log.info('Expanding %d repos...', len(todos))
             sys.stdout.flush()
 
-            # TODO handle weird timeout html page being returned
-            result = send_query(EXPAND_QUERY, {'owner': todo.repo.owner.login, 'name': todo.repo.name})
-            errors = result.get('errors', [])
+            query, variables, aliases = build_expand_batch_query(todos, self.expand_shape)
+            result = send_query(query, variables, url=self.api_url, api_key=token.key)
             data = result['data']
 
-            if errors:
-                log.error(errors)
-                for error in errors:
-                    if 'type' in error and error['type'].lower() == 'rate_limited':
-                        raise RateLimit()
-
-            if not data:
-                log.warning('result was empty')
-                raise EmptyResultError(errors, todo)
-
-            if isinstance(data, str):
-                log.error('result was text, not a dictionary. Assuming Github timed out')
-                raise GithubTimeout(errors, todo)
-
-            repo_node = data.get('repository')
-            if repo_node:
-                repos = set()
-                count = 0
-
-                for key in ('mentionableUsers', 'stargazers', 'watchers'):
-                    new_repos, new_count = get_repos_from_user_nodes(repo_node.get(key, {}).get('nodes', []))
-                    repos.update(new_repos)
-                    count += new_count
-
-                new_count = 0
-                # Create new owners and NewRepos
-                for (owner_login, owner_type), repo_name in repos:
-                    if not self.owner_exists(owner_login):
-                        assert owner_type.lower() in ('user', 'organization')
-                        owner = Owner(login=owner_login, type_id=self.session.query(OwnerType.id).filter_by(typename=owner_type).scalar())
-                        self.session.add(owner)
-                    else:
-                        owner = self.session.query(Owner).filter_by(login=owner_login).one()
-
-                    if not self.repo_exists(owner_login, repo_name):
-                        self.session.add(NewRepo(owner=owner, name=repo_name))
-                        new_count += 1
-
-                log.info('%d repo nodes returned, %d unique, %d new', count, len(repos), new_count)
-
-                # Delete todos
-                self.session.query(ReposTodo).filter(ReposTodo.id == todo.id).delete(synchronize_session='fetch')
-            else:
-                log.warning('result was empty')
-                raise EmptyResultError(errors, todo)
+            expansions = []
+            failures = []
+            for alias, todo in aliases.items():
+                try:
+                    expansions.append((todo,) + get_repos_from_expand_result(split_expand_result(result, alias), todo))
+                except (GithubTimeout, EmptyResultError) as e:
+                    failures.append(e)
+
+            self.write_expansions(expansions)
+            for e in failures:
+                self.record_expand_error(e)
+
+        except Exception as e:
+            self.session.rollback()
+            if isinstance(e, RateLimit):
+                self.tokens.exhaust(token)
+            self.todo_queue.release(todos)
+            raise e
+
+        finally:
+            self.tokens.release(token, cost_guess)
+            self.update_rate_limit(data, cost_guess, EXPAND, len(todos), token)
 
+    def write_expansions(self, expansions):
+        '''Adds the repos found by several (todo, repos, count) expansions and marks the todos expanded in one
+        transaction'''
+
+        if not expansions:
+            return
+
+        try:
+            repos = set()
+            count = 0
+            for todo, todo_repos, todo_count in expansions:
+                repos.update(todo_repos)
+                count += todo_count
+
+            new = self.add_new_repos(repos)
+            self.note_expansions([(todo.owner_id, todo_repos) for todo, todo_repos, _ in expansions], new)
+            expanded = self.mark_expanded([todo.id for todo, _, _ in expansions])
+            aggregates.add(self.session, repos_todo=-expanded)
             self.session.commit()
 
+            log.info('Wrote %d expansions: %d repo nodes returned, %d unique, %d new',
+                     len(expansions), count, len(repos), len(new))
+
         except Exception as e:
             self.session.rollback()
             raise e
 
+    def mark_expanded(self, repo_ids):
+        '''Moves the todo repos with `repo_ids` to STATE_EXPANDED. Returns the number moved'''
+
+        return self.session.query(Repo) \
+                           .filter(Repo.id.in_(repo_ids)) \
+                           .filter(Repo.state == STATE_TODO) \
+                           .update({Repo.state: STATE_EXPANDED, Repo.leased_by: None, Repo.lease_expires: None,
+                                    Repo.priority: None}, synchronize_session='fetch')
+
+    def expand_repos_concurrently(self, concurrency=None, round_size=None, write_batch=None):
+        '''Expands up to `round_size` todo repos, keeping `concurrency` expand queries
+        in flight at once. All queries reserve their points from the shared TokenPool, and discovered repos are
+        written back every `write_batch` finished expansions. Raises RateLimit once no token has points left and
+        nothing is in flight.'''
+
+        concurrency = concurrency or self.concurrency
+        round_size = round_size or concurrency * getattr(g, 'scraper_round_multiplier', 4)
+        write_batch = write_batch or getattr(g, 'scraper_write_batch', concurrency)
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._expand_concurrently(loop, concurrency, round_size, write_batch))
         finally:
-            try:
-                self.rate_limit_remaining = data['rateLimit']['remaining']
-                rate_limit_reset_at = strp_reset_time(data['rateLimit']['resetAt'])
-                actual_cost = data['rateLimit']['cost']
-                self.session.add(QueryCost(guess=EXPAND_COST_GUESS, normalized_actual=actual_cost))
+            loop.close()
+
+    async def _expand_concurrently(self, loop, concurrency, round_size, write_batch):
+        cost = self.cost_model.predict(EXPAND, 1)
+        query = expand_template(shape=self.expand_shape).text
+        todos = collections.deque(self.todo_queue.claim(round_size))
+        in_flight = {}
+        finished = []
+        rate_limited = False
+        error = None
+
+        executor = ThreadPoolExecutor(concurrency)
+        try:
+            while todos or in_flight:
+                while todos and len(in_flight) < concurrency and not rate_limited:
+                    token = self.tokens.acquire(cost)
+                    if token is None:
+                        rate_limited = True
+                        break
+
+                    todo = todos.popleft()
+                    log.info('Expanding %s/%s...', todo.owner.login, todo.name)
+                    future = loop.run_in_executor(executor, functools.partial(
+                        send_query, query, {'owner': todo.owner.login, 'name': todo.name},
+                        url=self.api_url, api_key=token.key))
+                    in_flight[future] = todo, token
+
+                if not in_flight:
+                    break
+
+                done, _ = await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    todo, token = in_flight.pop(future)
+                    data = None
+                    try:
+                        result = future.result()
+                        data = result['data']
+                        finished.append((todo,) + get_repos_from_expand_result(result, todo))
 
-                self.reset_time = calendar.timegm(rate_limit_reset_at)
-                local_reset_time_str = time.asctime(time.localtime(self.reset_time))
+                    except RateLimit:
+                        self.tokens.exhaust(token)
+                        rate_limited = True
 
-                log.info('Guessed cost %f, actual cost %d', EXPAND_COST_GUESS / 100, actual_cost)
-                log.info('Rate limited cost %d remaining until %s', self.rate_limit_remaining, local_reset_time_str)
+                    except (GithubTimeout, EmptyResultError) as e:
+                        self.record_expand_error(e)
+
+                    except Exception as e:
+                        # Raised once the rest of the finished queries are collected
+                        log.error('Expanding %s/%s failed: %s', todo.owner.login, todo.name, e)
+                        todos.append(todo)
+                        error = error or e
+
+                    finally:
+                        self.tokens.release(token, cost)
+                        self.update_rate_limit(data, cost, EXPAND, 1, token)
+
+                if error is not None:
+                    raise error
+
+                if len(finished) >= write_batch:
+                    batch, finished = finished, []
+                    self.write_expansions(batch)
+                    self.todo_queue.renew(list(todos) + [todo for todo, _ in in_flight.values()])
+
+            batch, finished = finished, []
+            self.write_expansions(batch)
+
+        except Exception:
+            self.session.rollback()
+            # Keep the expansions that finished before the failure; only the failing one is lost
+            try:
+                self.write_expansions(finished)
             except Exception as e:
-                log.error(e)
-                log.error('Could not get latest remaining query cost. `data` is probably None')
+                log.error('Could not write %d finished expansions: %s', len(finished), e)
+            raise
 
+        finally:
+            executor.shutdown(wait=True)
+            # Whatever wasn't expanded, including the queries in flight when something failed, goes back
+            for todo, token in in_flight.values():
+                self.tokens.release(token, cost)
+            self.todo_queue.release(list(todos) + [todo for todo, _ in in_flight.values()])
+
+        if rate_limited:
+            raise RateLimit(cost)
+
+    def fetch_batch_limit(self):
+        '''Largest fetch batch to send: MAX_FETCH_BATCH, or less for a while after a batch failed'''
+
+        if time.time() >= self.safe_fetch_batch_until:
+            return MAX_FETCH_BATCH
+        return self.safe_fetch_batch
+
+    def note_fetch_failure(self, batch_size):
+        '''Remembers that a freshly claimed fetch batch of `batch_size` repos failed as a whole, so batches stay at most
+        half that size for scraper_fetch_safe_batch_seconds. Failures while bisecting don't count, or one bad repo
+        would bring it down to 1'''
+
+        if batch_size < 2:
+            # Says nothing about batch sizes, only about that repo
+            return
+        self.safe_fetch_batch = max(1, min(self.fetch_batch_limit(), batch_size // 2))
+        self.safe_fetch_batch_until = time.time() + getattr(g, 'scraper_fetch_safe_batch_seconds', 3600)
+        log.warning('Fetching at most %d repos per query for now', self.safe_fetch_batch)
+
+    def note_fetch_result(self, ok):
+        '''Counts failed fetch queries in a row when bisecting, which stops the crawl once github seems to be down
+        rather than just choking on some repos'''
+
+        self.fetch_failure_streak = 0 if ok else self.fetch_failure_streak + 1
+        if self.fetch_failure_streak > MAX_FETCH_ERRORS:
+            raise MaxErrors()
+
+    def record_fetch_error(self, e, todo):
+        '''Counts a failed fetch of `todo` on its own, and releases its lease. After MAX_FETCH_ATTEMPTS the repo moves
+        to STATE_ERROR'''
+
+        attempts = self.new_repo_queue.fail(todo, e.errors)
+        log.error('Error count for fetching %s/%s is %d', todo.owner.login, todo.name, attempts)
+
+        if attempts >= MAX_FETCH_ATTEMPTS:
+            with self.session.begin_nested():
+                todo.state = STATE_ERROR
+                aggregates.add(self.session, repo_errors=1, new_repos=-1)
+        self.session.commit()
 
     def fetch_new_repo_info(self):
-        if self.rate_limit_remaining <= 2:
-            raise RateLimit()
+        next_batch_size = self.cost_model.best_batch_size(FETCH, self.fetch_batch_limit(), self.rate_limit_remaining)
+        if next_batch_size < 1:
+            raise RateLimit(self.cost_model.predict(FETCH, 1))
 
-        try:
-            next_batch_size = max(0, min(500, int(self.rate_limit_remaining * 100) - 1))
-            cost_guess = fetch_cost_guess(next_batch_size)
-            todos = self.session.query(NewRepo).order_by(NewRepo.id).limit(next_batch_size).all()
+        todos = self.new_repo_queue.claim(next_batch_size)
+        if not todos:
+            log.info('Every repo to fetch is leased by another worker')
+            return
+        todo_ids = [todo.id for todo in todos]
 
+        try:
+            for batch in fetch_batches(todos, next_batch_size):
+                self.fetch_batch(batch)
+        finally:
+            # Whatever wasn't fetched, found missing or merged into its new name goes back to the queue
+            self.new_repo_queue.release(todo_ids)
+
+    def fetch_batch(self, todos, bisecting=False):
+        '''Fetches and writes the leased `todos` with one query. With scraper_fetch_bisect, the repos that failed,
+        all of them if the whole query did, are fetched again in two halves, down to single repos whose failures
+        are counted by record_fetch_error'''
+
+        cost_guess = self.cost_model.predict(FETCH, len(todos))
+        token = self.tokens.acquire(cost_guess)
+        if token is None:
+            raise RateLimit(cost_guess)
+
+        retry = []
+        # Aliases of the streamed nodes already written, kept if the rest of the response fails
+        done = set()
+        try:
             log.info('Fetching %d repos...', len(todos))
             sys.stdout.flush()
 
-            repos_query = ''
-            gensym_counter = 1
-            for todo in todos:
-                repos_query += '    repo%d: repository(owner: %s, name: %s) {...repoInfo}\n' % (
-                    gensym_counter, json.dumps(todo.owner.login), json.dumps(todo.name))
-                gensym_counter += 1
+            template = templates.get(('fetch', len(todos)), lambda: build_fetch_query(len(todos)))
+            variables = batch_variables((todo.owner.login, todo.name) for todo in todos)
 
-            query = FETCH_QUERY % repos_query
+            # Lowercase new key -> todo renamed to it, across the parts of a streamed batch
+            moved = {}
+            if self.stream_fetches:
+                streamed = stream_query(template.text, variables, url=self.api_url, api_key=token.key)
+                self.ingest_streamed(todos, streamed, moved, done)
+                result = streamed.result
+            else:
+                result = send_query(template.text, variables, url=self.api_url, api_key=token.key)
+            data = get_batch_data(result, todos)
 
-            result = send_query(query)
-            errors = result.get('errors', [])
-            data = result['data']
+            # Streamed nodes are already in; the null ones waited for the errors saying why they are null
+            failed = failed_aliases(result) - done
+            self.ingest_fetched(fetched_pairs(todos, data, failed | done), moved)
 
-            if errors:
-                log.error(errors)
-                for error in errors:
-                    if 'type' in error and error['type'].lower() == 'rate_limited':
-                        raise RateLimit()
-
-            if not data:
-                log.warning('result was empty')
-                raise EmptyResultError(errors, todos)
-
-            if isinstance(data, str):
-                log.error('result was text, not a dictionary. Assuming Github timed out')
-                raise GithubTimeout(errors, todos)
-
-            for key, node in data.items():
-                if not key.lower().startswith('repo'):
-                    continue
-
-                for todo in todos:
-                    if todo.name == node['name'] and todo.owner.login == node['owner']['login']:
-                        self.session.delete(todo)
-
-                repo = Repo(name=node['name'],
-                            owner=self.session.query(Owner).filter_by(login=node['owner']['login']).one(),
-                            description=node['description'],
-                            disk_usage=node['diskUsage'],
-                            url=node['url'],
-                            is_fork=node['isFork'],
-                            is_mirror=node['isMirror'])
-
-                for lang_edge in node.get('languages', {}).get('edges', []):
-                    try:
-                        lang = self.session.query(Language).filter_by(name=lang_edge['node']['name']).one()
-                    except NoResultFound:
-                        lang = Language(name=lang_edge['node']['name'], color=lang_edge['node']['color'])
+            log.info('done')
 
-                    repo_lang = RepoLanguages(repo=repo, language=lang, bytes_used=lang_edge['size'])
-                    self.session.add(repo_lang)
+            self.update_rate_limit(data, cost_guess, FETCH, len(todos), token)
 
-                self.session.add(repo)
+            self.session.commit()
+            self.note_fetch_result(True)
+
+            # Keep what came back, and try the rest again on their own
+            retry = [todo for alias, todo in batch_aliases(todos) if alias in failed]
+            error = GithubTimeout(result.get('errors'), retry)
+
+        except (GithubTimeout, EmptyResultError) as e:
+            self.keep_streamed(done)
+            if not self.fetch_bisect:
+                raise e
+            log.error('Fetching %d repos failed: %s', len(todos), e)
+            self.note_fetch_result(False)
+            if not bisecting:
+                self.note_fetch_failure(len(todos))
+            retry, error = [todo for alias, todo in batch_aliases(todos) if alias not in done], e
+
+        except Exception as e:
+            if isinstance(e, RateLimit):
+                self.keep_streamed(done)
+                self.tokens.exhaust(token)
+            else:
+                self.session.rollback()
+            raise e
 
-                new_todo = ReposTodo(repo=repo)
-                self.session.add(new_todo)
+        finally:
+            self.tokens.release(token, cost_guess)
+
+        if self.fetch_bisect:
+            self.bisect_fetch(retry, error)
+        else:
+            for todo in retry:
+                self.record_fetch_error(error, todo)
+
+    def ingest_fetched(self, pairs, moved=None):
+        '''Resolves and writes fetched (todo, node) pairs, without committing'''
+
+        resolved, nodes = resolve_fetched_pairs(self.session, pairs, self.cache, moved)
+        if self.bulk_ingest:
+            bulk_ingest_fetched_repos(self.session, resolved, nodes, self.cache)
+        else:
+            orm_ingest_fetched_repos(self.session, resolved, nodes)
+
+    def ingest_streamed(self, todos, streamed, moved, done):
+        '''Writes the repo nodes of the StreamedResult of a fetch of `todos` scraper_stream_chunk at a time as they
+        download, in the batch's transaction. Adds the aliases of each chunk to `done` once it is written'''
+
+        todo_of = dict(batch_aliases(todos))
+        pairs = []
+        for alias, node in streamed:
+            pairs.append((alias, node))
+            if len(pairs) >= self.stream_chunk:
+                self.ingest_fetched([(todo_of[alias], node) for alias, node in pairs], moved)
+                done.update(alias for alias, _ in pairs)
+                pairs = []
+        if pairs:
+            self.ingest_fetched([(todo_of[alias], node) for alias, node in pairs], moved)
+            done.update(alias for alias, _ in pairs)
+
+    def keep_streamed(self, done):
+        '''After a streamed fetch failed, commits the repos it wrote before that (the aliases in `done`), or rolls
+        back if it wrote none'''
+
+        if done:
+            log.info('Keeping %d repos streamed before the fetch failed', len(done))
+            self.session.commit()
+        else:
+            self.session.rollback()
 
-            log.info('done')
+    def bisect_fetch(self, todos, error):
+        if not todos:
+            return
+        elif len(todos) == 1:
+            self.record_fetch_error(error, todos[0])
+            return
 
-            self.rate_limit_remaining = data['rateLimit']['remaining']
-            rate_limit_reset_at = strp_reset_time(data['rateLimit']['resetAt'])
-            actual_cost = data['rateLimit']['cost']
-            self.session.add(QueryCost(guess=cost_guess, normalized_actual=actual_cost))
+        half = (len(todos) + 1) // 2
+        self.fetch_batch(todos[:half], bisecting=True)
+        self.fetch_batch(todos[half:], bisecting=True)
 
-            self.reset_time = calendar.timegm(rate_limit_reset_at)
-            local_reset_time_str = time.asctime(time.localtime(self.reset_time))
 
-            log.info('Guessed cost %f, actual cost %d', cost_guess / 100, actual_cost)
-            log.info('Rate limited cost %d remaining until %s', self.rate_limit_remaining, local_reset_time_str)
+    def claim_stale_repos(self, n, max_age):
+        '''Up to `n` repos whose change markers weren't checked for `max_age` seconds, least recently checked first.
+        Their fetched_at is stamped right away so other workers skip them. Returns the repos and their previous
+        fetched_at, for unclaim_repos'''
+
+        now = time.time()
+        # Missing repos are retried by requeue_missing_repos instead
+        repos = self.session.query(Repo) \
+                            .filter(Repo.state != STATE_NEW) \
+                            .filter(Repo.state != STATE_MISSING) \
+                            .filter(or_(Repo.fetched_at.is_(None), Repo.fetched_at < now - max_age)) \
+                            .order_by(Repo.fetched_at.nullsfirst(), Repo.id) \
+                            .limit(n) \
+                            .with_for_update(skip_locked=True) \
+                            .all()
+
+        previous = {repo.id: repo.fetched_at for repo in repos}
+        for repo in repos:
+            repo.fetched_at = now
+        self.session.commit()
+        return repos, previous
+
+    def unclaim_repos(self, previous):
+        '''Puts back the fetched_at claim_stale_repos replaced, so the repos are checked again'''
+
+        for repo_id, fetched_at in previous.items():
+            self.session.query(Repo).filter(Repo.id == repo_id) \
+                        .update({Repo.fetched_at: fetched_at}, synchronize_session=False)
+        self.session.commit()
+
+    def refresh_stale_repos(self, max_age=None):
+        '''Checks the pushedAt/updatedAt markers of the least recently checked repos with one aliased query, and
+        re-fetches only the repos whose markers moved. Returns the number of repos checked'''
+
+        max_age = max_age or getattr(g, 'refresh_max_age', 7 * 24 * 3600)
+        batch_size = self.cost_model.best_batch_size(REFRESH, MAX_FETCH_BATCH, self.rate_limit_remaining)
+        if batch_size < 1:
+            raise RateLimit(self.cost_model.predict(REFRESH, 1))
+
+        repos, previous = self.claim_stale_repos(batch_size, max_age)
+        if not repos:
+            return 0
+
+        cost_guess = self.cost_model.predict(REFRESH, len(repos))
+        token = self.tokens.acquire(cost_guess)
+        if token is None:
+            self.unclaim_repos(previous)
+            raise RateLimit(cost_guess)
+
+        data = None
+        try:
+            log.info('Checking %d repos for changes...', len(repos))
+            sys.stdout.flush()
+
+            template = templates.get(('refresh', len(repos)), lambda: build_refresh_query(len(repos)))
+            variables = batch_variables((repo.owner.login, repo.name) for repo in repos)
+            result = send_query(template.text, variables, url=self.api_url, api_key=token.key)
+            data = get_batch_data(result, repos)
+
+            changed = []
+            for i, repo in enumerate(repos, 1):
+                # Repos github can't resolve any more keep their row and are checked again next time. Renamed ones
+                # are re-fetched to take their new name
+                marker = data.get('repo%d' % i)
+                if marker and (is_renamed(repo, marker) or
+                               (marker['pushedAt'], marker['updatedAt']) != (repo.pushed_at, repo.updated_at)):
+                    changed.append(repo)
+
+        except Exception as e:
+            self.session.rollback()
+            if isinstance(e, RateLimit):
+                self.tokens.exhaust(token)
+            self.unclaim_repos(previous)
+            raise e
+
+        finally:
+            self.tokens.release(token, cost_guess)
+            self.update_rate_limit(data, cost_guess, REFRESH, len(repos), token)
+
+        self.session.commit()
+        log.info('%d of %d repos changed', len(changed), len(repos))
+
+        if changed:
+            self.refetch_repos(changed, {repo.id: previous[repo.id] for repo in changed})
+        return len(repos)
+
+    def refetch_repos(self, repos, previous):
+        '''Runs the full fetch query for already fetched `repos` and rewrites their rows and languages'''
+
+        cost_guess = self.cost_model.predict(FETCH, len(repos))
+        token = self.tokens.acquire(cost_guess)
+        if token is None:
+            self.unclaim_repos(previous)
+            raise RateLimit(cost_guess)
+
+        try:
+            log.info('Re-fetching %d repos...', len(repos))
+            sys.stdout.flush()
+
+            template = templates.get(('fetch', len(repos)), lambda: build_fetch_query(len(repos)))
+            variables = batch_variables((repo.owner.login, repo.name) for repo in repos)
+            result = send_query(template.text, variables, url=self.api_url, api_key=token.key)
+            data = get_batch_data(result, repos)
+
+            repo_ids, nodes = resolve_refetched_pairs(self.session, fetched_pairs(repos, data), self.cache)
+            refreshed = refresh_fetched_repos(self.session, repo_ids, nodes)
+            log.info('Rewrote %d repos', refreshed)
+
+            self.update_rate_limit(data, cost_guess, FETCH, len(repos), token)
+            self.session.commit()
+
+        except Exception as e:
+            self.session.rollback()
+            if isinstance(e, RateLimit):
+                self.tokens.exhaust(token)
+            self.unclaim_repos(previous)
+            raise e
+
+        finally:
+            self.tokens.release(token, cost_guess)
+
+    def refresh(self, max_age=None):
+        '''Refreshes stale repos until every repo was checked within `max_age` seconds'''
+
+        log.info('Starting refresh loop')
+        while True:
+            try:
+                if not self.refresh_stale_repos(max_age):
+                    log.info('Every repo was checked in the last %d seconds',
+                             max_age or getattr(g, 'refresh_max_age', 7 * 24 * 3600))
+                    return
+
+            except RateLimit as e:
+                self.rate_limit_sleep(e.cost)
+
+            except (GithubTimeout, EmptyResultError) as e:
+                self.fetch_errors += 1
+                log.error('Error count for refreshing is %d', self.fetch_errors)
+                if self.fetch_errors > MAX_FETCH_ERRORS:
+                    raise MaxErrors()
+
+    def find_by_key(self, pairs, *criteria):
+        '''Repos matching `criteria` whose (owner login, name) is one of `pairs`, compared case insensitively like
+        github does'''
+
+        lower_login = func.lower(Owner.login)
+        owner_ids = dict(self.session.query(lower_login, Owner.id)
+                                     .filter(lower_login.in_({login.lower() for login, _ in pairs})))
+        wanted = {(owner_ids[login.lower()], name.lower()) for login, name in pairs if login.lower() in owner_ids}
+        if not wanted:
+            return []
+
+        rows = self.session.query(Repo) \
+                           .filter(Repo.owner_id.in_({owner_id for owner_id, _ in wanted})) \
+                           .filter(func.lower(Repo.name).in_({name for _, name in wanted})) \
+                           .filter(*criteria) \
+                           .all()
+        return [row for row in rows if (row.owner_id, row.name.lower()) in wanted]
+
+    def reingest_expansion(self, variables, result):
+        '''Writes an archived expand query result like expand_repos_from_db would. Returns the number of repos
+        expanded'''
+
+        expanded = {}
+        for alias, owner, name in archived_pairs(variables):
+            try:
+                expanded[(owner, name)] = get_repos_from_expand_result(
+                    split_expand_result(result, alias) if alias else result, None)[0]
+            except (GithubTimeout, EmptyResultError, RateLimit):
+                pass
+
+        new = self.add_new_repos(set().union(*expanded.values()))
+        expanded_repos = self.find_by_key(list(expanded), Repo.state != STATE_NEW)
+        found = {(owner.lower(), name.lower()): repos for (owner, name), repos in expanded.items()}
+        self.note_expansions([(repo.owner_id, found[(repo.owner.login.lower(), repo.name.lower())])
+                              for repo in expanded_repos], new)
+
+        repo_ids = [repo.id for repo in expanded_repos]
+        if repo_ids:
+            aggregates.add(self.session, repos_todo=-self.mark_expanded(repo_ids))
+        return len(expanded)
+
+    def reingest_fetch(self, variables, result):
+        '''Writes an archived fetch query result like fetch_new_repo_info would. Repos already fetched are
+        overwritten like refetch_repos would, so later responses win. Returns the number of repos written'''
+
+        data = result.get('data')
+        if not isinstance(data, dict):
+            return 0
+
+        repos = {(repo.owner.login.lower(), repo.name.lower()): repo
+                 for repo in self.find_by_key([(owner, name) for _, owner, name in archived_pairs(variables)])}
+        fetched = {}
+        fetched_nodes = []
+        todos = []
+        new_nodes = []
+        for node in get_fetched_nodes(data):
+            repo = repos.get((node['owner']['login'].lower(), node['name'].lower()))
+            if repo is not None:
+                # Spelled like the node, so the ingest functions match them up
+                node = own_login(repo, node)
+                repo.name = node['name']
+            if repo is None or repo.state == STATE_NEW:
+                new_nodes.append(node)
+                if repo is not None:
+                    todos.append(repo)
+            else:
+                fetched[(repo.owner.login, repo.name)] = repo.id
+                fetched_nodes.append(node)
+
+        refreshed = refresh_fetched_repos(self.session, fetched, fetched_nodes)
+        if self.bulk_ingest:
+            return refreshed + bulk_ingest_fetched_repos(self.session, todos, new_nodes, self.cache)
+        else:
+            return refreshed + orm_ingest_fetched_repos(self.session, todos, new_nodes)
+
+    def reingest(self, archive, since=None, until=None, commit_every=None):
+        '''Replays archived responses, oldest first, through the expansion and fetch persistence logic without
+        sending any queries. Returns a Counter of responses replayed per query kind'''
+
+        commit_every = commit_every or getattr(g, 'archive_reingest_commit', 100)
+        counts = collections.Counter()
+
+        try:
+            for record in archive.records(since, until):
+                kind = query_kind(archive.get(record.query_hash).decode('utf8'))
+                try:
+                    result = json.loads(archive.get(record.response_hash).decode('utf8'))
+                except ValueError:
+                    kind = None
+
+                if kind == EXPAND:
+                    self.reingest_expansion(record.variables, result)
+                elif kind == FETCH:
+                    self.reingest_fetch(record.variables, result)
+                elif kind == POPULAR:
+                    self.add_popular_repos(result)
+
+                counts[kind if kind in (EXPAND, FETCH, POPULAR) else 'skipped'] += 1
+                if sum(counts.values()) % commit_every == 0:
+                    self.session.commit()
+                    log.info('Replayed %d responses, up to %s', sum(counts.values()),
+                             time.asctime(time.localtime(record.time)))
 
             self.session.commit()
 
@@ -432,59 +1380,62 @@ class MainScraper():
             self.session.rollback()
             raise e
 
+        return counts
+
 
     def start(self):
         log.info('Starting scraper loop')
-        log.info('Assuming %d rate limit cost remaining', self.rate_limit_remaining)
+        serve_metrics()
+        self.frontier.backfill(self.session)
+        self.requeue_missing_repos()
+        log.info('Assuming %d rate limit cost remaining on %d tokens', self.rate_limit_remaining, len(self.tokens))
         log.info('Assuming rate limit reset time is %s', time.asctime(time.localtime(self.reset_time)))
 
         last_step_empty = False
         try:
             while True:
+                self.profiler.tick()
+                metrics.maybe_dump()
+
                 # Expansion step
-                if self.session.query(ReposTodo).first() is None:
+                if self.todo_queue.available().first() is None:
                     log.info('No repos to expand. Skipping expansion step')
                     if last_step_empty:
                         return
                     last_step_empty = True
                 else:
                     try:
-                        self.expand_repos_from_db()
+                        with metrics.timer('scraper_step_seconds', step='expand'):
+                            if self.expand_batch > 1:
+                                self.expand_repos_batched()
+                            elif self.concurrency > 1:
+                                self.expand_repos_concurrently()
+                            else:
+                                self.expand_repos_from_db()
 
-                    except RateLimit:
-                        self.rate_limit_sleep()
+                    except RateLimit as e:
+                        self.rate_limit_sleep(e.cost)
 
                     except (GithubTimeout, EmptyResultError) as e:
-                        todo = e.todo
-                        self.expand_errors.setdefault(todo.id, [])
-                        self.expand_errors[todo.id].append(e.errors)
-
-                        errors_sofar = self.expand_errors[todo.id]
-                        log.error('Error count for expanding %s/%s is %d',
-                                  todo.repo.owner.login, todo.repo.name, len(errors_sofar))
-
-                        if len(errors_sofar) > MAX_EXPAND_ERRORS:
-                            with self.session.begin_nested():
-                                self.session.add(RepoError(repo=todo.repo, error_text=repr([e for e in errors_sofar if e])))
-                                self.session.delete(todo)
-                            self.session.commit()
+                        self.record_expand_error(e)
 
                     last_step_empty = False
 
                 print()
 
                 # Fetching step
-                if self.session.query(NewRepo).first() is None:
+                if self.new_repo_queue.available().first() is None:
                     log.info('No repos to fetch. Skipping fetching step')
                     if last_step_empty:
                         return
                     last_step_empty = True
                 else:
                     try:
-                        self.fetch_new_repo_info()
+                        with metrics.timer('scraper_step_seconds', step='fetch'):
+                            self.fetch_new_repo_info()
 
-                    except RateLimit:
-                        self.rate_limit_sleep()
+                    except RateLimit as e:
+                        self.rate_limit_sleep(e.cost)
 
                     except (GithubTimeout, EmptyResultError) as e:
                         todo = e.todo
@@ -0,0 +1,125 @@
+'''Incremental decoding of batched query responses, so each aliased repo node can be ingested as soon as it has
+downloaded instead of after the whole body has been read and parsed.
+
+Needs ijson. Without it (or when github answers with an error page), the response is decoded in one go and no node
+is streamed; everything ends up in `result`.'''
+
+import time
+import logging as _logging
+
+import requests
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+from github_repos.transport import is_json
+from github_repos.metrics import metrics
+
+
+log = _logging.getLogger(__name__)
+
+CHUNK_BYTES = 64 * 1024
+
+
+class StreamedResult():
+    '''A batched query response parsed as it downloads.
+
+    Iterating it yields (alias, node) for each non-null top level field of `data` whose alias starts with `prefix`,
+    as soon as the node is complete. Afterwards `result` holds the rest of the response like send_query would have
+    returned it: errors, rateLimit, and the aliases that came back null. A body that can't be parsed or stops
+    downloading partway leaves a result with null data and an error, after the nodes that did come through.
+
+    The raw body is written to `archive` (an archive.ResponseWriter) a chunk at a time as it downloads, and it is
+    closed once the whole body has been read, or aborted if it can't be'''
+
+    def __init__(self, response, kind='other', prefix='repo', archive=None):
+        self.response = response
+        self.kind = kind
+        self.prefix = prefix
+        self.archive = archive
+        self.result = None
+
+    def __iter__(self):
+        response = self.response
+        start = time.perf_counter()
+        archived = False
+        try:
+            if ijson is None or not is_json(response):
+                self.result = self.decode()
+                archived = True
+                return
+            try:
+                yield from self.parse()
+                archived = True
+            except ijson.JSONError as e:
+                log.error('Could not parse the response: %s', e)
+                self.result = {'data': None, 'errors': [{'message': 'Bad JSON: {}'.format(e)}]}
+            except requests.RequestException as e:
+                log.error('The response was cut short: %s', e)
+                self.result = {'data': None, 'errors': [{'message': 'Cut short: {}'.format(e)}]}
+        finally:
+            response.close()
+            if self.archive is not None:
+                if archived:
+                    self.archive.close()
+                else:
+                    self.archive.abort()
+            metrics.observe('json_decode_seconds', time.perf_counter() - start, kind=self.kind)
+
+    def decode(self):
+        body = self.response.content
+        if self.archive is not None:
+            self.archive.write(body)
+        if not is_json(self.response):
+            log.error('Github returned %d %s instead of JSON', self.response.status_code,
+                      self.response.headers.get('Content-Type'))
+            return {'data': self.response.text, 'errors': [{'message': 'HTTP {}'.format(self.response.status_code)}]}
+        return self.response.json()
+
+    def chunks(self):
+        '''The decompressed body in pieces as it downloads, then None for the end of it'''
+
+        yield from self.response.iter_content(CHUNK_BYTES)
+        yield None
+
+    def parse(self):
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=True)
+
+        root = ObjectBuilder()
+        # Top level key of data whose value hasn't started yet, and the alias and builder of the node being streamed
+        key = None
+        alias = node = None
+        for chunk in self.chunks():
+            if chunk is None:
+                parser.close()
+            else:
+                if self.archive is not None:
+                    self.archive.write(chunk)
+                parser.send(chunk)
+            for prefix, event, value in events:
+                if node is not None:
+                    node.event(event, value)
+                    if event == 'end_map' and prefix == 'data.' + alias:
+                        yield alias, node.value
+                        alias = node = None
+                    continue
+
+                if prefix == 'data' and event == 'map_key':
+                    key = value
+                    continue
+                if key is not None:
+                    if event == 'start_map' and key.startswith(self.prefix):
+                        alias, key = key, None
+                        node = ObjectBuilder()
+                        node.event(event, value)
+                        continue
+                    root.event('map_key', key)
+                    key = None
+                root.event(event, value)
+            del events[:]
+
+        self.result = root.value
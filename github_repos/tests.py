@@ -1,9 +1,50 @@
+import io
+import os
+import gzip
+import json
+import time
+import types
 import unittest
+import unittest.mock
+import tempfile
+
+import requests
+import urllib3
+from requests.adapters import BaseAdapter
+from sqlalchemy import create_engine, insert, select, inspect, event, text
+from sqlalchemy import MetaData, Table, Column, Integer, String, Float
+from sqlalchemy.orm import sessionmaker
 
 from github_repos.graphql import GraphQLNode as gqn
-from github_repos.scraper import send_query
+import github_repos.scraper as scraper_module
+from github_repos.scraper import send_query, get_repos_from_expand_result, RateLimit
+from github_repos.scraper import EXPAND_QUERY, build_fetch_query, build_refresh_query, batch_variables
+from github_repos.scraper import MainScraper, get_repos_from_user_nodes, MAX_QUERY_NODES
+from github_repos.scraper import DEFAULT_EXPAND_SHAPE, expand_shape, expand_shape_of, expand_template
+from github_repos.scraper import warn_renamed_expand_flags
+from github_repos.pipeline import Pipeline
+from github_repos.bench import bench_db_url, main as bench_main
+from github_repos.fakeserver import FakeGithub, FakeGraph
+from github_repos.cache import LRU, BloomFilter, IdentityCache
+from github_repos.costmodel import CostModel, EXPAND, FETCH
+from github_repos.frontier import Frontier
+from github_repos.tokens import TokenPool
+from github_repos.workqueue import LeaseQueue
+from github_repos.transport import Transport
+from github_repos.archive import Archive
+from github_repos.streaming import StreamedResult, ijson
+from github_repos.metrics import Metrics, Profiler
+from github_repos.db import Base, Owner, OwnerType, Repo, RepoRedirect, Language, RepoLanguages, QueryCost
+from github_repos.db import STATE_NEW, STATE_TODO, STATE_EXPANDED, STATE_ERROR, STATE_MISSING
+from github_repos.db import get_engine, create_schema, insert_ignoring_conflicts
+from github_repos.ingest import bulk_ingest_fetched_repos
+from github_repos import aggregates
+from github_repos.migrations import upgrade, column_sorting
+from github_repos.graphql import Query, Fragment, Spread, Var, Enum, estimate, templates
+import github_repos.config as g
 
 class TestQuerying(unittest.TestCase):
+    @unittest.skipUnless(getattr(g, 'test_live_api', False), 'set test_live_api to query github')
     def test_query_sending(self):
         query = \
                 gqn('query')(
@@ -24,3 +65,1096 @@ class TestQuerying(unittest.TestCase):
             self.assertIn('name', repo)
             self.assertIn('owner', repo)
             self.assertIn('login', repo['owner'])
+
+
+class TestFakeGithub(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeGithub(FakeGraph(100), rate_limit=20).start()
+        self.login = self.fake.graph.owner(0)[0]
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_expand_query(self):
+        result = send_query(EXPAND_QUERY, {'owner': self.login, 'name': 'repo0'}, url=self.fake.url, api_key='a')
+        repos, count = get_repos_from_expand_result(result, None)
+
+        self.assertGreaterEqual(count, len(repos))
+        self.assertEqual(result['data']['rateLimit']['remaining'], 20 - result['data']['rateLimit']['cost'])
+
+        for _ in range(20):
+            result = send_query(EXPAND_QUERY, {'owner': self.login, 'name': 'repo0'}, url=self.fake.url, api_key='a')
+        self.assertRaises(RateLimit, get_repos_from_expand_result, result, None)
+
+    def test_expand_shape(self):
+        shape = (('repo_stars', 2), ('repo_issues_participants', 3), ('user_stars', 4), ('participants', 2))
+        template = expand_template(shape=shape)
+        self.assertEqual(expand_shape_of(template.text), shape)
+        self.assertEqual(expand_shape_of(EXPAND_QUERY), expand_shape())
+        self.assertNotIn('watchers', template.text)
+        self.assertLess(template.requests, expand_template(shape=DEFAULT_EXPAND_SHAPE).requests)
+
+        result = send_query(template.text, {'owner': self.login, 'name': 'repo0'}, url=self.fake.url, api_key='a')
+        node = result['data']['repository']
+        self.assertEqual(set(node) - {'name', 'owner'}, {'stargazers', 'issues'})
+        self.assertLessEqual(len(node['stargazers']['nodes']), 2)
+        users = node['stargazers']['nodes'] + [user for issue in node['issues']['nodes']
+                                               for user in issue['participants']['nodes']]
+        self.assertTrue(users)
+        self.assertEqual({key for user in users for key in user}, {'login', 'starredRepositories'})
+
+        repos, count = get_repos_from_expand_result(result, None)
+        self.assertEqual(count, sum(len(user['starredRepositories']['nodes']) for user in users))
+
+    def test_participants_are_opt_in(self):
+        old = types.SimpleNamespace(scraper_expand_repo_issues_participants=True,
+                                    scraper_expand_repo_pullrequest_participants=True)
+        with self.assertLogs('github_repos.scraper', 'WARNING') as logs:
+            warn_renamed_expand_flags(old)
+        self.assertEqual(len(logs.output), 2)
+        self.assertNotIn('participants', dict(expand_shape(old)))
+
+        new = types.SimpleNamespace(scraper_expand_issue_participants=True)
+        self.assertEqual(dict(expand_shape(new))['participants'], 5)
+        self.assertNotIn('repo_pullrequest_participants', dict(expand_shape(new)))
+
+    def test_fetch_query(self):
+        variables = batch_variables([(self.login, 'repo0'), (self.login, 'nope')])
+        result = send_query(build_fetch_query(2), variables, url=self.fake.url, api_key='a')
+
+        self.assertEqual(result['data']['repo1']['name'], 'repo0')
+        self.assertIsNone(result['data']['repo2'])
+        self.assertEqual(result['errors'][0]['path'], ['repo2'])
+
+    def test_refresh_markers(self):
+        variables = batch_variables([(self.login, 'repo0')])
+        before = send_query(build_refresh_query(1), variables, url=self.fake.url, api_key='a')['data']
+        self.fake.graph.touch(0)
+        after = send_query(build_refresh_query(1), variables, url=self.fake.url, api_key='a')['data']
+
+        self.assertEqual(before['rateLimit']['cost'], 1)
+        self.assertNotEqual(before['repo1']['pushedAt'], after['repo1']['pushedAt'])
+
+    def test_timeout_page(self):
+        self.fake.timeout_rate = 1
+        result = send_query(EXPAND_QUERY, {'owner': self.login, 'name': 'repo0'}, url=self.fake.url, api_key='a',
+                            sender=requests.post)
+        self.assertIsInstance(result['data'], str)
+
+
+class TestBench(unittest.TestCase):
+    def test_refuses_the_crawl_database(self):
+        with unittest.mock.patch.object(g, 'db_url', 'postgresql://me@localhost:5432/github', create=True):
+            for url in (None, '', 'postgresql+psycopg2://me@LOCALHOST/github'):
+                with unittest.mock.patch.object(g, 'bench_db_url', url, create=True):
+                    self.assertRaises(ValueError, bench_db_url)
+                    self.assertEqual(bench_main(['scrape', '10']), 1)
+
+            with unittest.mock.patch.object(g, 'bench_db_url', 'postgresql://me@localhost/github_bench', create=True):
+                self.assertEqual(bench_db_url(), 'postgresql://me@localhost/github_bench')
+
+
+class TestQueryBuilder(unittest.TestCase):
+    def test_query_compiling(self):
+        repo_info = Fragment('repoInfo', 'Repository')('name', gqn('owner')('login'))
+        query = Query(variables={'owner': 'String!'}, fragments=[repo_info])(
+            gqn('repositoryOwner', login=Var('owner'))(
+                gqn('repositories', first=10, orderBy={'field': Enum('STARGAZERS'), 'direction': Enum('DESC')})(
+                    gqn('nodes')(
+                        Spread('repoInfo'),
+                        gqn('languages', first=5)(
+                            gqn('nodes')('name'))))))
+
+        text = query.format()
+        self.assertTrue(text.startswith('query($owner: String!) {'))
+        self.assertIn('repositoryOwner (login: $owner)', text)
+        self.assertIn('orderBy: {field: STARGAZERS, direction: DESC}', text)
+        self.assertIn('fragment repoInfo on Repository', text)
+
+        self.assertEqual(estimate(query), (10 + 10 * 5, 1 + 10, 1))
+
+        template = templates.get(('test', 1), lambda: query)
+        self.assertIs(templates.get(('test', 1), lambda: self.fail('rebuilt a cached template')), template)
+        self.assertEqual(template.text, text)
+
+
+class TestIdentityCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        lru = LRU(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertIn('a', lru)
+        self.assertNotIn('b', lru)
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add((i, 'repo%d' % i))
+
+        for i in range(1000):
+            self.assertIn((i, 'repo%d' % i), bloom)
+
+        false_positives = sum((i, 'repo%d' % i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+
+    def test_rollback_forgets_looked_up_rows(self):
+        engine = get_engine('sqlite://')
+        create_schema(engine)
+        session = sessionmaker(engine)()
+        cache = IdentityCache(use_bloom=False)
+        cache.attach(session)
+
+        # Written without the ORM, so the cache only learns of the row by looking it up
+        session.execute(insert(Owner.__table__).values(id=7, login='ghost', type_id=1))
+        self.assertEqual(cache.owner_id(session, 'ghost'), 7)
+        session.rollback()
+        self.assertIsNone(cache.owner_id(session, 'ghost'))
+
+        session.execute(insert(Owner.__table__).values(id=7, login='ghost', type_id=1))
+        session.commit()
+        self.assertEqual(cache.owner_id(session, 'ghost'), 7)
+        session.commit()
+        self.assertEqual(cache.owners.get('ghost'), 7)
+
+        cache.detach(session)
+        session.close()
+
+    def test_warm_loads_most_recent_rows(self):
+        engine = get_engine('sqlite://')
+        create_schema(engine)
+        session = sessionmaker(engine)()
+        session.execute(insert(Owner.__table__).values(id=1, login='someone', type_id=1))
+        session.execute(insert(Repo.__table__), [{'id': i, 'owner_id': 1, 'name': 'repo%d' % i, 'state': STATE_NEW}
+                                                 for i in range(1, 6)])
+
+        cache = IdentityCache(maxsize=2, use_bloom=True)
+        cache.warm(session)
+        self.assertEqual(list(cache.repos.items), [(1, 'repo4'), (1, 'repo5')])
+        self.assertTrue(all((1, 'repo%d' % i) in cache.bloom for i in range(1, 6)))
+        session.close()
+
+
+class TestFrontier(unittest.TestCase):
+    def test_expansions_shift_priorities(self):
+        engine = get_engine('sqlite://')
+        create_schema(engine)
+        session = sessionmaker(engine)()
+        frontier = Frontier()
+
+        owners = [Owner(login=login, expansions=1, yielded=3) for login in ('a', 'b')]
+        session.add_all(owners)
+        session.flush()
+        stars = {'x': 10, 'y': 0, 'z': 200, 'w': 5}
+        repos = [Repo(owner=owners[0], name=name, state=STATE_TODO, stars=stars[name], sightings=2,
+                      priority=frontier.score(stars[name], 2, 1, 3)) for name in ('x', 'y', 'z')]
+        repos += [Repo(owner=owners[0], name='unscored', state=STATE_TODO),
+                  Repo(owner=owners[1], name='w', state=STATE_TODO, stars=5, priority=frontier.score(5, 0, 1, 3))]
+        session.add_all(repos)
+        session.commit()
+
+        frontier.note_expansions(session, {owners[0].id: (3, 0)})
+        session.commit()
+
+        priorities = dict(session.query(Repo.name, Repo.priority))
+        for name in ('x', 'y', 'z'):
+            self.assertAlmostEqual(priorities[name], frontier.score(stars[name], 2, 4, 3))
+        self.assertAlmostEqual(priorities['w'], frontier.score(5, 0, 1, 3))
+        self.assertIsNone(priorities['unscored'])
+        self.assertEqual(session.query(Owner.expansions, Owner.yielded).filter_by(login='a').one(), (4, 3))
+
+        order = [name for name, in session.query(Repo.name).order_by(*frontier.order_by)]
+        self.assertEqual(order, ['z', 'x', 'w', 'y', 'unscored'])
+
+        # Equal priorities are claimed oldest first
+        session.add_all([Repo(owner=owners[1], name=name, state=STATE_TODO, priority=100.0) for name in ('p', 'q')])
+        session.commit()
+        order = [name for name, in session.query(Repo.name).order_by(*frontier.order_by).limit(2)]
+        self.assertEqual(order, ['p', 'q'])
+        session.close()
+
+class TestCostModel(unittest.TestCase):
+    def test_learns_linear_cost(self):
+        model = CostModel(margin=0)
+        for _ in range(20):
+            for n in (1, 5, 10, 20):
+                model.update(EXPAND, n, n)
+
+        self.assertIn(model.predict(EXPAND, 10), (10, 11))
+
+        batch_size = model.best_batch_size(EXPAND, 50, 30)
+        self.assertGreater(batch_size, 20)
+        self.assertLessEqual(model.predict(EXPAND, batch_size), 28)
+        self.assertEqual(model.best_batch_size(EXPAND, 50, 2), 0)
+
+
+    def test_loads_costs_of_current_shape(self):
+        engine = get_engine('sqlite://')
+        create_schema(engine)
+        session = sessionmaker(engine)()
+        for _ in range(20):
+            for n in (1, 5, 10, 20):
+                session.add_all([QueryCost(query_type=EXPAND, shape='stars:10', batch_size=n, normalized_actual=n),
+                                 QueryCost(query_type=EXPAND, shape='stars:100', batch_size=n,
+                                           normalized_actual=10 * n),
+                                 QueryCost(query_type=EXPAND, batch_size=n, normalized_actual=100 * n),
+                                 QueryCost(query_type=FETCH, batch_size=n * 25, normalized_actual=n)])
+        session.commit()
+
+        model = CostModel(margin=0)
+        model.set_prior(EXPAND, 0.0, 5.0, 10, shape='stars:10')
+        model.load(session)
+        self.assertIn(model.predict(EXPAND, 10), (10, 11))
+        self.assertIn(model.predict(FETCH, 250), (10, 11))
+
+        model.set_prior(EXPAND, 0.0, 5.0, 10, shape='stars:100')
+        model.load(session)
+        self.assertIn(model.predict(EXPAND, 10), (100, 101))
+        session.close()
+
+
+class TestLeaseQueue(unittest.TestCase):
+    def test_leases(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = get_engine('sqlite:///' + os.path.join(directory, 'queue.db'))
+            create_schema(engine)
+            with engine.begin() as conn:
+                conn.execute(insert(Owner.__table__).values(id=1, login='someone', type_id=1))
+                conn.execute(insert(Repo.__table__), [{'id': i, 'owner_id': 1, 'name': 'repo%d' % i,
+                                                       'state': STATE_TODO} for i in range(1, 5)])
+
+            def queue(worker_id):
+                return LeaseQueue(sessionmaker(engine)(), Repo, (Repo.state == STATE_TODO,), worker_id=worker_id,
+                                  lease_seconds=60)
+            first, second = queue('first'), queue('second')
+
+            def claim(queue, n):
+                # Ends the read the claimed rows were loaded in, like a worker going on to do the work would
+                rows = [(repo.id, repo.attempts, repo.leased_by) for repo in queue.claim(n)]
+                queue.session.commit()
+                return rows
+
+            self.assertEqual(claim(first, 2), [(1, None, 'first'), (2, None, 'first')])
+            # A live lease is skipped
+            self.assertEqual(claim(second, 4), [(3, None, 'second'), (4, None, 'second')])
+            self.assertEqual(claim(first, 1), [])
+
+            # Released rows go back to the queue, with no attempt counted
+            first.release([1])
+            self.assertEqual(claim(second, 1), [(1, None, 'second')])
+
+            # An expired lease is reclaimed, counting an attempt for the worker that let it lapse
+            first.session.query(Repo).filter(Repo.id == 2).update({Repo.lease_expires: time.time() - 1})
+            first.session.commit()
+            self.assertEqual(claim(second, 1), [(2, 1, 'second')])
+            self.assertEqual(first.available().count(), 0)
+
+            for worker in (first, second):
+                worker.session.close()
+
+
+class TestTokenPool(unittest.TestCase):
+    def test_routes_to_most_headroom(self):
+        pool = TokenPool(['a', 'b'])
+        a, b = pool.tokens
+        pool.update(a, 100, a.reset_time)
+        pool.update(b, 50, b.reset_time)
+
+        self.assertIs(pool.acquire(60), a)
+        self.assertIs(pool.acquire(30), b)
+        self.assertIsNone(pool.acquire(40))
+
+        pool.release(a, 60)
+        self.assertIs(pool.acquire(30), a)
+
+    def test_rolls_over_after_reset(self):
+        pool = TokenPool(['a'])
+        token = pool.tokens[0]
+        pool.update(token, 0, token.reset_time)
+        self.assertIsNone(pool.acquire(1))
+
+        token.reset_time = 0
+        self.assertIs(pool.acquire(1), token)
+
+    def test_paces_spend_over_window(self):
+        pool = TokenPool(['a'], pacing=True, burst=10)
+        token = pool.tokens[0]
+        # 1000 points to spend over 1000 seconds
+        pool.update(token, 1002, time.time() + 1000)
+
+        self.assertIs(pool.acquire(10), token)
+        self.assertIsNone(pool.acquire(5))
+        self.assertAlmostEqual(pool.wait_time(5), 5, delta=0.5)
+
+        token.filled_at -= 6
+        self.assertIs(pool.acquire(5), token)
+        # Costlier than the bucket holds: waits for a full bucket
+        self.assertAlmostEqual(pool.wait_time(100), 10, delta=1)
+        self.assertGreater(pool.wait_time(2000), 1000)
+
+        unpaced = TokenPool(['a'], pacing=False)
+        self.assertIs(unpaced.acquire(1000), unpaced.tokens[0])
+        self.assertEqual(unpaced.wait_time(1000), 0)
+
+
+class StubAdapter(BaseAdapter):
+    '''Answers each request with the next of `replies`, (status, body bytes, headers) or an exception to raise'''
+
+    def __init__(self, replies):
+        super().__init__()
+        self.replies = list(replies)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        status, body, headers = reply
+        raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers=headers, status=status, preload_content=False)
+        return requests.adapters.HTTPAdapter().build_response(request, raw)
+
+    def close(self):
+        pass
+
+class TestTransport(unittest.TestCase):
+    def transport(self, replies, **kwargs):
+        transport = Transport(backoff=2.0, **kwargs)
+        adapter = StubAdapter(replies)
+        transport.session.mount('http://', adapter)
+        return transport, adapter
+
+    def test_retries_with_backoff_then_decodes_gzip(self):
+        body = gzip.compress(json.dumps({'data': {'viewer': {'login': 'someone'}}}).encode('utf8'))
+        transport, adapter = self.transport([
+            (503, b'<html>weird timeout page</html>', {'Content-Type': 'text/html'}),
+            requests.ConnectionError('connection reset'),
+            (200, body, {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})], retries=3)
+
+        with unittest.mock.patch('github_repos.transport.time.sleep') as sleep:
+            response = transport.post('http://github.invalid/graphql', {'query': '{viewer{login}}'})
+        self.assertEqual([call.args for call in sleep.call_args_list], [(2.0,), (4.0,)])
+        self.assertEqual(response.json(), {'data': {'viewer': {'login': 'someone'}}})
+        self.assertEqual(len(adapter.sent), 3)
+        self.assertEqual([record.status for record in transport.records], [503, 200])
+        self.assertEqual(transport.records[-1].attempts, 3)
+        # The gzipped size, as it came over the wire
+        self.assertEqual(transport.records[-1].wire_bytes_received, len(body))
+
+    def test_gives_up_after_retries(self):
+        transport, adapter = self.transport([(502, b'', {})] * 3, retries=2)
+        with unittest.mock.patch('github_repos.transport.time.sleep') as sleep:
+            response = transport.post('http://github.invalid/graphql', {})
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(sleep.call_count, 2)
+
+        transport, adapter = self.transport([requests.Timeout('read timed out')] * 2, retries=1)
+        with unittest.mock.patch('github_repos.transport.time.sleep'):
+            self.assertRaises(requests.Timeout, transport.post, 'http://github.invalid/graphql', {})
+
+    def test_gzips_requests(self):
+        transport, adapter = self.transport([(200, b'{}', {'Content-Type': 'application/json'})],
+                                            gzip_requests=True)
+        transport.post('http://github.invalid/graphql', {'query': '{viewer{login}}'})
+        request = adapter.sent[0]
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(request.body)), {'query': '{viewer{login}}'})
+
+class TestArchive(unittest.TestCase):
+    def test_stores_blobs_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive = Archive(directory)
+            first = archive.put('query { a }', None, b'{"data": {"a": 1}}')
+            second = archive.put('query { a }', {'x': 1}, b'{"data": {"a": 2}}')
+            archive.put('query { b }', None, b'{"data": {"a": 1}}', 502)
+
+            self.assertEqual(first.query_hash, second.query_hash)
+            self.assertEqual(archive.get(second.response_hash), b'{"data": {"a": 2}}')
+            self.assertEqual(len(archive.blobs), 4)
+            archive.close()
+
+            archive = Archive(directory)
+            records = list(archive.records())
+            self.assertEqual([record.status for record in records], [200, 200, 502])
+            self.assertEqual(records[1].variables, {'x': 1})
+            self.assertEqual(len(list(archive.records(query_hash=first.query_hash))), 2)
+            self.assertEqual(archive.get(records[2].response_hash), b'{"data": {"a": 1}}')
+            archive.close()
+
+
+    def test_writes_bodies_as_they_download(self):
+        body = json.dumps({'data': {'repo1': {'name': 'a'}, 'repo2': None, 'rateLimit': {'cost': 1}}}).encode('utf8')
+        with tempfile.TemporaryDirectory() as directory:
+            archive = Archive(directory)
+            writer = archive.writer('query { a }', {'x': 1})
+            for i in range(0, len(body), 7):
+                writer.write(body[i:i + 7])
+            record = writer.close()
+            self.assertEqual(archive.get(record.response_hash), body)
+            self.assertEqual(record.response_hash, archive.put('query { a }', None, body).response_hash)
+            self.assertEqual(len(archive.blobs), 2)
+
+            writer = archive.writer('query { a }', None)
+            writer.write(b'{"data": ')
+            writer.abort()
+            self.assertEqual(len(list(archive.records())), 2)
+
+            # Streamed through a response, in chunks of whatever size the transport reads
+            response = requests.adapters.HTTPAdapter().build_response(
+                requests.Request('POST', 'http://github.invalid/graphql').prepare(),
+                urllib3.HTTPResponse(body=io.BytesIO(gzip.compress(body)), preload_content=False, status=200,
+                                     headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}))
+            streamed = StreamedResult(response, archive=archive.writer('query { b }', None))
+            self.assertEqual(list(streamed), [('repo1', {'name': 'a'})] if ijson is not None else [])
+            records = list(archive.records())
+            self.assertEqual(len(records), 3)
+            self.assertEqual(archive.get(records[-1].response_hash), body)
+            archive.close()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        metrics = Metrics()
+        metrics.describe('queries_total', 'Queries sent')
+        metrics.inc('queries_total', kind='expand')
+        metrics.inc('queries_total', 2, kind='expand')
+        metrics.observe('query_seconds', 0.003)
+        metrics.observe('query_seconds', 7.0)
+
+        lines = metrics.render().splitlines()
+        self.assertIn('# HELP queries_total Queries sent', lines)
+        self.assertIn('queries_total{kind="expand"} 3', lines)
+        self.assertIn('query_seconds_bucket{le="0.001"} 0', lines)
+        self.assertIn('query_seconds_bucket{le="0.005"} 1', lines)
+        self.assertIn('query_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('query_seconds_count 2', lines)
+
+    def test_profiler_control(self):
+        with tempfile.TemporaryDirectory() as directory:
+            control = os.path.join(directory, 'profile')
+            profiler = Profiler(control)
+            profiler.tick()
+            self.assertIsNone(profiler.mode)
+
+            with open(control, 'w') as f:
+                f.write('cprofile 2\n')
+            for _ in range(5):
+                profiler.tick()
+            self.assertEqual(profiler.mode, 'cprofile')
+
+            os.remove(control)
+            profiler.tick()
+            self.assertIsNone(profiler.mode)
+            self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.prof')]), 2)
+
+class TestMigrations(unittest.TestCase):
+    def test_consolidates_repo_tables(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'crawl.db'))
+            Base.metadata.create_all(engine)
+
+            old = MetaData()
+            new_repos = Table('new_repos', old, Column('id', Integer, primary_key=True), Column('owner_id', Integer),
+                              Column('name', String), Column('sightings', Integer))
+            repos_todo = Table('repos_todo', old, Column('id', Integer, primary_key=True),
+                               Column('repo_id', Integer), Column('priority', Float))
+            repo_errors = Table('repo_errors', old, Column('id', Integer, primary_key=True),
+                                Column('repo_id', Integer), Column('error_text', String))
+            old.create_all(engine)
+
+            with engine.begin() as conn:
+                conn.execute(insert(OwnerType.__table__), [{'id': 1, 'type': 'User'}])
+                conn.execute(insert(Owner.__table__), [{'id': 1, 'login': 'someone', 'type_id': 1}])
+                conn.execute(insert(Repo.__table__), [{'id': i, 'name': 'repo%d' % i, 'owner_id': 1}
+                                                      for i in range(1, 6)])
+                conn.execute(insert(repos_todo), [{'repo_id': 1, 'priority': 2.0}, {'repo_id': 2, 'priority': None}])
+                conn.execute(insert(repo_errors), [{'repo_id': 3, 'error_text': 'NOT_FOUND'}])
+                conn.execute(insert(new_repos), [{'owner_id': 1, 'name': 'repo6', 'sightings': 3},
+                                                 {'owner_id': 1, 'name': 'REPO1', 'sightings': None}])
+
+            # The todo index as it was before id was descending
+            with engine.begin() as conn:
+                conn.execute(text('DROP INDEX ix_repositories_todo_priority_id'))
+                conn.execute(text("CREATE INDEX ix_repositories_todo_priority_id ON repositories (priority, id) "
+                                  "WHERE state = 'todo'"))
+
+            self.assertEqual(upgrade(engine, chunk=1), 5)
+            self.assertEqual(upgrade(engine), 0)
+            self.assertEqual(column_sorting(engine, Repo, 'ix_repositories_todo_priority_id'), {'id': ('desc',)})
+
+            with engine.connect() as conn:
+                states = {name: (state, priority, errors, sightings) for name, state, priority, errors, sightings in
+                          conn.execute(select(Repo.name, Repo.state, Repo.priority, Repo.errors, Repo.sightings))}
+            self.assertEqual(states, {'repo1': (STATE_TODO, 2.0, None, None),
+                                      'repo2': (STATE_TODO, None, None, None),
+                                      'repo3': (STATE_ERROR, None, 'NOT_FOUND', None),
+                                      'repo4': (STATE_EXPANDED, None, None, None),
+                                      'repo5': (STATE_EXPANDED, None, None, None),
+                                      'repo6': (STATE_NEW, None, None, 3)})
+            self.assertFalse({'new_repos', 'repos_todo', 'repo_errors'} & set(inspect(engine).get_table_names()))
+
+try:
+    import numpy as np
+    from github_repos.edges import EdgeLog, EdgeGraph, compact, CONTRIBUTED, STARRED, ISSUE, WATCHES
+except ImportError:
+    np = None
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestEdges(unittest.TestCase):
+    def test_compacts_segments(self):
+        owner = {'login': 'x', '__typename': 'User'}
+        user_nodes = [{'login': 'alice',
+                       'contributedRepositories': {'nodes': [{'name': 'a', 'owner': owner}]},
+                       'issues': {'nodes': [{'repository': {'name': 'b', 'owner': owner}}]}},
+                      {'login': 'bob',
+                       'starredRepositories': {'nodes': [{'name': 'a', 'owner': owner}]}}]
+        edges = []
+        get_repos_from_user_nodes(user_nodes, edges)
+        self.assertEqual(sorted(edges), [('alice', ('x', 'a'), CONTRIBUTED), ('alice', ('x', 'b'), ISSUE),
+                                         ('bob', ('x', 'a'), STARRED)])
+
+        with tempfile.TemporaryDirectory() as directory:
+            edge_log = EdgeLog(directory, segment_edges=2)
+            edge_log.append(edges)
+            edge_log.append(edges[:1])
+            edge_log.close()
+            self.assertEqual(compact(directory), 4)
+
+            # Another process, and a segment cut short mid-edge
+            edge_log = EdgeLog(directory)
+            edge_log.append([('carol', ('x', 'a'), WATCHES), ('bob', ('x', 'b'), STARRED)])
+            with open(os.path.join(directory, edge_log.segment_name + '.edges'), 'ab') as f:
+                f.write(b'\0\0')
+            edge_log.close()
+            self.assertEqual(compact(directory), 2)
+            self.assertEqual(compact(directory), 0)
+
+            graph = EdgeGraph(directory)
+            self.assertEqual(len(graph.user_repos), 5)
+            a = graph.repo_id('x', 'a')
+            self.assertEqual(sorted(graph.users[i] for i in graph.users_of(a)), ['alice', 'bob', 'carol'])
+            self.assertEqual([graph.users[i] for i in graph.users_of(a, STARRED)], ['bob'])
+            self.assertEqual(sorted(graph.repos[i] for i in graph.repos_of(graph.user_id('bob'))), ['x/a', 'x/b'])
+            self.assertEqual(graph.user_degree(graph.user_id('alice')), 2)
+            self.assertEqual(graph.repo_degrees().tolist(), [graph.repo_degree(i) for i in range(len(graph.repos))])
+            self.assertIsNone(graph.user_id('dave'))
+
+class TestAggregates(unittest.TestCase):
+    def setUp(self):
+        engine = get_engine('sqlite://')
+        create_schema(engine)
+        self.session = sessionmaker(engine)()
+        owner = Owner(login='someone')
+        python, c = Language(name='Python'), Language(name='C')
+        self.session.add_all([owner, python, c])
+        self.session.add_all([Repo(owner=owner, name='a', state=STATE_TODO),
+                              Repo(owner=owner, name='b', state=STATE_EXPANDED),
+                              Repo(owner=owner, name='c', state=STATE_NEW)])
+        self.session.flush()
+        self.session.add_all([RepoLanguages(repo_id=1, lang_id=python.id, bytes_used=100),
+                              RepoLanguages(repo_id=2, lang_id=python.id, bytes_used=50),
+                              RepoLanguages(repo_id=2, lang_id=c.id, bytes_used=None)])
+        self.session.commit()
+        self.python, self.c = python.id, c.id
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_check_and_rebuild(self):
+        aggregates.ensure(self.session)
+        self.assertEqual(aggregates.stored(self.session),
+                         ({'repos': 2, 'owners': 1, 'new_repos': 1, 'repos_todo': 1, 'repo_errors': 0,
+                           'repos_missing': 0},
+                          {self.python: (2, 150), self.c: (1, 0)}))
+        self.assertEqual(aggregates.check(self.session), {})
+
+        aggregates.add(self.session, repos=3, repos_todo=0)
+        aggregates.add_languages(self.session, [{'lang_id': self.c, 'bytes_used': 7}], sign=-1)
+        self.assertEqual(aggregates.check(self.session), {'repos': (5, 2), ('language', self.c): ((0, -7), (1, 0))})
+
+        aggregates.rebuild(self.session)
+        self.assertEqual(aggregates.check(self.session), {})
+
+    def test_updates_rows_in_key_order(self):
+        aggregates.ensure(self.session)
+        updated = []
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE') and executemany:
+                updated.append([row[-1] for row in parameters])
+
+        event.listen(self.session.get_bind(), 'before_cursor_execute', before_execute)
+        aggregates.add(self.session, repos_todo=-1, repos=1, new_repos=-1)
+        aggregates.add_languages(self.session, [{'lang_id': self.c, 'bytes_used': 2},
+                                                {'lang_id': self.python, 'bytes_used': 1}])
+        event.remove(self.session.get_bind(), 'before_cursor_execute', before_execute)
+
+        self.assertEqual(updated, [['new_repos', 'repos', 'repos_todo'], sorted([self.python, self.c])])
+
+class TestBulkIngest(unittest.TestCase):
+    def setUp(self):
+        engine = get_engine('sqlite://')
+        create_schema(engine)
+        self.session = sessionmaker(engine)()
+        self.graph = FakeGraph(100)
+
+    def tearDown(self):
+        self.session.close()
+
+    def add_owners(self, repos):
+        types = {}
+        for repo in repos:
+            login, typename = self.graph.owner(repo)
+            if typename not in types:
+                types[typename] = self.session.query(OwnerType).filter_by(typename=typename).first() \
+                    or OwnerType(typename=typename)
+            if not self.session.query(Owner).filter_by(login=login).count():
+                self.session.add(Owner(login=login, owner_type=types[typename]))
+                self.session.flush()
+
+    def test_insert_ignoring_conflicts(self):
+        self.session.add(Language(name='Python', color='#3572A5'))
+        self.session.flush()
+        self.session.execute(insert_ignoring_conflicts(self.session, Language.__table__)
+                             .values([{'name': 'Python', 'color': None}, {'name': 'C', 'color': None},
+                                      {'name': 'C', 'color': '#555555'}]))
+        self.assertEqual(sorted(self.session.query(Language.name, Language.color)),
+                         [('C', None), ('Python', '#3572A5')])
+
+        session = unittest.mock.Mock()
+        session.bind.dialect.name = 'oracle'
+        self.assertRaises(NotImplementedError, insert_ignoring_conflicts, session, Language.__table__)
+
+    def test_duplicate_languages_across_batches(self):
+        self.add_owners(range(40))
+        aggregates.ensure(self.session)
+
+        for batch in (range(20), range(20, 40)):
+            nodes = [self.graph.fetch_node(repo) for repo in batch]
+            self.assertEqual(bulk_ingest_fetched_repos(self.session, [], nodes), len(nodes))
+            self.session.commit()
+
+        languages = {edge['node']['name'] for repo in range(40)
+                     for edge in self.graph.fetch_node(repo)['languages']['edges']}
+        self.assertEqual(sorted(name for name, in self.session.query(Language.name)), sorted(languages))
+        self.assertEqual(self.session.query(RepoLanguages).count(),
+                         sum(len(self.graph.fetch_node(repo)['languages']['edges']) for repo in range(40)))
+        self.assertEqual(aggregates.check(self.session), {})
+
+class TestSqliteCrawl(unittest.TestCase):
+    def database(self, directory, name):
+        engine = get_engine('sqlite:///' + os.path.join(directory, name))
+        create_schema(engine)
+        session = sessionmaker(engine)()
+        session.add_all([OwnerType('User'), OwnerType('Organization')])
+        session.commit()
+        return session
+
+    def crawl(self, directory, pipeline, poisoned=(), broken=(), stream=False):
+        session = self.database(directory, 'pipeline.db' if pipeline else 'stream.db' if stream else 'crawl.db')
+
+        with FakeGithub(FakeGraph(100), rate_limit=10**6) as fake:
+            fake.poisoned.update(poisoned)
+            fake.broken.update(broken)
+            scraper = MainScraper(concurrency=2, tokens=TokenPool(['a']), api_url=fake.url, session=session,
+                                  cache=IdentityCache(use_bloom=True))
+            scraper.stream_fetches = stream
+            scraper.stream_chunk = 3
+            scraper.populate_most_popular()
+            if pipeline:
+                Pipeline(scraper).run()
+            else:
+                scraper.start()
+
+        self.assertEqual(aggregates.check(session), {})
+        repos = {(owner, name, state) for owner, name, state in
+                 session.query(Owner.login, Repo.name, Repo.state).join(Repo.owner)}
+        scraper.cache.detach(session)
+        session.close()
+        return repos
+
+    def test_workers_adding_the_same_repos(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'race.db')
+            aggregates.ensure(session)
+
+            def scraper(session):
+                return MainScraper(tokens=TokenPool(['a']), api_url='http://github.invalid', session=session,
+                                   cache=IdentityCache(use_bloom=False))
+
+            first = scraper(session)
+            first.add_new_repos({(('someone', 'User'), 'a'), (('someone', 'User'), 'b')})
+            first.session.commit()
+
+            second = scraper(sessionmaker(session.get_bind())())
+            # The second worker looked the owner and repos up before the first one committed them
+            with unittest.mock.patch.object(second.cache, 'owner_id', return_value=None):
+                new = second.add_new_repos({(('someone', 'User'), 'A'), (('someone', 'User'), 'c')})
+            second.session.commit()
+
+            self.assertEqual(len(new), 2)
+            self.assertEqual(sorted(name for name, in session.query(Repo.name)), ['a', 'b', 'c'])
+            self.assertEqual(session.query(Owner).count(), 1)
+            self.assertEqual(aggregates.check(session), {})
+            for worker in (first, second):
+                worker.session.close()
+
+    def test_pipeline_holds_depth_batches_in_flight(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'depth.db')
+            graph = FakeGraph(100)
+            scraper = MainScraper(concurrency=1, expand_batch=2, tokens=TokenPool(['a']),
+                                  api_url='http://github.invalid', session=session, cache=IdentityCache())
+            scraper.add_new_repos([(graph.owner(repo), 'repo%d' % repo) for repo in range(6)])
+            session.query(Repo).update({Repo.state: STATE_TODO})
+            session.commit()
+
+            # No senders are running, so the batches stay queued and the next fill has no room
+            pipeline = Pipeline(scraper, depth=2)
+            for _ in range(2):
+                pipeline.fill()
+                self.assertEqual(len(pipeline.outstanding), 2)
+                self.assertEqual(pipeline.requests.qsize(), 2)
+                self.assertEqual(session.query(Repo).filter(Repo.leased_by.isnot(None)).count(), 4)
+
+            pipeline.stop()
+            self.assertEqual(pipeline.outstanding, {})
+            self.assertEqual(session.query(Repo).filter(Repo.leased_by.isnot(None)).count(), 0)
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_batched_expansion_keeps_failed_aliases_queued(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'batch.db')
+            graph = FakeGraph(100)
+            with FakeGithub(graph, rate_limit=10**6) as fake:
+                # repo1 comes back null with an error, and gone doesn't exist
+                fake.broken.add(1)
+                scraper = MainScraper(expand_batch=4, tokens=TokenPool(['a']), api_url=fake.url, session=session,
+                                      cache=IdentityCache())
+                keys = [(graph.owner(repo), 'repo%d' % repo) for repo in range(3)] + [(graph.owner(0), 'gone')]
+                scraper.add_new_repos(keys)
+                session.query(Repo).update({Repo.state: STATE_TODO})
+                session.commit()
+
+                scraper.expand_repos_batched()
+                self.assertEqual(fake.queries[EXPAND], 1)
+
+            states = {name: (state, attempts, leased_by) for name, state, attempts, leased_by in
+                      session.query(Repo.name, Repo.state, Repo.attempts, Repo.leased_by)
+                      .filter(Repo.name.in_([name for _, name in keys]))}
+            self.assertEqual(states, {'repo0': (STATE_EXPANDED, None, None), 'repo2': (STATE_EXPANDED, None, None),
+                                      'repo1': (STATE_TODO, 1, None), 'gone': (STATE_TODO, 1, None)})
+            self.assertTrue(session.query(Repo).filter(Repo.state == STATE_NEW).count())
+
+            # However many todos are asked for, a batch stays under the node limit
+            scraper.expand_batch = 10**6
+            self.assertLessEqual(scraper.expand_batch_size() * expand_template(shape=scraper.expand_shape).nodes,
+                                 MAX_QUERY_NODES)
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_reingest_rebuilds_the_crawl(self):
+        def snapshot(session):
+            return ({login for login, in session.query(Owner.login)},
+                    {(owner, name, state) for owner, name, state in
+                     session.query(Owner.login, Repo.name, Repo.state).join(Repo.owner)},
+                    {(owner, name, language) for owner, name, language in
+                     session.query(Owner.login, Repo.name, Language.name).join(Repo.owner)
+                     .join(RepoLanguages, RepoLanguages.repo_id == Repo.id)
+                     .join(Language, Language.id == RepoLanguages.lang_id)})
+
+        class EdgeList(list):
+            append = list.extend
+
+        with tempfile.TemporaryDirectory() as directory:
+            archive = Archive(os.path.join(directory, 'archive'))
+            crawl_edges, reingest_edges = EdgeList(), EdgeList()
+
+            session = self.database(directory, 'reingest.db')
+            with FakeGithub(FakeGraph(60), rate_limit=10**6) as fake, \
+                    unittest.mock.patch.object(scraper_module, 'get_archive', return_value=archive), \
+                    unittest.mock.patch.object(scraper_module, 'get_edge_log', return_value=crawl_edges):
+                scraper = MainScraper(tokens=TokenPool(['a']), api_url=fake.url, session=session,
+                                      cache=IdentityCache())
+                scraper.populate_most_popular()
+                scraper.start()
+            crawled = snapshot(session)
+            scraper.cache.detach(session)
+            session.close()
+            Base.metadata.drop_all(session.get_bind())
+
+            session = self.database(directory, 'reingest.db')
+            with unittest.mock.patch.object(Transport, 'post', side_effect=AssertionError('sent a query')) as post, \
+                    unittest.mock.patch.object(scraper_module, 'get_edge_log', return_value=reingest_edges):
+                scraper = MainScraper(tokens=TokenPool(['a']), api_url='http://github.invalid', session=session,
+                                      cache=IdentityCache())
+                counts = scraper.reingest(archive)
+            self.assertFalse(post.called)
+            self.assertEqual(counts[EXPAND], fake.queries[EXPAND])
+            self.assertEqual(counts[FETCH], fake.queries[FETCH])
+
+            self.assertTrue(crawled[2])
+            self.assertEqual(snapshot(session), crawled)
+            self.assertEqual({state for _, _, state in crawled[1]}, {STATE_EXPANDED})
+            self.assertTrue(crawl_edges)
+            self.assertEqual(sorted(reingest_edges), sorted(crawl_edges))
+            self.assertEqual(aggregates.check(session), {})
+            archive.close()
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_errors_are_not_crawled_repos(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'errors.db')
+            scraper = MainScraper(tokens=TokenPool(['a']), api_url='http://github.invalid', session=session,
+                                  cache=IdentityCache())
+            scraper.add_new_repos([(('someone', 'User'), 'fetched'), (('someone', 'User'), 'new')])
+            fetched, new = session.query(Repo).order_by(Repo.name)
+            fetched.state = STATE_TODO
+            aggregates.add(session, repos=1, repos_todo=1, new_repos=-1)
+            session.commit()
+
+            for _ in range(scraper_module.MAX_FETCH_ATTEMPTS):
+                scraper.record_fetch_error(scraper_module.EmptyResultError(['NOT_FOUND'], new), new)
+            self.assertEqual(aggregates.stored(session)[0]['repos'], 1)
+            for _ in range(scraper_module.MAX_EXPAND_ERRORS + 1):
+                scraper.record_expand_error(scraper_module.EmptyResultError(['NOT_FOUND'], fetched))
+
+            stats, _ = aggregates.stored(session)
+            self.assertEqual((stats['repos'], stats['new_repos'], stats['repos_todo'], stats['repo_errors']),
+                             (0, 0, 0, 2))
+            self.assertEqual(aggregates.check(session), {})
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_matches_keys_case_insensitively(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'case.db')
+            scraper = MainScraper(tokens=TokenPool(['a']), api_url='http://github.invalid', session=session,
+                                  cache=IdentityCache())
+            scraper.add_new_repos([(('Someone', 'User'), 'Repo')])
+            session.commit()
+
+            repo, = scraper.find_by_key([('someone', 'REPO')])
+            self.assertEqual((repo.owner.login, repo.name), ('Someone', 'Repo'))
+
+            scraper.frontier.note_sightings(session, {(repo.owner_id, 'rEPO')})
+            session.commit()
+            self.assertEqual(session.query(Repo.sightings).scalar(), 1)
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_pipeline_matches_scraper_loop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            repos = self.crawl(directory, False)
+            self.assertTrue(repos)
+            self.assertEqual({state for _, _, state in repos}, {STATE_EXPANDED})
+            self.assertEqual(self.crawl(directory, True), repos)
+
+    def test_bisects_failed_fetches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            repos = self.crawl(directory, False, poisoned={0}, broken={1})
+            self.assertEqual({(name, state) for _, name, state in repos if state != STATE_EXPANDED},
+                             {('repo0', STATE_ERROR), ('repo1', STATE_ERROR)})
+            self.assertGreater(len(repos), 2)
+            self.assertEqual(self.crawl(directory, True, poisoned={0}, broken={1}), repos)
+
+    @unittest.skipIf(ijson is None, 'ijson is not installed')
+    def test_streamed_fetches_match_whole_responses(self):
+        with tempfile.TemporaryDirectory() as directory:
+            repos = self.crawl(directory, False, poisoned={0}, broken={1})
+            self.assertEqual(self.crawl(directory, False, poisoned={0}, broken={1}, stream=True), repos)
+
+    @unittest.skipIf(ijson is None, 'ijson is not installed')
+    def test_keeps_repos_streamed_before_a_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'cut.db')
+            graph = FakeGraph(100)
+            transport = Transport()
+            scraper = MainScraper(tokens=TokenPool(['a']), api_url='http://github.invalid', session=session,
+                                  cache=IdentityCache())
+            scraper.stream_fetches = True
+            scraper.stream_chunk = 1
+            scraper.add_new_repos([(graph.owner(repo), 'repo%d' % repo) for repo in range(4)])
+            session.commit()
+            todos = scraper.new_repo_queue.claim(4)
+            nodes = [graph.fetch_node(int(todo.name[4:])) for todo in todos]
+
+            def reply(nodes):
+                data = dict(('repo%d' % i, node) for i, node in enumerate(nodes, 1))
+                data['rateLimit'] = {'cost': 1, 'remaining': 4999, 'resetAt': '2030-01-01T00:00:00Z'}
+                return 200, json.dumps({'data': data}).encode('utf8'), {'Content-Type': 'application/json'}
+
+            # The first response stops partway through repo2, then the rest are fetched again in halves
+            _, body, headers = reply(nodes)
+            adapter = StubAdapter([(200, body[:body.index(b'"repo2"') + 20], headers),
+                                   reply(nodes[1:3]), reply(nodes[3:])])
+            transport.session.mount('http://', adapter)
+            with unittest.mock.patch.object(scraper_module, 'get_transport', return_value=transport):
+                scraper.fetch_batch(todos)
+
+            self.assertEqual([len(json.loads(request.body)['variables']) // 2 for request in adapter.sent], [4, 2, 1])
+            self.assertEqual({(name, state, attempts) for name, state, attempts in
+                              session.query(Repo.name, Repo.state, Repo.attempts)},
+                             {('repo%d' % repo, STATE_TODO, None) for repo in range(4)})
+            self.assertEqual(aggregates.check(session), {})
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_failed_round_keeps_finished_expansions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'round.db')
+            with FakeGithub(FakeGraph(100), rate_limit=10**6) as fake:
+                scraper = MainScraper(concurrency=2, tokens=TokenPool(['a']), api_url=fake.url, session=session,
+                                      cache=IdentityCache())
+                scraper.populate_most_popular()
+                scraper.fetch_new_repo_info()
+
+                sent = []
+                def failing_send_query(query, variables, **kwargs):
+                    sent.append(variables['name'])
+                    if len(sent) == 3:
+                        raise ValueError('unexpected')
+                    return send_query(query, variables, **kwargs)
+
+                with unittest.mock.patch.object(scraper_module, 'send_query', failing_send_query):
+                    self.assertRaises(ValueError, scraper.expand_repos_concurrently, round_size=8, write_batch=100)
+
+                states = dict(session.query(Repo.name, Repo.state).filter(Repo.name.in_(sent)))
+                self.assertEqual(states[sent[2]], STATE_TODO)
+                self.assertIn(STATE_EXPANDED, states.values())
+                self.assertEqual(session.query(Repo).filter(Repo.leased_by.isnot(None)).count(), 0)
+                self.assertEqual(aggregates.check(session), {})
+
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_resolves_renamed_and_missing_repos(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'renames.db')
+
+            graph = FakeGraph(100)
+            (login3, type3), (login5, type5) = graph.owner(3), graph.owner(5)
+            graph.renames[(login5, 'old-name')] = 5
+            graph.renames[(login3, 'older')] = 3
+
+            with FakeGithub(graph, rate_limit=10**6) as fake:
+                scraper = MainScraper(tokens=TokenPool(['a']), api_url=fake.url, session=session,
+                                      cache=IdentityCache())
+                scraper.add_new_repos([((login5, type5), 'old-name'), ((login3, type3), 'repo3'),
+                                       ((login3, type3), 'older'), ((login3, type3), 'gone')])
+                session.commit()
+                scraper.fetch_new_repo_info()
+
+                repos = {(owner, name): state for owner, name, state in
+                         session.query(Owner.login, Repo.name, Repo.state).join(Repo.owner)}
+                self.assertEqual(repos, {(login5, 'repo5'): STATE_TODO, (login3, 'repo3'): STATE_TODO,
+                                         (login3, 'gone'): STATE_MISSING})
+                self.assertEqual(session.query(RepoRedirect).count(), 2)
+                self.assertEqual(aggregates.check(session), {})
+
+                # Found again under their old names, or while missing: nothing new to fetch
+                self.assertEqual(scraper.add_new_repos([((login5, type5), 'old-name'), ((login3, type3), 'older'),
+                                                        ((login3, type3), 'gone')]), set())
+                session.commit()
+                self.assertIsNone(scraper.new_repo_queue.available().first())
+
+                self.assertEqual(scraper.requeue_missing_repos(ttl=0), 1)
+                self.assertEqual(aggregates.check(session), {})
+
+            scraper.cache.detach(session)
+            session.close()
+
+    def test_refresh_resolves_renamed_repos(self):
+        with tempfile.TemporaryDirectory() as directory:
+            session = self.database(directory, 'refresh-renames.db')
+
+            graph = FakeGraph(100)
+            owners = {repo: graph.owner(repo) for repo in (3, 5, 7)}
+            with FakeGithub(graph, rate_limit=10**6) as fake:
+                scraper = MainScraper(tokens=TokenPool(['a']), api_url=fake.url, session=session,
+                                      cache=IdentityCache())
+                scraper.add_new_repos([(owners[repo], 'repo%d' % repo) for repo in (3, 5, 7)])
+                session.commit()
+                scraper.fetch_new_repo_info()
+
+                # Renamed on github since they were fetched: repo5 to its current name, and repo7 to the name of
+                # repo3, which is already known
+                graph.renames[(owners[5][0], 'old-name')] = 5
+                graph.renames[(owners[7][0], 'copy')] = 3
+                session.query(Repo).filter_by(name='repo5').update({'name': 'old-name'})
+                session.query(Repo).filter_by(name='repo7').update({'name': 'copy'})
+                session.query(Repo).update({'fetched_at': 0})
+                session.commit()
+                scraper.cache.clear()
+
+                self.assertEqual(scraper.refresh_stale_repos(max_age=60), 3)
+                repos = {(owner, name): state for owner, name, state in
+                         session.query(Owner.login, Repo.name, Repo.state).join(Repo.owner)}
+                self.assertEqual(repos, {(owners[5][0], 'repo5'): STATE_TODO, (owners[3][0], 'repo3'): STATE_TODO,
+                                         (owners[7][0], 'copy'): STATE_MISSING})
+                self.assertEqual(session.query(RepoRedirect).count(), 2)
+                self.assertEqual(aggregates.check(session), {})
+                self.assertEqual(scraper.add_new_repos([(owners[5], 'old-name'), (owners[7], 'copy')]), set())
+
+            scraper.cache.detach(session)
+            session.close()
+
+try:
+    import pyarrow.parquet as pq
+    from github_repos.export import Exporter
+except ImportError:
+    pq = None
+
+@unittest.skipIf(pq is None, 'pyarrow is not installed')
+class TestExport(unittest.TestCase):
+    def add_repos(self, engine, first, n, fetched_at=None):
+        with engine.begin() as conn:
+            conn.execute(insert(Repo.__table__), [{'id': i, 'name': 'repo%d' % i, 'owner_id': 1, 'is_fork': i % 2 == 0,
+                                                   'state': STATE_TODO if fetched_at else STATE_NEW,
+                                                   'fetched_at': fetched_at, 'priority': 1.0}
+                                                  for i in range(first, first + n)])
+
+    def test_appends_new_and_refetched_rows(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'crawl.db'))
+            Base.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.execute(insert(OwnerType.__table__), [{'id': 1, 'type': 'User'}])
+                conn.execute(insert(Owner.__table__), [{'id': 1, 'login': 'someone', 'type_id': 1}])
+            self.add_repos(engine, 1, 25, fetched_at=1000.0)
+            self.add_repos(engine, 26, 1)
+
+            exporter = Exporter(os.path.join(directory, 'export'), engine, chunk_rows=10, rows_per_file=20,
+                                settle_seconds=0)
+            self.assertEqual(exporter.export()['repositories'], 25)
+
+            # Repos fetched since, one of them found before the last export, and one re-fetched
+            self.add_repos(engine, 27, 5, fetched_at=time.time())
+            with engine.begin() as conn:
+                conn.execute(Repo.__table__.update().where(Repo.__table__.c.id.in_([3, 26]))
+                             .values(state=STATE_EXPANDED, description='fetched', fetched_at=time.time()))
+                conn.execute(insert(Language.__table__), [{'id': 1, 'name': 'Python'}])
+                conn.execute(insert(RepoLanguages.__table__), [{'repo_id': 26, 'lang_id': 1, 'bytes_used': 10}])
+            self.assertEqual(exporter.export(), {'repositories': 7, 'owners': 0, 'languages': 1, 'repo_languages': 1})
+            self.assertEqual(exporter.export()['repositories'], 0)
+
+            table = pq.read_table(os.path.join(directory, 'export', 'repositories'))
+            self.assertEqual(sorted(table.column('id').to_pylist()), sorted(list(range(1, 32)) + [3]))
+            self.assertEqual(table.schema.field('name').type.value_type, 'string')
+            self.assertFalse({'state', 'priority', 'leased_by', 'attempts'} & set(table.schema.names))
+            self.assertEqual(len(os.listdir(os.path.join(directory, 'export', 'repositories'))), 3)
+
+            self.assertEqual(exporter.export(full=True)['repositories'], 31)
+            table = pq.read_table(os.path.join(directory, 'export', 'repositories'))
+            self.assertEqual(table.num_rows, 31)
+            descriptions = dict(zip(table.column('id').to_pylist(), table.column('description').to_pylist()))
+            self.assertEqual((descriptions[3], descriptions[26]), ('fetched', 'fetched'))
+
+            # Repos fetched just now are left for the next export, in case older stamps are still being written
+            self.add_repos(engine, 32, 1, fetched_at=time.time())
+            self.assertEqual(Exporter(os.path.join(directory, 'export'), engine).export()['repositories'], 0)
@@ -0,0 +1,176 @@
+import time
+import threading
+import logging as _logging
+
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+RATE_LIMIT = 5000
+RATE_LIMIT_WINDOW = 3600
+# Seconds to wait past a reset time, in case our clock is ahead of github's
+RESET_MARGIN = 30
+
+
+class Token():
+    '''A personal access token and its rate limit budget. Points are reserved before a query is sent with the token
+    and released once its response (and its rateLimit block) has come back.
+
+    When paced, spending also draws on a token bucket holding up to `burst` points, refilled at the rate that would
+    spend what is left of the window evenly until it resets. Every rateLimit block updates remaining and reset_time,
+    so the rate follows what github reports without asking separately.'''
+
+    def __init__(self, key, name=None, remaining=RATE_LIMIT, reset_time=None):
+        self.key = key
+        self.name = name or key[:4] + '...'
+        self.remaining = remaining
+        self.reset_time = reset_time or time.time() + RATE_LIMIT_WINDOW
+        # Until github tells us, reset_time is only a guess
+        self.reset_known = reset_time is not None
+        self.reserved = 0
+        self.bucket = None
+        self.filled_at = None
+
+    def __repr__(self):
+        return '<Token {} {} remaining until {}>'.format(self.name, self.remaining, time.ctime(self.reset_time))
+
+    def roll_over(self, now=None):
+        now = now or time.time()
+        if now >= self.reset_time:
+            self.remaining = RATE_LIMIT
+            self.reset_time = now + RATE_LIMIT_WINDOW
+            self.reset_known = False
+
+    def headroom(self, now=None):
+        self.roll_over(now)
+        return self.remaining - self.reserved
+
+    def reserve(self, cost):
+        if cost > self.headroom():
+            return False
+        self.reserved += cost
+        return True
+
+    def release(self, cost):
+        self.reserved = max(0, self.reserved - cost)
+
+    def rate(self, now=None, reserve=2):
+        '''Points per second that spend the headroom left, bar `reserve`, evenly over the rest of the window'''
+
+        now = now or time.time()
+        return max(0, self.headroom(now) - reserve) / max(1.0, self.reset_time - now)
+
+    def refill(self, burst, now=None):
+        '''Tops up the bucket for the time since the last refill, up to `burst`. A new token starts full'''
+
+        now = now or time.time()
+        if self.filled_at is None:
+            self.bucket = burst
+        else:
+            self.bucket = min(burst, self.bucket + self.rate(now) * (now - self.filled_at))
+        self.filled_at = now
+
+    def update(self, remaining, reset_time):
+        # Responses can arrive out of order, so within one window only ever lower the remaining count
+        if reset_time > self.reset_time or not self.reset_known:
+            self.remaining = remaining
+            self.reset_time = reset_time
+            self.reset_known = True
+        else:
+            self.remaining = min(self.remaining, remaining)
+
+
+class TokenPool():
+    '''Routes each query to the token with the most headroom. With `pacing` (default rate_limit_pacing) a token
+    only takes a query while its bucket has the points for it, so the budget is spread over each window instead of
+    spent at the start of it'''
+
+    def __init__(self, keys, pacing=None, burst=None):
+        if not keys:
+            raise ValueError('TokenPool needs at least one token')
+
+        self.tokens = [Token(key, 'token{}'.format(i)) for i, key in enumerate(keys)]
+        self.lock = threading.Lock()
+        self.pacing = getattr(g, 'rate_limit_pacing', True) if pacing is None else pacing
+        self.burst = burst or getattr(g, 'rate_limit_burst', 200)
+
+    @classmethod
+    def from_config(cls):
+        return cls(getattr(g, 'personal_tokens', None) or [g.personal_token])
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def best(self):
+        with self.lock:
+            return max(self.tokens, key=lambda token: token.headroom())
+
+    def affordable(self, token, cost, reserve, now):
+        if token.headroom(now) - reserve < cost:
+            return False
+        if self.pacing:
+            token.refill(self.burst, now)
+            # Queries costing more than a whole bucket go once it is full, and leave it in debt
+            return token.bucket >= min(cost, self.burst)
+        return True
+
+    def acquire(self, cost, reserve=2):
+        '''Reserves `cost` points on the token with the most headroom that can afford them now, keeping `reserve`
+        points spare. Returns the token, or None if every token is exhausted or, when paced, has to wait'''
+
+        with self.lock:
+            now = time.time()
+            for token in sorted(self.tokens, key=lambda token: token.headroom(now), reverse=True):
+                if self.affordable(token, cost, reserve, now) and token.reserve(cost):
+                    if self.pacing:
+                        token.bucket -= cost
+                    return token
+            return None
+
+    def wait_time(self, cost, reserve=2):
+        '''Seconds until some token can afford `cost` points: until its bucket refills if its window has them
+        left, otherwise until it resets'''
+
+        with self.lock:
+            now = time.time()
+            waits = []
+            for token in self.tokens:
+                if token.headroom(now) - reserve < cost:
+                    waits.append(token.reset_time + RESET_MARGIN - now)
+                elif not self.pacing:
+                    return 0
+                else:
+                    token.refill(self.burst, now)
+                    deficit = min(cost, self.burst) - token.bucket
+                    rate = token.rate(now, reserve)
+                    if deficit <= 0:
+                        return 0
+                    waits.append(deficit / rate if rate > 0 else token.reset_time + RESET_MARGIN - now)
+            return max(0, min(waits))
+
+    def release(self, token, cost):
+        with self.lock:
+            token.release(cost)
+
+    def update(self, token, remaining, reset_time):
+        with self.lock:
+            token.update(remaining, reset_time)
+
+    def exhaust(self, token):
+        log.warning('%s was rate limited', token.name)
+        with self.lock:
+            token.remaining = 0
+
+    def headroom(self):
+        return self.best().headroom()
+
+    def next_reset(self):
+        '''When the soonest exhausted token refills, or the soonest reset of any token if none are exhausted'''
+
+        with self.lock:
+            exhausted = [token.reset_time for token in self.tokens if token.headroom() <= 2]
+            return min(exhausted or [token.reset_time for token in self.tokens])
@@ -0,0 +1,118 @@
+import gzip
+import json
+import time
+import threading
+import collections
+import logging as _logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+RETRY_STATUSES = (502, 503, 504)
+
+RequestRecord = collections.namedtuple('RequestRecord',
+                                       'time latency bytes_sent wire_bytes_received status attempts')
+
+
+class Transport():
+    '''Keep-alive HTTP transport for GraphQL queries.
+
+    Connections are pooled per host, responses are gzipped on the wire, and request bodies can be gzipped too.
+    Timeouts and the "weird timeout html page" github serves instead of JSON are retried with exponential backoff.
+    Every request's latency and size is recorded in `records`. Sizes are of the bodies on the wire, so compressed
+    when they were gzipped.'''
+
+    def __init__(self, timeout=None, retries=None, backoff=None, gzip_requests=None, pool_size=None):
+        self.timeout = timeout or getattr(g, 'http_timeout', (10, 120))
+        self.retries = retries if retries is not None else getattr(g, 'http_retries', 3)
+        self.backoff = backoff if backoff is not None else getattr(g, 'http_backoff', 2.0)
+        self.gzip_requests = gzip_requests if gzip_requests is not None else getattr(g, 'http_gzip_requests', False)
+        pool_size = pool_size or max(10, getattr(g, 'scraper_concurrency', 1))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip', 'Content-Type': 'application/json'})
+
+        self.records = collections.deque(maxlen=1000)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.wire_bytes_received = 0
+        self.latency = 0.0
+
+    def encode(self, payload):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf8')
+        if self.gzip_requests:
+            return gzip.compress(body, 5), {'Content-Encoding': 'gzip'}
+        return body, {}
+
+    def post(self, url, payload, headers=None, stream=False):
+        '''POSTs `payload` as JSON. Returns the last response, which is an error page if every attempt failed. With
+        `stream`, the body of the returned response is left to be read (and the response closed) by the caller'''
+
+        body, extra_headers = self.encode(payload)
+        headers = dict(headers or {}, **extra_headers)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, data=body, headers=headers, timeout=self.timeout, stream=stream)
+                retry = response.status_code in RETRY_STATUSES or not is_json(response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt > self.retries:
+                    raise
+                log.warning('%s, retrying', e)
+                response = None
+                retry = True
+
+            if response is not None:
+                self.record(start, len(body), response, attempt, stream)
+            if not retry or attempt > self.retries:
+                return response
+            if response is not None:
+                response.close()
+
+            delay = self.backoff ** attempt
+            log.warning('Github returned %s, retrying in %.1f seconds',
+                        response.status_code if response is not None else 'nothing', delay)
+            time.sleep(delay)
+
+    def record(self, start, bytes_sent, response, attempts, stream=False):
+        latency = time.perf_counter() - start
+        # A streamed body hasn't been read yet, so only its declared (compressed) length is known, if any
+        wire_bytes_received = int(response.headers.get('Content-Length') or 0) if stream else response.raw.tell()
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+            self.wire_bytes_received += wire_bytes_received
+            self.latency += latency
+            self.records.append(RequestRecord(time.time(), latency, bytes_sent, wire_bytes_received,
+                                              response.status_code, attempts))
+
+    def close(self):
+        self.session.close()
+
+
+def is_json(response):
+    return 'json' in response.headers.get('Content-Type', '')
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    '''The process-wide Transport used by send_query'''
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport()
+        return _transport
@@ -0,0 +1,97 @@
+import os
+import time
+import socket
+import logging as _logging
+
+from sqlalchemy import or_
+
+import github_repos.config as g
+
+
+log = _logging.getLogger(__name__)
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class LeaseQueue():
+    '''Work queue over the rows matching `criteria` of a table with leased_by, lease_expires, attempts and errors
+    columns, e.g. the repos in one state.
+
+    A worker claims rows with SELECT ... FOR UPDATE SKIP LOCKED and marks them leased for `lease_seconds`, so other
+    workers sharing the database skip them. When their work is done, rows leave the queue by no longer matching
+    `criteria`, e.g. by moving on to the next state. Otherwise they are released, optionally counting a failed
+    attempt. A lease that isn't renewed expires, and its rows can be claimed again, counting an attempt since the
+    worker holding it died or hung.'''
+
+    def __init__(self, session, model, criteria=(), worker_id=None, lease_seconds=None, order_by=None):
+        self.session = session
+        self.model = model
+        self.criteria = criteria
+        self.order_by = order_by or (model.id,)
+        self.worker_id = worker_id or getattr(g, 'scraper_worker_id', None) or default_worker_id()
+        self.lease_seconds = lease_seconds or getattr(g, 'scraper_lease_seconds', 600)
+
+    def available(self, now=None):
+        '''Rows nobody holds a live lease on'''
+
+        now = now or time.time()
+        return self.session.query(self.model) \
+                           .filter(*self.criteria) \
+                           .filter(or_(self.model.lease_expires.is_(None), self.model.lease_expires < now))
+
+    def claim(self, n):
+        '''Leases up to `n` rows in `order_by` (default id) order and commits. Rows reclaimed from an expired lease
+        get an attempt counted against them. Returns the leased rows'''
+
+        now = time.time()
+        rows = self.available(now) \
+                   .order_by(*self.order_by) \
+                   .limit(n) \
+                   .with_for_update(skip_locked=True) \
+                   .all()
+
+        for row in rows:
+            if row.leased_by is not None:
+                log.info('Reclaiming %s %d from expired lease of %s', self.model.__tablename__, row.id, row.leased_by)
+                row.attempts = (row.attempts or 0) + 1
+            row.leased_by = self.worker_id
+            row.lease_expires = now + self.lease_seconds
+
+        self.session.commit()
+        return rows
+
+    def _mine(self, rows):
+        # Not filtered by criteria, so rows that moved on to another queue's criteria are still released
+        ids = [row if isinstance(row, int) else row.id for row in rows]
+        return self.session.query(self.model) \
+                           .filter(self.model.id.in_(ids)) \
+                           .filter(self.model.leased_by == self.worker_id)
+
+    def renew(self, rows):
+        '''Heartbeat: extends the lease on `rows` (or row ids) that are still ours'''
+
+        if rows:
+            self._mine(rows).update({self.model.lease_expires: time.time() + self.lease_seconds},
+                                   synchronize_session=False)
+            self.session.commit()
+
+    def release(self, rows):
+        '''Gives up the lease on `rows` (or row ids) without counting a failure. Rows that no longer exist (e.g. merged
+        into another after a rename) are skipped'''
+
+        if rows:
+            self._mine(rows).update({self.model.leased_by: None, self.model.lease_expires: None},
+                                   synchronize_session=False)
+            self.session.commit()
+
+    def fail(self, row, errors):
+        '''Counts a failed attempt on `row`, records `errors` and releases its lease. Returns the attempt count.
+        Doesn't commit'''
+
+        row.attempts = (row.attempts or 0) + 1
+        row.errors = (row.errors + '\n' if row.errors else '') + repr(errors)
+        row.leased_by = None
+        row.lease_expires = None
+        return row.attempts